@@ -0,0 +1,173 @@
+"""
+admission
+~~~~~~~~~
+
+Admission control for the expensive routes.  Each limited route has a
+fixed number of concurrent slots and a bounded waiting line; when both
+are full the request is shed at once with ``503`` and ``Retry-After``
+instead of joining an unbounded pile-up.
+
+Every admitted request carries a deadline (the route default, shortened
+by an ``X-Request-Timeout`` header in milliseconds).  A request whose
+deadline passes while it waits in line ends with ``504``, like one that
+runs out of time later: the preprocessing pipeline and the views check
+the deadline between steps and abandon the work once the client has
+given up.
+
+Limits can be overridden per route with ``ADMISSION_<ROUTE>=concurrency:queue:timeout``,
+e.g. ``ADMISSION_PREDICT=8:32:5``.
+"""
+
+#### Libraries
+# Standard library
+import functools
+import os
+import threading
+import time
+
+# Third-party libraries
+from flask import jsonify, request
+
+import metrics
+
+GATES = {}
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """The request ran past its deadline; the result is no longer wanted."""
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded("Request deadline exceeded")
+
+
+def current_deadline():
+    return getattr(_local, "deadline", None)
+
+
+def check_deadline():
+    """Raise DeadlineExceeded if the current request's deadline has passed."""
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check()
+
+
+def run_with_deadline(deadline, fn, *args):
+    """Call ``fn(*args)`` in this thread with ``deadline`` as the current one (for ``asgi_app``'s pools)."""
+    _local.deadline = deadline
+    try:
+        deadline.check()
+        return fn(*args)
+    finally:
+        _local.deadline = None
+
+
+def deadline_hook(pipeline_name, stage_name, seconds):
+    """Pipeline hook that stops preprocessing once the deadline has passed."""
+    check_deadline()
+
+
+class Gate:
+    """``concurrency`` slots plus a waiting line of at most ``queue_size`` requests."""
+
+    def __init__(self, concurrency, queue_size, labels=(), timeout=None, retry_after=1):
+        self.labels = labels
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout  # default deadline of the route, in seconds
+        self.retry_after = retry_after
+        self.waiting = 0
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """Returns "ok", "full" (line is full) or "timeout" (waited past the deadline)."""
+        if self._slots.acquire(blocking=False):
+            return "ok"
+        with self._lock:
+            if self.waiting >= self.queue_size:
+                return "full"
+            self.waiting += 1
+        metrics.QUEUED.inc(*self.labels)
+        try:
+            return "ok" if self._slots.acquire(timeout=timeout) else "timeout"
+        finally:
+            metrics.QUEUED.dec(*self.labels)
+            with self._lock:
+                self.waiting -= 1
+
+    def admit(self, deadline):
+        """``acquire`` until the deadline and count shed and expired requests; returns its outcome."""
+        admitted = self.acquire(deadline.remaining())
+        if admitted == "full":
+            metrics.SHED.inc(*self.labels)
+        elif admitted == "timeout":
+            metrics.EXPIRED.inc(*self.labels)
+        return admitted
+
+    def release(self):
+        self._slots.release()
+
+
+def queue_depth():
+    """Requests currently waiting for a slot, over all limited routes."""
+    return sum(gate.waiting for gate in GATES.values())
+
+
+def client_timeout(default, header):
+    """The route's ``default`` timeout, shortened by an ``X-Request-Timeout`` header (milliseconds)."""
+    try:
+        return min(default, float(header) / 1000.0) if header else default
+    except ValueError:
+        return default
+
+
+def limit(app_name, route, concurrency, queue, timeout, retry_after=1):
+    """
+    Decorator for a Flask view: admit at most ``concurrency`` requests at
+    once with ``queue`` more waiting, and give each a deadline of
+    ``timeout`` seconds.
+    """
+    override = os.getenv("ADMISSION_" + route.upper())
+    if override:
+        values = override.split(":")
+        concurrency = int(values[0])
+        queue = int(values[1]) if len(values) > 1 else queue
+        timeout = float(values[2]) if len(values) > 2 else timeout
+    gate = GATES[(app_name, route)] = Gate(concurrency, queue, (app_name, route), timeout, retry_after)
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            deadline = Deadline(client_timeout(timeout, request.headers.get("X-Request-Timeout")))
+            admitted = gate.admit(deadline)
+            if admitted == "full":
+                response = jsonify({"error": "Server busy, please retry"})
+                return response, 503, {"Retry-After": str(retry_after)}
+            if admitted == "timeout":
+                return jsonify({"error": "Request deadline exceeded"}), 504
+
+            _local.deadline = deadline
+            try:
+                check_deadline()
+                return view(*args, **kwargs)
+            except DeadlineExceeded as e:
+                metrics.EXPIRED.inc(app_name, route)
+                return jsonify({"error": str(e)}), 504
+            finally:
+                _local.deadline = None
+                gate.release()
+        return wrapper
+    return decorator
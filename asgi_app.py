@@ -0,0 +1,380 @@
+"""
+ASGI variant of the digit apps.
+
+The Flask apps block a worker thread for the whole request, including
+the Gemini round trip.  Here the event loop only awaits: CPU-bound work
+(PNG decode, preprocessing, SVM predict) runs in a small pool sized to
+the CPUs, and blocking LLM calls run in a separate, much larger I/O pool.
+Hundreds of game sessions can wait on Gemini without taking a thread
+away from ``/predict``.
+
+Hot game endpoints are native async handlers that split the request into
+its CPU step and its LLM step.  They go through the same admission gate,
+deadline and request metrics as the Flask view they replace.  Every other
+route is served by the app's Flask view, run in the pool that matches its
+cost.
+
+    DIGIT_APP=spy_game uvicorn asgi_app:app --port 5000
+    CPU_WORKERS=4 IO_WORKERS=512 uvicorn asgi_app:app
+"""
+
+import asyncio
+import importlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import admission
+import metrics
+import preprocessing
+
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 1)))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "256"))
+MAX_BODY_BYTES = preprocessing.MAX_REQUEST_BYTES  # what the Flask apps' MAX_CONTENT_LENGTH allows
+
+CPU_EXECUTOR = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+
+async def run_cpu(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(CPU_EXECUTOR, fn, *args)
+
+
+async def run_io(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(IO_EXECUTOR, fn, *args)
+
+
+# --- ASGI PLUMBING ---
+class BodyTooLarge(Exception):
+    """The request body is over MAX_BODY_BYTES."""
+
+
+def header(scope, name):
+    """The first value of a request header (``name`` in lower case), or None."""
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def read_body(scope, receive, limit=MAX_BODY_BYTES):
+    """The whole request body; raises BodyTooLarge as soon as it passes ``limit`` bytes."""
+    try:
+        declared = int(header(scope, b"content-length") or 0)
+    except ValueError:
+        declared = 0
+    if declared > limit:
+        raise BodyTooLarge()
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_too_large(send):
+    await send_json(send, {"error": "Request too large"}, 413)
+
+
+async def send_response(send, status, body, headers):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, payload, status=200, headers=()):
+    await send_response(send, status, json.dumps(payload).encode(), [("Content-Type", "application/json"), *headers])
+
+
+def wsgi_environ(scope, body):
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "SERVER_NAME": (scope.get("server") or ("localhost", 80))[0],
+        "SERVER_PORT": str((scope.get("server") or ("localhost", 80))[1]),
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif key != "CONTENT_LENGTH":
+            key = "HTTP_" + key
+            environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """Run a WSGI app to completion; returns (status, headers, body)."""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"], started["headers"] = int(status.split(" ", 1)[0]), headers
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return started["status"], started["headers"], body
+
+
+def flask_route(wsgi_app, runner):
+    """Serve a request with the Flask view, in the pool picked by ``runner``."""
+    async def handler(scope, receive, send):
+        try:
+            body = await read_body(scope, receive)
+        except BodyTooLarge:
+            await send_too_large(send)
+            return
+        status, headers, payload = await runner(call_wsgi, wsgi_app, wsgi_environ(scope, body))
+        await send_response(send, status, payload, headers)
+    return handler
+
+
+# --- NATIVE GAME HANDLERS ---
+def native(game, handler, limited=None):
+    """
+    Wrap ``handler(scope, receive, send, deadline)`` with the request metrics
+    of the Flask apps and, for a ``limited`` route, its admission gate: shed
+    with 503 and Retry-After, 504 once the deadline passes (in line or later).  Without a gate
+    the deadline is None.
+    """
+    gate = admission.GATES.get((game.APP_NAME, limited)) if limited else None
+
+    async def wrapped(scope, receive, send):
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_recorded(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        metrics.IN_FLIGHT.inc(game.APP_NAME)
+        try:
+            if gate is None:
+                await handler(scope, receive, send_recorded, None)
+                return
+            deadline = admission.Deadline(admission.client_timeout(gate.timeout, header(scope, b"x-request-timeout")))
+            admitted = await run_io(gate.admit, deadline)
+            if admitted == "full":
+                await send_json(send_recorded, {"error": "Server busy, please retry"}, 503,
+                                [("Retry-After", str(gate.retry_after))])
+                return
+            if admitted == "timeout":
+                await send_json(send_recorded, {"error": "Request deadline exceeded"}, 504)
+                return
+            try:
+                await handler(scope, receive, send_recorded, deadline)
+            except admission.DeadlineExceeded as e:
+                metrics.EXPIRED.inc(*gate.labels)
+                await send_json(send_recorded, {"error": str(e)}, 504)
+            finally:
+                gate.release()
+        finally:
+            metrics.IN_FLIGHT.dec(game.APP_NAME)
+            metrics.record_request(game.APP_NAME, scope["path"], status[0], time.perf_counter() - start)
+
+    return wrapped
+
+
+async def read_image(scope, receive, send):
+    """Parse the JSON body; answers 400 (413 if too large) and returns None if there is no image."""
+    try:
+        data = json.loads(await read_body(scope, receive) or b"null")
+    except BodyTooLarge:
+        await send_too_large(send)
+        return None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or "image" not in data:
+        await send_json(send, {"error": "No image provided"}, 400)
+        return None
+    return data["image"]
+
+
+def game_session(scope):
+    """(session id, response headers) from the request's game session cookie; a new id is set as a cookie."""
+    import game_sessions
+
+    cookie = "; ".join(value.decode("latin-1") for name, value in scope.get("headers", []) if name == b"cookie")
+    sid = game_sessions.id_from_cookie_header(cookie)
+    if sid is not None:
+        return sid, []
+    sid = game_sessions.new_id()
+    return sid, [("Set-Cookie", game_sessions.set_cookie_header(sid))]
+
+
+def player(scope):
+    """(player id, response headers) from the request's long-lived player cookie."""
+    import player_stats
+
+    cookie = "; ".join(value.decode("latin-1") for name, value in scope.get("headers", []) if name == b"cookie")
+    player_id = player_stats.player_from_cookie_header(cookie)
+    if player_id is not None:
+        return player_id, []
+    player_id = player_stats.new_id()
+    return player_id, [("Set-Cookie", player_stats.set_cookie_header(player_id))]
+
+
+async def send_conflict(send, headers):
+    await send_json(send, {"error": "Another move in this game was handled first; please retry."}, 409, headers)
+
+
+def starship_routes(game):
+    import game_sessions
+
+    async def start_game(scope, receive, send, deadline):
+        sid, headers = game_session(scope)
+        await send_json(send, await run_io(game.begin_story, sid), headers=headers)
+
+    async def submit_drawing(scope, receive, send, deadline):
+        sid, headers = game_session(scope)
+        player_id, player_headers = player(scope)
+        headers += player_headers
+        image = await read_image(scope, receive, send)
+        if image is None:
+            return
+        guess = await run_cpu(admission.run_with_deadline, deadline, game.classify_drawing, image)
+        deadline.check()  # don't start an LLM call nobody is waiting for
+        try:
+            result = await run_io(game.advance_story, sid, guess["prediction"], player_id)
+        except game_sessions.Conflict:
+            await send_conflict(send, headers)
+            return
+        await send_json(send, {**result, "confidence": guess["confidence"], "top_k": guess["top_k"]}, headers=headers)
+
+    return {("GET", "/start_game"): native(game, start_game),
+            ("POST", "/submit_drawing"): native(game, submit_drawing, limited="submit_drawing")}
+
+
+def spy_routes(game):
+    async def start_game(scope, receive, send, deadline):
+        sid, headers = game_session(scope)
+        await send_json(send, await run_io(game.begin_mission, sid), headers=headers)
+
+    async def submit_drawing(scope, receive, send, deadline):
+        sid, headers = game_session(scope)
+        player_id, player_headers = player(scope)
+        headers += player_headers
+        timed_out = await run_io(game.check_time_up, sid)
+        if timed_out:
+            await send_json(send, timed_out, headers=headers)
+            return
+        image = await read_image(scope, receive, send)
+        if image is None:
+            return
+        guess = await run_cpu(admission.run_with_deadline, deadline, game.classify_drawing, image)
+        deadline.check()  # don't start an LLM call nobody is waiting for
+        result = await run_io(game.process_submission, sid, guess["prediction"], player_id)
+        await send_json(send, {**result, "confidence": guess["confidence"], "top_k": guess["top_k"]}, headers=headers)
+
+    return {("GET", "/start_game"): native(game, start_game),
+            ("POST", "/submit_drawing"): native(game, submit_drawing, limited="submit_drawing")}
+
+
+def recognizer_routes(game):
+    import live
+
+    channel = game.live_channel
+
+    async def live_stream(scope, receive, send):
+        # The WSGI bridge buffers whole responses, so the SSE stream is native:
+        # waiting for frames happens in the I/O pool, inference in the CPU pool.
+        session = channel.open()
+        if session is None:
+            await send_json(send, {"error": "Too many live sessions"}, 503)
+            return
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            session.close()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]})
+            message = live.sse("ready", {"session": session.id})
+            while not session.closed:
+                await send({"type": "http.response.body", "body": message.encode(), "more_body": True})
+                message = ""
+                while not message and not session.closed:
+                    data_url = await run_io(session.take, channel.wait_seconds(session))
+                    if data_url is None and session.deferred_x is None:
+                        message = live.HEARTBEAT
+                        continue
+                    event = await run_cpu(channel.process, session, data_url)
+                    if event is not None:
+                        message = live.sse("prediction", event)
+                    elif data_url is None:
+                        message = live.HEARTBEAT
+        finally:
+            watcher.cancel()
+            channel.close(session)
+
+    return {("GET", "/live"): live_stream}
+
+
+# Native handlers per app, and the Flask routes that are CPU-bound (everything
+# else runs in the I/O pool because it may wait on Gemini).
+NATIVE_ROUTES = {"number_recognizer_app": recognizer_routes, "starship_calibrator": starship_routes,
+                 "spy_game": spy_routes}
+CPU_ROUTES = {
+    "number_recognizer_app": {"/predict", "/predict_digits"},
+    "game_for_kids": {"/predict", "/hint"},
+}
+
+
+def create_app(module_name):
+    """Build an ASGI app around one of the Flask app modules."""
+    game = importlib.import_module(module_name)
+    native_routes = NATIVE_ROUTES.get(module_name, lambda g: {})(game)
+    cpu_routes = CPU_ROUTES.get(module_name, set())
+    on_cpu = flask_route(game.app.wsgi_app, run_cpu)
+    on_io = flask_route(game.app.wsgi_app, run_io)
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    CPU_EXECUTOR.shutdown(wait=False)
+                    IO_EXECUTOR.shutdown(wait=False)
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        handler = native_routes.get((scope["method"], scope["path"]))
+        if handler is None:
+            handler = on_cpu if scope["path"] in cpu_routes else on_io
+        await handler(scope, receive, send)
+
+    return app
+
+
+app = create_app(os.getenv("DIGIT_APP", "number_recognizer_app"))
@@ -0,0 +1,158 @@
+"""
+Validate and benchmark the NumPy preprocessing in ``preprocessing.py``
+against the original PIL implementation.
+
+Both pipelines are run over a corpus of canvas-style PNGs (280x280 black
+strokes on white) and compared pixel by pixel and, when the SVM model is
+available, by predicted digit.  Each stage is timed separately.
+
+    python bench_preprocessing.py                  # synthesize 500 canvases from MNIST
+    python bench_preprocessing.py --corpus pngs/   # use your own canvas PNGs
+"""
+
+import argparse
+import gzip
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageOps, ImageChops, ImageFilter
+
+import preprocessing
+
+MNIST_IMAGES = os.path.join("data", "MNIST", "raw", "t10k-images-idx3-ubyte.gz")
+MNIST_LABELS = os.path.join("data", "MNIST", "raw", "t10k-labels-idx1-ubyte.gz")
+MODEL_PATH = "svm_mnist_model.pkl"
+
+
+# --- REFERENCE (original PIL pipeline, split into the same stages) ---
+def pil_decode(img_bytes):
+    return Image.open(io.BytesIO(img_bytes)).convert('L')
+
+
+def pil_crop(img):
+    img = ImageOps.invert(img)
+    bbox = img.getbbox()
+    return img.crop(bbox) if bbox else None
+
+
+def pil_resize(img):
+    width, height = img.size
+    max_side = max(width, height)
+    new_width = int(round(width * 20.0 / max_side))
+    new_height = int(round(height * 20.0 / max_side))
+    return img.resize((new_width, new_height), resample=Image.LANCZOS)
+
+
+def pil_center(img):
+    new_img = Image.new('L', (28, 28), 0)
+    new_img.paste(img, ((28 - img.size[0]) // 2, (28 - img.size[1]) // 2))
+    arr = np.array(new_img, dtype=np.float32)
+    if arr.sum() > 0:
+        cy, cx = np.indices(arr.shape)
+        total = arr.sum()
+        shift_x = int(round(14 - (cx * arr).sum() / total))
+        shift_y = int(round(14 - (cy * arr).sum() / total))
+        new_img = ImageChops.offset(new_img, shift_x, shift_y)
+    return new_img
+
+
+def pil_normalize(img):
+    return (np.array(img, dtype=np.float32) / 255.0).reshape(1, -1)
+
+
+REFERENCE_STAGES = [("decode", pil_decode), ("crop", pil_crop), ("resize", pil_resize),
+                    ("center", pil_center), ("normalize", pil_normalize)]
+NUMPY_STAGES = [("decode", preprocessing.decode), ("crop", preprocessing.crop_to_content),
+                ("resize", preprocessing.resize_to_box), ("center", preprocessing.center_in_frame),
+                ("normalize", preprocessing.normalize)]
+
+
+# --- CORPUS ---
+def synthesize_corpus(count, seed=0, labels=False):
+    """
+    Render MNIST test digits as 280x280 canvas PNGs with varied stroke weight and placement.
+    With ``labels=True`` returns (png, digit) pairs.
+    """
+    rng = np.random.default_rng(seed)
+    with gzip.open(MNIST_IMAGES, 'rb') as f:
+        digits = np.frombuffer(f.read(), dtype=np.uint8, offset=16).reshape(-1, 28, 28)
+    if labels:
+        with gzip.open(MNIST_LABELS, 'rb') as f:
+            digit_labels = np.frombuffer(f.read(), dtype=np.uint8, offset=8)
+    corpus = []
+    for i in rng.choice(len(digits), size=count, replace=False):
+        size = int(rng.integers(120, 280))
+        digit = Image.fromarray(digits[i]).resize((size, size), resample=Image.BILINEAR)
+        width = int(rng.integers(0, 4)) * 2 + 1
+        if width > 1:
+            digit = digit.filter(ImageFilter.MaxFilter(width))
+        canvas = Image.new('L', (280, 280), 0)
+        offset = rng.integers(0, 280 - size + 1, size=2)
+        canvas.paste(digit, (int(offset[0]), int(offset[1])))
+        buf = io.BytesIO()
+        ImageOps.invert(canvas).convert('RGBA').save(buf, format='PNG')
+        corpus.append((buf.getvalue(), int(digit_labels[i])) if labels else buf.getvalue())
+    return corpus
+
+
+def load_corpus(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(('.png', '.jpg', '.jpeg')):
+            with open(os.path.join(directory, name), 'rb') as f:
+                corpus.append(f.read())
+    return corpus
+
+
+# --- BENCHMARK ---
+def run_stages(stages, img_bytes, timings):
+    value = img_bytes
+    for name, stage in stages:
+        start = time.perf_counter()
+        value = stage(value)
+        timings[name] += time.perf_counter() - start
+        if value is None:  # blank canvas
+            return np.zeros((1, 784), dtype=np.float32)
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="directory of canvas PNG/JPEG files")
+    parser.add_argument("--count", type=int, default=500, help="number of synthetic canvases")
+    parser.add_argument("--repeat", type=int, default=3, help="timing passes over the corpus")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthesize_corpus(args.count)
+    print(f"Corpus: {len(corpus)} images")
+
+    ref_times = {name: 0.0 for name, _ in REFERENCE_STAGES}
+    new_times = {name: 0.0 for name, _ in NUMPY_STAGES}
+    for _ in range(args.repeat):
+        ref = np.vstack([run_stages(REFERENCE_STAGES, b, ref_times) for b in corpus])
+        new = np.vstack([run_stages(NUMPY_STAGES, b, new_times) for b in corpus])
+
+    diff = np.abs(ref - new)
+    print("\nValidation (pixel values in 0-1)")
+    print(f"  mean abs diff: {diff.mean():.4f}   max abs diff: {diff.max():.4f}")
+    print(f"  mean per-image L2 distance: {np.linalg.norm(ref - new, axis=1).mean():.4f}")
+    if os.path.exists(MODEL_PATH):
+        import joblib
+        clf = joblib.load(MODEL_PATH)
+        agree = (clf.predict(ref) == clf.predict(new)).mean()
+        print(f"  SVM prediction agreement: {agree * 100:.2f}%")
+
+    runs = len(corpus) * args.repeat
+    print(f"\nPer-stage time (microseconds per image, {args.repeat} passes)")
+    print(f"  {'stage':<10} {'PIL':>10} {'NumPy':>10} {'speedup':>8}")
+    for name, _ in REFERENCE_STAGES:
+        ref_us, new_us = ref_times[name] / runs * 1e6, new_times[name] / runs * 1e6
+        print(f"  {name:<10} {ref_us:>10.1f} {new_us:>10.1f} {ref_us / max(new_us, 1e-9):>7.1f}x")
+    ref_total, new_total = sum(ref_times.values()) / runs * 1e6, sum(new_times.values()) / runs * 1e6
+    print(f"  {'total':<10} {ref_total:>10.1f} {new_total:>10.1f} {ref_total / new_total:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+challenge_pool
+~~~~~~~~~~~~~~
+
+Ready-made game challenges, kept topped up in the background.
+
+One pool per key (the kids' game uses its levels).  ``take`` pops from
+the pool under a lock and never waits for the LLM; when a pool drops
+below half of ``CHALLENGE_POOL_SIZE`` a background thread asks
+``refill(key, CHALLENGE_BATCH)`` for a whole batch at a time until it is
+full again.  A failing refill is retried after ``RETRY_SECONDS``, so an
+LLM outage costs one call per key per interval, not one per game.
+
+The refill thread starts with the app's first request (a health probe
+will do) under ``app.run``, ``asgi_app`` and ``multi_game``, and right
+after the fork in each ``serve.py`` worker, so every worker fills its
+own pools.  It never starts in the ``serve.py`` master (the process
+named by ``SERVE_MASTER_PID``): a thread caught mid-call by the fork
+could leave the workers' HTTP client locked.
+Pool sizes and how many challenges came from the pool are exported in
+``/metrics``.
+"""
+
+#### Libraries
+# Standard library
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+
+CHALLENGE_POOL_SIZE = int(os.getenv("CHALLENGE_POOL_SIZE", "50"))
+CHALLENGE_BATCH = int(os.getenv("CHALLENGE_BATCH", "20"))
+RETRY_SECONDS = 30.0
+
+_pools = []  # every ChallengePool in this process, restarted after a fork
+
+
+class ChallengePool:
+    """Per-key deques of challenges, refilled in batches by one background thread."""
+
+    def __init__(self, name, keys, refill, size=CHALLENGE_POOL_SIZE, batch=CHALLENGE_BATCH):
+        self.name = name
+        self.keys = list(keys)
+        self.refill = refill
+        self.size = size
+        self.low = size // 2
+        self.batch = batch
+        self._pools = {key: deque() for key in self.keys}
+        self._retry_at = {key: 0.0 for key in self.keys}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        _pools.append(self)
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork: each serve.py worker starts its own.
+        if self._pid != os.getpid() and os.getenv("SERVE_MASTER_PID") != str(os.getpid()):
+            with self._lock:
+                if self._pid == os.getpid():
+                    return
+                self._pid = os.getpid()
+                self._wake = threading.Event()
+                threading.Thread(target=self._run, name="challenge-pool-" + self.name, daemon=True).start()
+
+    def start(self):
+        """Begin filling the pools now rather than on the first ``take``."""
+        self._ensure_worker()
+        self._wake.set()
+
+    def install(self, app):
+        """Start filling when a Flask app serves its first request."""
+
+        @app.before_request
+        def _start_challenge_pool():
+            if self._pid != os.getpid():
+                self.start()
+
+    def take(self, key, count):
+        """Up to ``count`` challenges for ``key``; fewer (or none) if the pool is running dry."""
+        self._ensure_worker()
+        pool = self._pools[key]
+        with self._lock:
+            taken = [pool.popleft() for _ in range(min(count, len(pool)))]
+            remaining = len(pool)
+        metrics.CHALLENGE_POOL.set(remaining, self.name, key)
+        metrics.CHALLENGES_SERVED.inc(self.name, "pool", amount=len(taken))
+        metrics.CHALLENGES_SERVED.inc(self.name, "fallback", amount=count - len(taken))
+        if remaining < self.low:
+            self._wake.set()
+        return taken
+
+    def _fill(self, key):
+        pool = self._pools[key]
+        while len(pool) < self.size and time.monotonic() >= self._retry_at[key]:
+            try:
+                items = self.refill(key, self.batch)
+            except Exception as e:
+                print(f"[{self.name}] refilling the {key} challenge pool failed: {e}")
+                items = []
+            if not items:
+                self._retry_at[key] = time.monotonic() + RETRY_SECONDS
+                return
+            with self._lock:
+                pool.extend(items[:self.size - len(pool)])
+                metrics.CHALLENGE_POOL.set(len(pool), self.name, key)
+
+    def _run(self):
+        wake = self._wake
+        while True:
+            for key in self.keys:
+                self._fill(key)
+            wake.wait(RETRY_SECONDS)
+            wake.clear()
+
+
+def _start_in_child():
+    for pool in _pools:
+        pool._lock = threading.Lock()  # a parent's refill thread may have held it at the fork
+        pool.start()
+
+
+# A serve.py worker fills its own pools from the moment it is forked.
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_start_in_child)
@@ -0,0 +1,217 @@
+"""
+Classify a directory or tar archive of digit images offline.
+
+Uses the same preprocessing as the apps and ``svm_mnist_model.pkl``.
+Inputs are read one at a time (tar archives as a stream, so ``.tar.gz``
+piped from elsewhere works too), decoding and preprocessing fan out over
+a process pool, the model is called once per batch in this process, and
+every finished batch is written out right away.
+
+    python classify_bulk.py scans/ --output results.csv
+    python classify_bulk.py scans.tar.gz --output results.jsonl --workers 8
+    cat scans.tar | python classify_bulk.py - --threshold 200 > results.csv
+
+Scanned digits are rarely on pure white: ``--threshold N`` treats every
+pixel at least N light as background.  Use ``--invert`` for white-on-black
+images (like MNIST itself).
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from serve import pin_blas_threads
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+MODEL_PATH = "svm_mnist_model.pkl"
+PROGRESS_EVERY = 5.0  # seconds between progress lines
+
+_pipeline = None  # per worker process
+
+
+# --- INPUT ---
+def iter_directory(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(dirpath, filename)
+                with open(path, "rb") as f:
+                    yield os.path.relpath(path, root), f.read()
+
+
+def iter_tar(fileobj=None, path=None):
+    # "r|*" reads the archive sequentially without seeking, gzip/bz2/xz included.
+    with tarfile.open(name=path, fileobj=fileobj, mode="r|*") as archive:
+        for member in archive:
+            if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                yield member.name, archive.extractfile(member).read()
+
+
+def iter_inputs(source):
+    if source == "-":
+        return iter_tar(fileobj=sys.stdin.buffer)
+    if os.path.isdir(source):
+        return iter_directory(source)
+    return iter_tar(path=source)
+
+
+# --- WORKERS ---
+def _init_worker(threshold, invert):
+    import preprocessing
+
+    global _pipeline
+    stages = list(preprocessing.DEFAULT_STAGES)
+    if threshold < 255 or invert:
+        def clean(gray):
+            if invert:
+                gray = 255 - gray
+            if threshold < 255:
+                gray = gray.copy()
+                gray[gray >= threshold] = 255
+            return gray
+        stages.insert([name for name, stage in stages].index("decode") + 1, ("clean", clean))
+    _pipeline = preprocessing.Pipeline("bulk", stages=stages)
+
+
+def preprocess_chunk(items):
+    """[(name, bytes)] -> [(name, 1x784 array or None, error or None)]; one bad file never stops the chunk."""
+    import preprocessing
+
+    results = []
+    for name, img_bytes in items:
+        try:
+            x = _pipeline(img_bytes)
+            if not x.any():
+                results.append((name, None, "blank image"))
+            else:
+                results.append((name, x, None))
+        except preprocessing.PayloadError as e:
+            results.append((name, None, str(e)))
+        except Exception as e:
+            results.append((name, None, f"preprocessing failed: {e}"))
+    return results
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# --- OUTPUT ---
+class CsvWriter:
+    def __init__(self, out):
+        self.out = out
+        self.writer = csv.writer(out)
+        self.writer.writerow(["name", "prediction", "confidence", "top_k", "error"])
+
+    def write(self, name, result, error):
+        if error:
+            self.writer.writerow([name, "", "", "", error])
+        else:
+            top_k = " ".join(f"{d['digit']}:{d['confidence']}" for d in result["top_k"])
+            self.writer.writerow([name, result["prediction"], result["confidence"], top_k, ""])
+
+
+class JsonlWriter:
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, name, result, error):
+        record = {"name": name, "error": error} if error else {"name": name, **result}
+        self.out.write(json.dumps(record) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="directory, tar archive (optionally compressed), or - for a tar on stdin")
+    parser.add_argument("--output", "-o", default="-", help="results file (.csv or .jsonl), - for stdout")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="default: from the output extension, else csv")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="preprocessing processes")
+    parser.add_argument("--batch-size", type=int, default=256, help="images per model call")
+    parser.add_argument("--chunk-size", type=int, default=32, help="images per task sent to a worker")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--threshold", type=int, default=255, help="pixels at least this light are background")
+    parser.add_argument("--invert", action="store_true", help="images are light digits on a dark background")
+    parser.add_argument("--model", default=MODEL_PATH)
+    args = parser.parse_args()
+
+    pin_blas_threads(1)
+    import joblib
+    import numpy as np
+    import inference
+
+    clf = inference.prepare_model(joblib.load(args.model))
+    calibrator = inference.load_calibrator()
+
+    fmt = args.format or ("jsonl" if args.output.endswith(".jsonl") else "csv")
+    out = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    writer = (JsonlWriter if fmt == "jsonl" else CsvWriter)(out)
+
+    done = errors = 0
+    start = last_report = time.perf_counter()
+    pending = []    # (name, x, error) in input order, written once the batch is classified
+    batch_rows = 0
+
+    def flush_batch():
+        nonlocal done, batch_rows
+        rows = [x for name, x, error in pending if error is None]
+        results = iter(inference.classify(clf, np.vstack(rows), calibrator, args.top_k) if rows else [])
+        for name, x, error in pending:
+            writer.write(name, None if error else next(results), error)
+        done += len(rows)
+        pending.clear()
+        batch_rows = 0
+        out.flush()
+
+    def report(final=False):
+        elapsed = time.perf_counter() - start
+        rate = (done + errors) / elapsed if elapsed > 0 else 0.0
+        print(f"{'done' if final else 'progress'}: {done} classified, {errors} errors, "
+              f"{elapsed:.1f}s, {rate:.0f} images/s", file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(args.threshold, args.invert)) as pool:
+        # Keep a bounded number of chunks in flight so huge archives are never read into memory.
+        in_flight = deque()
+        max_in_flight = 2 * args.workers
+        chunks = chunked(iter_inputs(args.source), args.chunk_size)
+        while True:
+            while len(in_flight) < max_in_flight:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                in_flight.append(pool.submit(preprocess_chunk, chunk))
+            if not in_flight:
+                break
+            for name, x, error in in_flight.popleft().result():
+                pending.append((name, x, error))
+                if error:
+                    errors += 1
+                else:
+                    batch_rows += 1
+            if batch_rows >= args.batch_size:
+                flush_batch()
+            if time.perf_counter() - last_report >= PROGRESS_EVERY:
+                report()
+                last_report = time.perf_counter()
+    flush_batch()
+    report(final=True)
+    if out is not sys.stdout:
+        out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+confusion
+~~~~~~~~~
+
+Which digits the model misreads on real drawings, counted as they happen.
+
+The games know the digit they asked for and the digit the model read, so
+every submission is one cell of a 10x10 confusion matrix (rows: asked,
+columns: read).  ``record`` adds it to a running total and to a ring of
+``CONFUSION_WINDOW`` seconds of one-minute matrices, so memory stays
+constant however long the app runs and recent misreads are not drowned
+out by old ones.  A player who draws the wrong digit counts as a misread
+too; on enough traffic the patterns that stand out are the model's.
+
+``/confusion`` serves the matrices, the error rate per digit and the
+most frequent misreads; the cells are also exported in ``/metrics``.
+Every ``CONFUSION_SNAPSHOT_SECONDS`` each process appends its matrices
+to ``CONFUSION_SNAPSHOTS`` (one JSON line per process and interval), if
+anything changed.
+"""
+
+#### Libraries
+# Standard library
+import atexit
+import json
+import os
+import threading
+import time
+
+# Third-party libraries
+import numpy as np
+from flask import jsonify
+
+import metrics
+
+CONFUSION_WINDOW = float(os.getenv("CONFUSION_WINDOW", "3600"))
+CONFUSION_SNAPSHOTS = os.getenv("CONFUSION_SNAPSHOTS", "confusion_snapshots.jsonl")
+CONFUSION_SNAPSHOT_SECONDS = float(os.getenv("CONFUSION_SNAPSHOT_SECONDS", "300"))
+BUCKET_SECONDS = 60.0
+TOP_MISREADS = 10
+N_CLASSES = 10
+
+
+def _error_rates(confusion):
+    """Share of each asked digit read as something else, for digits seen at least once."""
+    rates = {}
+    for digit in range(N_CLASSES):
+        total = int(confusion[digit].sum())
+        if total:
+            rates[str(digit)] = round(1.0 - confusion[digit, digit] / total, 4)
+    return rates
+
+
+def _misreads(confusion, top=TOP_MISREADS):
+    off_diagonal = confusion * (1 - np.eye(N_CLASSES, dtype=np.int64))
+    cells = np.argsort(off_diagonal, axis=None)[::-1][:top]
+    return [{"asked": int(i // N_CLASSES), "read": int(i % N_CLASSES), "count": int(off_diagonal.flat[i])}
+            for i in cells if off_diagonal.flat[i]]
+
+
+class ConfusionTracker:
+    """A running confusion matrix plus a ring of per-minute matrices covering the window."""
+
+    def __init__(self, name, model_version=None, window=CONFUSION_WINDOW, path=CONFUSION_SNAPSHOTS,
+                 snapshot_every=CONFUSION_SNAPSHOT_SECONDS):
+        self.name = name
+        self.model_version = model_version
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.slots = max(1, int(round(window / BUCKET_SECONDS)))
+        self.total = np.zeros((N_CLASSES, N_CLASSES), dtype=np.int64)
+        self.ring = np.zeros((self.slots, N_CLASSES, N_CLASSES), dtype=np.int64)
+        self.ring_minute = np.full(self.slots, -1, dtype=np.int64)  # minute each slot holds
+        self._recorded = 0
+        self._snapshotted = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        atexit.register(self.snapshot)
+
+    def _ensure_writer(self):
+        # Threads do not survive a fork: each serve.py worker snapshots its own counts.
+        if self._pid != os.getpid() and self.path and self.snapshot_every > 0:
+            with self._lock:
+                if self._pid == os.getpid():
+                    return
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="confusion-" + self.name, daemon=True).start()
+
+    def record(self, asked, read):
+        """Count one drawing of digit ``asked`` that the model read as ``read``; O(1)."""
+        if not (isinstance(asked, int) and isinstance(read, int) and 0 <= asked < N_CLASSES
+                and 0 <= read < N_CLASSES):
+            return
+        self._ensure_writer()
+        minute = int(time.time() // BUCKET_SECONDS)
+        slot = minute % self.slots
+        with self._lock:
+            if self.ring_minute[slot] != minute:
+                self.ring[slot] = 0
+                self.ring_minute[slot] = minute
+            self.ring[slot, asked, read] += 1
+            self.total[asked, read] += 1
+            self._recorded += 1
+        metrics.CONFUSIONS.inc(self.name, str(asked), str(read))
+
+    def _window(self, now=None):
+        """(matrix summed over the window, [(minute, attempts, misreads)] oldest first)."""
+        minute = int((now or time.time()) // BUCKET_SECONDS)
+        with self._lock:
+            live = (self.ring_minute > minute - self.slots) & (self.ring_minute <= minute)
+            matrix = self.ring[live].sum(axis=0)
+            minutes = self.ring_minute[live]
+            per_minute = self.ring[live]
+        series = []
+        for i in np.argsort(minutes):
+            counts = per_minute[i]
+            attempts = int(counts.sum())
+            series.append((int(minutes[i]), attempts, attempts - int(np.trace(counts))))
+        return matrix, series
+
+    def report(self):
+        with self._lock:
+            total = self.total.copy()
+        window, series = self._window()
+        seen = int(total.sum())
+        return {
+            "app": self.name,
+            "model_version": self.model_version,
+            "pid": os.getpid(),
+            "drawings": seen,
+            "error_rate": round(1.0 - np.trace(total) / seen, 4) if seen else None,
+            "error_rate_by_digit": _error_rates(total),
+            "misreads": _misreads(total),
+            "confusion": total.tolist(),  # rows: digit asked for, columns: digit read
+            "window": {
+                "seconds": self.slots * BUCKET_SECONDS,
+                "drawings": int(window.sum()),
+                "error_rate_by_digit": _error_rates(window),
+                "misreads": _misreads(window),
+                "confusion": window.tolist(),
+                "per_minute": [{"minute": minute * int(BUCKET_SECONDS), "drawings": attempts, "misreads": misreads}
+                               for minute, attempts, misreads in series],
+            },
+        }
+
+    def snapshot(self):
+        """Append this process's matrices to the snapshot file if anything was recorded since the last one."""
+        if not self.path or self._recorded == self._snapshotted or self._pid != os.getpid():
+            return
+        with self._lock:
+            recorded, total = self._recorded, self.total.copy()
+        window, series = self._window()
+        line = {"time": time.time(), "app": self.name, "pid": os.getpid(), "model_version": self.model_version,
+                "confusion": total.tolist(), "window_seconds": self.slots * BUCKET_SECONDS,
+                "window_confusion": window.tolist()}
+        try:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(line, separators=(",", ":")) + "\n")
+        except OSError as e:
+            print(f"[{self.name}] writing the confusion snapshot failed: {e}")
+            return
+        self._snapshotted = recorded
+
+    def _run(self):
+        while True:
+            time.sleep(self.snapshot_every)
+            self.snapshot()
+
+
+def install(app, name, model_version=None, **kwargs):
+    """Add /confusion to a Flask app; returns the ConfusionTracker."""
+    tracker = ConfusionTracker(name, model_version, **kwargs)
+
+    @app.route("/confusion")
+    def confusion_report():
+        return jsonify(tracker.report())
+
+    return tracker
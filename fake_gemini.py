@@ -0,0 +1,232 @@
+"""
+Local stand-in for the Gemini API, for testing and benchmarking the games offline.
+
+Implements ``POST /v1beta/models/<model>:generateContent`` (the REST call
+``google.generativeai`` makes) and answers each game's prompts with
+well-formed canned JSON: story segments that follow the game context for
+the Starship Calibrator and the spy game, challenge lists for the Number
+Learning Adventure.  ``--canned FILE`` adds responses of your own (a JSON
+list of ``{"match": "prompt substring", "response": ...}``, checked
+first).
+
+Every response waits for a delay drawn from ``--latency``
+(``fixed:S``, ``uniform:LO:HI``, ``lognormal:MEDIAN:SIGMA`` or
+``exponential:MEAN``), and a fraction of calls can fail with 503 or 429,
+hang for ``--hang-seconds`` or return text that is not JSON.  Counts and
+latencies are served at ``/stats``.
+
+    python fake_gemini.py --port 8081 --latency lognormal:0.8:0.5 --error-rate 0.05
+    GEMINI_ENDPOINT=http://127.0.0.1:8081 GEMINI_API_KEY=fake python spy_game.py
+"""
+
+import argparse
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+
+# --- LATENCY ---
+def parse_latency(spec):
+    """A function returning one delay in seconds, from a spec like ``lognormal:0.8:0.5``."""
+    kind, *params = spec.split(":")
+    try:
+        params = [float(p) for p in params]
+        if kind == "fixed":
+            seconds, = params
+            return lambda: seconds
+        if kind == "uniform":
+            low, high = params
+            return lambda: random.uniform(low, high)
+        if kind == "lognormal":
+            median, sigma = params
+            return lambda: random.lognormvariate(0, sigma) * median
+        if kind == "exponential":
+            mean, = params
+            return lambda: random.expovariate(1 / mean) if mean > 0 else 0.0
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"Bad latency spec {spec!r}; use fixed:S, uniform:LO:HI, "
+                                     "lognormal:MEDIAN:SIGMA or exponential:MEAN")
+
+
+# --- CANNED RESPONSES ---
+def prompt_text(body):
+    return "\n".join(part.get("text", "") for content in body.get("contents", [])
+                     for part in content.get("parts", []))
+
+
+def game_context(text):
+    """The JSON game context the story prompts embed, or {}."""
+    match = re.search(r"(?:context|status):\s*(\{)", text)
+    if not match:
+        return {}
+    try:
+        return json.JSONDecoder().raw_decode(text, match.start(1))[0]
+    except ValueError:
+        return {}
+
+
+def starship_story(text):
+    context = game_context(text)
+    state, result = context.get("game_state"), context.get("result")
+    if state == "game_won":
+        return {"story_text": "All systems calibrated! Warp drive online. Outstanding work, Captain!",
+                "next_digit": None, "game_over": True}
+    if result == "failure":
+        target = context.get("target_digit")
+        return {"story_text": f"The energy matrix flickered. Try drawing the number {target} again, Captain.",
+                "next_digit": target, "game_over": False}
+    digit = random.randint(0, 9)
+    if state == "welcome":
+        story = f"Welcome aboard the Stardust Cruiser, Captain! Draw the number {digit} to start calibration."
+    else:
+        story = f"Circuits aligned! The shields are online. Now draw the number {digit}."
+    return {"story_text": story, "next_digit": digit, "game_over": False}
+
+
+def spy_story(text):
+    context = game_context(text)
+    state, digit = context.get("game_state"), context.get("next_digit")
+    if state == "welcome":
+        story = f"Director Thorne: SYNAPSE is probing the firewall. Your first counter-protocol code is {digit}."
+    elif state == "time_up":
+        story = "Director Thorne: We're out of time. SYNAPSE is loose. Mission failed."
+    elif state == "game_won":
+        story = "Director Thorne: Every firewall layer holds. SYNAPSE is contained. Well done, Specialist."
+    elif context.get("result") == "success":
+        story = f"Director Thorne: Layer reinforced. Next code: {digit}."
+    else:
+        story = f'Director Thorne: Code rejected. Re-enter {digit}. SYNAPSE: "You are too slow."'
+    return {"story_text": story}
+
+
+KIDS_THEMES = [("A puppy buried {} bones in the garden.", "Draw the number of bones!"),
+               ("The rocket has {} engines roaring.", "Draw how many engines!"),
+               ("The pirate found {} shiny coins.", "Draw the number of coins!"),
+               ("The wizard waved {} magic wands.", "Draw how many wands!")]
+
+
+def kids_challenges(text):
+    match = re.search(r"Create (\d+) .*? numbers (\d+)-(\d+)", text)
+    count, low, high = (int(g) for g in match.groups()) if match else (3, 0, 9)
+    challenges = []
+    for _ in range(count):
+        answer = random.randint(low, high)
+        story, challenge = random.choice(KIDS_THEMES)
+        challenges.append({"story": story.format(answer), "challenge": challenge, "answer": answer})
+    # Gemini usually wraps free-form JSON in a code fence; the game strips it
+    return "```json\n" + json.dumps(challenges) + "\n```"
+
+
+RESPONDERS = [("Stardust Cruiser", "starship_calibrator", starship_story),
+              ("SYNAPSE", "spy_game", spy_story),
+              ("educational challenges for kids", "game_for_kids", kids_challenges)]
+
+
+def respond(text, canned):
+    """(game, response text) for a prompt."""
+    for entry in canned:
+        if entry["match"] in text:
+            response = entry["response"]
+            return "canned", response if isinstance(response, str) else json.dumps(response)
+    for marker, game, responder in RESPONDERS:
+        if marker in text:
+            response = responder(text)
+            return game, response if isinstance(response, str) else json.dumps(response)
+    return "other", json.dumps({"text": "This is a canned response from fake_gemini."})
+
+
+def gemini_error(code, status, message):
+    return jsonify({"error": {"code": code, "message": message, "status": status}}), code
+
+
+# --- SERVER ---
+def create_app(args):
+    app = Flask("fake_gemini")
+    latency = args.latency
+    canned = []
+    if args.canned:
+        with open(args.canned) as f:
+            canned = json.load(f)
+    lock = threading.Lock()
+    stats = {"requests": 0, "outcomes": {}, "games": {}, "seconds": []}
+
+    def record(game, outcome, seconds):
+        with lock:
+            stats["requests"] += 1
+            stats["outcomes"][outcome] = stats["outcomes"].get(outcome, 0) + 1
+            stats["games"][game] = stats["games"].get(game, 0) + 1
+            stats["seconds"].append(seconds)
+
+    @app.route("/<version>/models/<model>:generateContent", methods=["POST"])
+    def generate_content(version, model):
+        start = time.perf_counter()
+        game, text = respond(prompt_text(request.get_json(force=True, silent=True) or {}), canned)
+        time.sleep(latency())
+        roll = random.random()
+        if roll < args.error_rate:
+            record(game, "unavailable", time.perf_counter() - start)
+            return gemini_error(503, "UNAVAILABLE", "The model is overloaded. Please try again later.")
+        roll -= args.error_rate
+        if roll < args.rate_limit_rate:
+            record(game, "rate_limited", time.perf_counter() - start)
+            return gemini_error(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).")
+        roll -= args.rate_limit_rate
+        outcome = "ok"
+        if roll < args.hang_rate:
+            time.sleep(args.hang_seconds)
+            outcome = "hung"
+        elif roll - args.hang_rate < args.malformed_rate:
+            text = "Sure! Here is your story: {not json"
+            outcome = "malformed"
+        record(game, outcome, time.perf_counter() - start)
+        return jsonify({
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"},
+                            "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {"promptTokenCount": len(text) // 4, "candidatesTokenCount": len(text) // 4,
+                              "totalTokenCount": len(text) // 2},
+            "modelVersion": model,
+        })
+
+    @app.route("/stats")
+    def show_stats():
+        with lock:
+            seconds = sorted(stats["seconds"])
+            summary = {key: value for key, value in stats.items() if key != "seconds"}
+        pick = lambda q: round(seconds[min(len(seconds) - 1, int(q * len(seconds)))], 4) if seconds else None
+        summary.update(p50_seconds=pick(0.50), p95_seconds=pick(0.95), p99_seconds=pick(0.99))
+        return jsonify(summary)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=parse_latency, default=parse_latency("lognormal:0.8:0.4"),
+                        help="response delay distribution (default lognormal:0.8:0.4)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls answered 429")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="fraction of calls that hang")
+    parser.add_argument("--hang-seconds", type=float, default=60.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="fraction of answers that are not JSON")
+    parser.add_argument("--canned", help="JSON file of extra {match, response} entries")
+    parser.add_argument("--seed", type=int, help="seed for reproducible responses and faults")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no line per request
+    print(f"Fake Gemini on http://{args.host}:{args.port} "
+          f"(set GEMINI_ENDPOINT=http://{args.host}:{args.port} and any GEMINI_API_KEY)")
+    create_app(args).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
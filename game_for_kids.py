@@ -1,29 +1,51 @@
-import base64
-import io
-import joblib
-import numpy as np
 import json
 import random
 import google.generativeai as genai
-from flask import Flask, request, jsonify, render_template_string, session
-from PIL import Image, ImageOps, ImageChops
+from flask import Flask, request, jsonify
 import os
+import time
 from datetime import datetime
 from dotenv import load_dotenv
-
-
+import admission
+import challenge_pool
+import confusion
+import game_sessions
+import health
+import inference
+import llm_client
+import metrics
+import player_stats
+import preprocessing
+import shadow
+import static_pages
+
+
+APP_NAME = "game_for_kids"
 load_dotenv(".env")
 app = Flask("Number Learning Adventure")
-app.secret_key = "your-secret-key-change-this"
+app.config["MAX_CONTENT_LENGTH"] = preprocessing.MAX_REQUEST_BYTES  # rejected with 413 before parsing
+metrics.install(app, APP_NAME)
 
 # Configure Gemini AI
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "your-gemini-api-key-here")
-genai.configure(api_key=GEMINI_API_KEY)
+genai.configure(api_key=GEMINI_API_KEY, **llm_client.gemini_options())
 model = genai.GenerativeModel('gemini-2.0-flash')
+llm = llm_client.LLMClient(APP_NAME, model)
 
 # Load the SVM model
 MODEL_PATH = "svm_mnist_model.pkl"
-clf = joblib.load(MODEL_PATH)
+with metrics.timed(metrics.MODEL_LOAD_SECONDS, APP_NAME):
+    clf = inference.load_model(MODEL_PATH)
+calibrator = inference.load_calibrator()
+batcher = inference.shared_batcher(clf, calibrator)  # one inference worker for every app in the process
+MODEL_VERSION = inference.model_version(MODEL_PATH)
+shadow_model = shadow.install(app, APP_NAME, MODEL_VERSION)
+confusions = confusion.install(app, APP_NAME, MODEL_VERSION)  # digit asked for vs digit read
+
+# Shared preprocessing pipeline: data URL -> 1x784 vector
+preprocess = preprocessing.build_pipeline(APP_NAME, data_url=True)
+preprocess.add_hook(metrics.stage_hook)
+preprocess.add_hook(admission.deadline_hook)
 
 # Game configuration
 LEVELS = {
@@ -31,6 +53,21 @@ LEVELS = {
     "intermediate": {"range": [0, 9], "challenges": 5, "time_limit": 45},
     "advanced": {"range": [0, 9], "challenges": 7, "time_limit": 30}
 }
+MAX_HISTORY = 50  # answers remembered per session
+
+# Each player's game, kept server-side; the browser only holds the session id cookie
+sessions = game_sessions.install(app, APP_NAME, {
+    "game_start": None,
+    "level": "beginner",
+    "challenges": [],
+    "current_challenge": 0,
+    "score": 0,
+    "correct_answers": [],
+    "achievements": [],
+    "move_started": None  # when the current challenge was shown
+})
+# Each player's progress across games, and the leaderboard
+stats = player_stats.install(app, APP_NAME)
 
 # HTML page with game interface
 HTML_PAGE = """
@@ -320,7 +357,7 @@ async function startGame(level) {
 
 async function initializeGame() {
     try {
-        const response = await fetch('/start_game', {
+        const response = await fetch('start_game', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({ level: gameState.level })
@@ -384,7 +421,7 @@ async function submitAnswer() {
     const dataURL = canvas.toDataURL('image/png');
 
     try {
-        const response = await fetch('/predict', {
+        const response = await fetch('predict', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({ 
@@ -464,7 +501,7 @@ function updateAchievements() {
 
 async function getHint() {
     try {
-        const response = await fetch('/hint', {
+        const response = await fetch('hint', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({ 
@@ -524,47 +561,8 @@ initCanvas();
 """
 
 
-def preprocess_image_from_bytes(img_bytes):
-    """Same preprocessing function as original"""
-    img = Image.open(io.BytesIO(img_bytes)).convert('L')
-    img = ImageOps.invert(img)
-
-    bbox = img.getbbox()
-    if bbox:
-        img = img.crop(bbox)
-
-    if img.size[0] == 0 or img.size[1] == 0:
-        blank = Image.new('L', (28, 28), 0)
-        return np.array(blank, dtype=np.float32).reshape(1, -1) / 255.0
-
-    width, height = img.size
-    max_side = max(width, height)
-    new_width = int(round(width * 20.0 / max_side))
-    new_height = int(round(height * 20.0 / max_side))
-    img = img.resize((new_width, new_height), resample=Image.LANCZOS)
-
-    new_img = Image.new('L', (28, 28), 0)
-    upper_left = ((28 - new_width) // 2, (28 - new_height) // 2)
-    new_img.paste(img, upper_left)
-
-    arr = np.array(new_img, dtype=np.float32)
-    if arr.sum() > 0:
-        cy, cx = np.indices(arr.shape)
-        total = arr.sum()
-        x_center = (cx * arr).sum() / total
-        y_center = (cy * arr).sum() / total
-        shift_x = int(round(14 - x_center))
-        shift_y = int(round(14 - y_center))
-        new_img = ImageChops.offset(new_img, shift_x, shift_y)
-
-    arr = np.array(new_img, dtype=np.float32)
-    arr = arr / 255.0
-    flat = arr.reshape(1, -1)
-    return flat
-
-
 def generate_challenges(level, count):
-    """Generate challenges using Gemini AI"""
+    """Generate a batch of challenges using Gemini AI; raises if none could be made"""
     level_config = LEVELS[level]
     min_num, max_num = level_config["range"]
 
@@ -593,28 +591,39 @@ def generate_challenges(level, count):
     Make each challenge unique and age-appropriate for 5-8 year olds.
     """
 
-    try:
-        response = model.generate_content(prompt)
-        # Extract JSON from response
-        content = response.text
-        if "```json" in content:
-            content = content.split("```json")[1].split("```")[0]
-        elif "```" in content:
-            content = content.split("```")[1]
+    # Not cached: every pool refill must bring new challenges, or players see the same sets again
+    content = llm.generate(prompt)
 
-        challenges = json.loads(content.strip())
+    # Extract JSON from response
+    if "```json" in content:
+        content = content.split("```json")[1].split("```")[0]
+    elif "```" in content:
+        content = content.split("```")[1]
 
-        # Ensure answers are within range
-        for challenge in challenges:
-            if challenge["answer"] < min_num or challenge["answer"] > max_num:
-                challenge["answer"] = random.randint(min_num, max_num)
+    challenges = json.loads(content.strip())
 
-        return challenges
+    # Keep only well-formed challenges whose answer is in the level's range; the story
+    # mentions the answer, so a wrong one is dropped rather than replaced
+    valid = [challenge for challenge in challenges
+             if isinstance(challenge, dict)
+             and isinstance(challenge.get("story"), str) and isinstance(challenge.get("challenge"), str)
+             and isinstance(challenge.get("answer"), int) and min_num <= challenge["answer"] <= max_num]
+    if not valid:
+        raise ValueError("Gemini returned no usable challenges")
+    return valid
 
-    except Exception as e:
-        print(f"Error generating challenges with Gemini: {e}")
-        # Fallback challenges
-        return generate_fallback_challenges(level, count)
+
+# Challenges are generated in batches in the background; start_game only pops them
+challenges_ready = challenge_pool.ChallengePool(APP_NAME, LEVELS, generate_challenges)
+challenges_ready.install(app)
+
+
+def take_challenges(level, count):
+    """Challenges from the pool, topped up with fallback ones if it is running dry"""
+    challenges = challenges_ready.take(level, count)
+    if len(challenges) < count:
+        challenges += generate_fallback_challenges(level, count - len(challenges))
+    return challenges
 
 
 def generate_fallback_challenges(level, count):
@@ -659,24 +668,20 @@ def generate_feedback(correct, prediction, expected, level):
         return f"Good try! The number {expected} is a bit different. Keep practicing!"
 
 
-def calculate_achievements(session_data, prediction, expected, correct, time_taken):
-    """Calculate achievements based on performance"""
+def calculate_achievements(progress, prediction, expected, correct, time_taken):
+    """Calculate achievements from the player's progress, which includes this answer"""
     achievements = []
 
-    if 'achievements' not in session_data:
-        session_data['achievements'] = set()
-
-    # First correct answer
-    if correct and len(session_data.get('correct_answers', [])) == 0:
+    # First correct answer ever
+    if correct and progress['correct'] == 1:
         achievements.append("🌟 First Success!")
 
     # Speed achievements
-    if correct and time_taken < 10:
+    if correct and time_taken is not None and time_taken < 10:
         achievements.append("⚡ Lightning Fast!")
 
     # Accuracy streak
-    recent_answers = session_data.get('recent_answers', [])
-    if len(recent_answers) >= 2 and all(recent_answers[-2:]):
+    if progress['streak'] >= 2:
         achievements.append("🎯 Accuracy Master!")
 
     # Number specific achievements
@@ -693,9 +698,12 @@ def calculate_achievements(session_data, prediction, expected, correct, time_tak
     return achievements
 
 
+INDEX_PAGE = static_pages.Page(app, HTML_PAGE)
+
+
 @app.route("/")
 def index():
-    return render_template_string(HTML_PAGE)
+    return INDEX_PAGE.response()
 
 
 @app.route("/start_game", methods=["POST"])
@@ -707,17 +715,17 @@ def start_game():
         return jsonify({"error": "Invalid level"}), 400
 
     level_config = LEVELS[level]
-    challenges = generate_challenges(level, level_config["challenges"])
+    challenges = take_challenges(level, level_config["challenges"])
 
     # Initialize session data
-    session['game_start'] = datetime.now().isoformat()
-    session['level'] = level
-    session['challenges'] = challenges
-    session['current_challenge'] = 0
-    session['score'] = 0
-    session['correct_answers'] = []
-    session['recent_answers'] = []
-    session['achievements'] = []
+    def start(session):
+        session.update(sessions.new_state())
+        session['game_start'] = datetime.now().isoformat()
+        session['level'] = level
+        session['challenges'] = challenges
+        session['move_started'] = time.time()
+
+    sessions.update(sessions.current_id(), start)
 
     return jsonify({
         "challenges": challenges,
@@ -727,62 +735,68 @@ def start_game():
 
 
 @app.route("/predict", methods=["POST"])
+@admission.limit(APP_NAME, "predict", concurrency=os.cpu_count() or 1, queue=32, timeout=10)
 def predict():
     data = request.get_json()
     if not data or "image" not in data:
         return jsonify({"error": "No image provided"}), 400
 
-    data_url = data["image"]
     expected_answer = data.get("expected_answer")
 
-    if "," not in data_url:
-        return jsonify({"error": "Invalid image data"}), 400
-
-    header, b64 = data_url.split(",", 1)
-
     try:
-        img_bytes = base64.b64decode(b64)
-        x = preprocess_image_from_bytes(img_bytes)
-        prediction = int(clf.predict(x)[0])
+        x = preprocess(data["image"])
+        with metrics.timed(metrics.STAGE_SECONDS, APP_NAME, "predict"):
+            guess = batcher.classify(x)[0]
+        shadow_model.submit(x, [guess["prediction"]])
+        prediction = guess["prediction"]
 
         # Check correctness
         correct = prediction == expected_answer
 
-        # Calculate points
-        points = 10 if correct else 0
-        level = session.get('level', 'beginner')
-        if level == 'intermediate':
-            points *= 1.5
-        elif level == 'advanced':
-            points *= 2
-        points = int(points)
-
-        # Update session data
-        if 'correct_answers' not in session:
-            session['correct_answers'] = []
-        if 'recent_answers' not in session:
-            session['recent_answers'] = []
-
-        session['correct_answers'].append(correct)
-        session['recent_answers'].append(correct)
-        if len(session['recent_answers']) > 5:
-            session['recent_answers'].pop(0)
+        def record_answer(session):
+            # Calculate points
+            points = 10 if correct else 0
+            level = session['level']
+            if level == 'intermediate':
+                points *= 1.5
+            elif level == 'advanced':
+                points *= 2
+            points = int(points)
+
+            # Update session data
+            session['correct_answers'].append(correct)
+            del session['correct_answers'][:-MAX_HISTORY]
+            now = time.time()
+            time_taken = now - session['move_started'] if session['move_started'] else None
+            session['move_started'] = now
+            return level, points, time_taken
+
+        level, points, time_taken = sessions.update(sessions.current_id(), record_answer)
 
         # Calculate achievements
-        time_taken = 30  # Placeholder - you'd track this properly
-        achievements = calculate_achievements(session, prediction, expected_answer, correct, time_taken)
+        player = stats.current_player()
+        if isinstance(expected_answer, int) and 0 <= expected_answer <= 9:
+            stats.record(player, expected_answer, correct, time_taken)
+            confusions.record(expected_answer, prediction)
+        achievements = calculate_achievements(stats.progress(player), prediction, expected_answer, correct, time_taken)
 
         # Generate feedback
         feedback = generate_feedback(correct, prediction, expected_answer, level)
 
         return jsonify({
             "prediction": prediction,
+            "confidence": guess["confidence"],
+            "top_k": guess["top_k"],
             "correct": correct,
             "points": points,
             "feedback": feedback,
             "achievements": achievements
         })
 
+    except preprocessing.PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+    except admission.DeadlineExceeded:
+        raise
     except Exception as e:
         return jsonify({"error": f"Processing failed: {str(e)}"}), 500
 
@@ -811,9 +825,14 @@ def get_hint():
     return jsonify({"hint": hint})
 
 
+health.install(app, APP_NAME, lambda data_url: inference.classify(clf, preprocess(data_url), calibrator),
+               model_version=MODEL_VERSION)
+
+
 if __name__ == "__main__":
     print("🎮 Starting Number Learning Adventure!")
     print("📝 Make sure to set your GEMINI_API_KEY environment variable")
     print("📁 Ensure 'svm_mnist_model.pkl' is in this folder")
     print("🌐 Game running at http://127.0.0.1:5000")
+    challenges_ready.start()
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,263 @@
+"""
+game_sessions
+~~~~~~~~~~~~~
+
+Per-player game state for the story games, keyed by a session cookie.
+
+A record only holds the fields that differ from the game's default
+state (compact JSON in SQLite), plus a version number and the time it
+was last used.  Sessions idle for ``SESSION_IDLE`` seconds are evicted.
+
+``SESSION_STORE=memory`` (the default) keeps the records in the process,
+which is right for ``app.run`` or ``asgi_app``.  ``SESSION_STORE=sqlite``
+keeps them in ``SESSION_DB`` (WAL mode) so every ``serve.py`` worker
+sees the same sessions; ``serve.py`` picks it when it runs more than one
+worker.
+
+Transitions are atomic: ``update(sid, fn)`` runs ``fn(state)`` under the
+store's lock (an ``IMMEDIATE`` transaction in SQLite) and saves what it
+changed.  ``fn`` must be quick -- slow work such as an LLM call goes
+before or after it.  A transition computed from an earlier ``load`` can
+pass ``expect=version`` and gets ``Conflict`` (HTTP 409) if the session
+moved on in the meantime.
+"""
+
+#### Libraries
+# Standard library
+import copy
+import json
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from http.cookies import SimpleCookie
+
+# Third-party libraries
+from flask import g, jsonify, request
+
+import metrics
+
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+SESSION_DB = os.getenv("SESSION_DB", "game_sessions.sqlite3")
+SESSION_IDLE = float(os.getenv("SESSION_IDLE", "3600"))
+SWEEP_EVERY = 60.0  # seconds between evictions in SQLite
+COOKIE_NAME = "game_session"
+
+_VALID_ID = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+
+class Conflict(Exception):
+    """The session changed between ``load`` and ``update``."""
+
+
+def new_id():
+    return secrets.token_urlsafe(16)
+
+
+def id_from_cookie_header(header, name=COOKIE_NAME):
+    """The session id in a raw Cookie header, or None."""
+    if not header:
+        return None
+    try:
+        morsel = SimpleCookie(header).get(name)
+    except Exception:
+        return None
+    return morsel.value if morsel is not None and _VALID_ID.match(morsel.value) else None
+
+
+def set_cookie_header(sid):
+    """Value of a Set-Cookie header for a new session."""
+    return f"{COOKIE_NAME}={sid}; Path=/; HttpOnly; SameSite=Lax"
+
+
+# --- BACKENDS ---
+# A record is (version, compact state dict); ``fn`` maps a record (None for
+# a new session) to (new record or None to delete, result).
+class MemoryBackend:
+    """Records in an OrderedDict ordered by last use, so eviction pops from the front."""
+    kind = "memory"
+
+    def __init__(self, name):
+        self.name = name
+        self._records = OrderedDict()  # sid -> (last used, version, compact)
+        self._lock = threading.Lock()
+
+    def load(self, sid, idle):
+        with self._lock:
+            self._evict(time.time() - idle)
+            entry = self._records.get(sid)
+            return None if entry is None else entry[1:]
+
+    def update(self, sid, fn, idle):
+        with self._lock:
+            now = time.time()
+            self._evict(now - idle)
+            entry = self._records.get(sid)
+            record, result = fn(None if entry is None else entry[1:])
+            self._records.pop(sid, None)
+            if record is not None:
+                self._records[sid] = (now,) + record
+            if (entry is None) != (record is None):
+                metrics.GAME_SESSIONS.inc(self.name, amount=1 if entry is None else -1)
+            return result
+
+    def _evict(self, cutoff):
+        evicted = 0
+        while self._records:
+            sid, entry = next(iter(self._records.items()))
+            if entry[0] >= cutoff:
+                break
+            del self._records[sid]
+            evicted += 1
+        if evicted:
+            metrics.GAME_SESSIONS.dec(self.name, amount=evicted)
+            metrics.SESSIONS_EVICTED.inc(self.name, amount=evicted)
+
+    def __len__(self):
+        return len(self._records)
+
+
+class SQLiteBackend:
+    """Records in one SQLite table shared by all worker processes."""
+    kind = "sqlite"
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self._local = threading.local()
+        self._next_sweep = 0.0
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS game_sessions (app TEXT, id TEXT, seen REAL, version INTEGER, "
+                       "state TEXT, PRIMARY KEY (app, id))")
+            db.execute("CREATE INDEX IF NOT EXISTS game_sessions_seen ON game_sessions (app, seen)")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def load(self, sid, idle):
+        row = self._db().execute("SELECT version, state FROM game_sessions WHERE app = ? AND id = ? AND seen >= ?",
+                                 (self.name, sid, time.time() - idle)).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def update(self, sid, fn, idle):
+        db = self._db()
+        now = time.time()
+        if now >= self._next_sweep:
+            self._next_sweep = now + SWEEP_EVERY
+            self._sweep(db, now - idle)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT version, state FROM game_sessions WHERE app = ? AND id = ? AND seen >= ?",
+                             (self.name, sid, now - idle)).fetchone()
+            record, result = fn(None if row is None else (row[0], json.loads(row[1])))
+            if record is None:
+                db.execute("DELETE FROM game_sessions WHERE app = ? AND id = ?", (self.name, sid))
+            else:
+                db.execute("INSERT OR REPLACE INTO game_sessions VALUES (?, ?, ?, ?, ?)",
+                           (self.name, sid, now, record[0], json.dumps(record[1], separators=(",", ":"))))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return result
+
+    def _sweep(self, db, cutoff):
+        try:
+            evicted = db.execute("DELETE FROM game_sessions WHERE app = ? AND seen < ?", (self.name, cutoff)).rowcount
+            count = db.execute("SELECT COUNT(*) FROM game_sessions WHERE app = ?", (self.name,)).fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"[{self.name}] session sweep failed: {e}")
+            return
+        metrics.SESSIONS_EVICTED.inc(self.name, amount=evicted)
+        metrics.GAME_SESSIONS.set(count, self.name)
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM game_sessions WHERE app = ?", (self.name,)).fetchone()[0]
+
+
+# --- STORE ---
+class SessionStore:
+    """Game state per session id, stored as the difference from ``defaults``."""
+
+    def __init__(self, name, defaults, backend=SESSION_STORE, path=SESSION_DB, idle=SESSION_IDLE):
+        self.name = name
+        self.defaults = copy.deepcopy(defaults)
+        self.idle = idle
+        self.backend = SQLiteBackend(name, path) if backend == "sqlite" else MemoryBackend(name)
+
+    def _expand(self, compact):
+        state = copy.deepcopy(self.defaults)
+        state.update(compact)
+        return state
+
+    def _compact(self, state):
+        return {key: value for key, value in state.items()
+                if key not in self.defaults or self.defaults[key] != value}
+
+    def new_state(self):
+        """A fresh copy of the default state."""
+        return self._expand({})
+
+    def load(self, sid):
+        """(state, version) of a session; a new session has the default state and version 0."""
+        record = self.backend.load(sid, self.idle)
+        if record is None:
+            return self.new_state(), 0
+        return self._expand(record[1]), record[0]
+
+    def get(self, sid):
+        return self.load(sid)[0]
+
+    def update(self, sid, fn, expect=None):
+        """Atomically apply ``fn(state)`` (which changes ``state`` in place) and return its result."""
+        def transition(record):
+            version, compact = record if record is not None else (0, {})
+            if expect is not None and version != expect:
+                raise Conflict(f"Session is at version {version}, expected {expect}")
+            state = self._expand(compact)
+            result = fn(state)
+            return (version + 1, self._compact(state)), result
+
+        return self.backend.update(sid, transition, self.idle)
+
+    def reset(self, sid):
+        """Forget a session; returns the default state."""
+        self.backend.update(sid, lambda record: (None, None), self.idle)
+        return self.new_state()
+
+    # --- Flask ---
+    def current_id(self):
+        """The session id of the current Flask request; a new one is set as a cookie on the response."""
+        sid = id_from_cookie_header(request.headers.get("Cookie"))
+        if sid is None:
+            sid = g.get("new_game_session")
+            if sid is None:
+                sid = g.new_game_session = new_id()
+        return sid
+
+
+def install(app, name, defaults, **kwargs):
+    """Add session cookies and 409 on ``Conflict`` to a Flask app; returns the SessionStore."""
+    store = SessionStore(name, defaults, **kwargs)
+    print(f"[{name}] game sessions kept in {store.backend.kind}")
+
+    @app.after_request
+    def set_session_cookie(response):
+        sid = g.get("new_game_session")
+        if sid is not None:
+            response.headers.add("Set-Cookie", set_cookie_header(sid))
+        return response
+
+    @app.errorhandler(Conflict)
+    def session_conflict(e):
+        return jsonify({"error": "Another move in this game was handled first; please retry."}), 409
+
+    return store
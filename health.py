@@ -0,0 +1,135 @@
+"""
+health
+~~~~~~
+
+Startup warmup plus ``/healthz`` (liveness) and ``/readyz`` (readiness)
+endpoints.
+
+The first request after boot pays for lazy initialization: BLAS thread
+pools, libsvm's first call, PIL plugin loading and template rendering.
+``install`` pushes synthetic canvas drawings through the app's full
+preprocessing and predict path in a background thread, and ``/readyz``
+answers 503 until that has finished.  Forked workers (``serve.py``) warm
+themselves up again because those lazy costs are per process.
+
+Set ``WARMUP_ROUNDS`` to change how many passes over the synthetic
+digits are made (0 disables the warmup).
+"""
+
+#### Libraries
+# Standard library
+import base64
+import io
+import os
+import threading
+import time
+
+# Third-party libraries
+from flask import jsonify
+from PIL import Image, ImageDraw
+
+import admission
+import metrics
+
+WARMUP_ROUNDS = int(os.getenv("WARMUP_ROUNDS", "3"))
+
+_apps = {}  # name -> warmup state for every app installed in this process
+
+
+def synthetic_digits():
+    """Canvas-style data URLs: a few stroke-drawn digits and a blank canvas."""
+    shapes = [
+        [("line", (140, 50, 140, 230))],                                         # 1
+        [("ellipse", (80, 45, 200, 235))],                                       # 0
+        [("line", (80, 55, 200, 55)), ("line", (200, 55, 110, 235))],            # 7
+        [("ellipse", (95, 40, 185, 135)), ("ellipse", (85, 135, 195, 240))],     # 8
+        [],                                                                      # blank
+    ]
+    urls = []
+    for strokes in shapes:
+        img = Image.new("RGBA", (280, 280), "white")
+        draw = ImageDraw.Draw(img)
+        for kind, box in strokes:
+            if kind == "line":
+                draw.line(box, fill="black", width=18)
+            else:
+                draw.ellipse(box, outline="black", width=18)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        urls.append("data:image/png;base64," + base64.b64encode(buf.getvalue()).decode())
+    return urls
+
+
+def _run_warmup(state):
+    start = time.perf_counter()
+    try:
+        # Compiles and renders the page once; not counted as traffic, which forked workers would inherit
+        state["app"].test_client().get("/", environ_base={metrics.UNCOUNTED: True})
+        digits = synthetic_digits()
+        for _ in range(WARMUP_ROUNDS):
+            for data_url in digits:
+                state["warm"](data_url)
+    except Exception as e:
+        state["error"] = str(e)
+        print(f"[{state['name']}] warmup failed: {e}")
+    state["warmup_seconds"] = round(time.perf_counter() - start, 3)
+    state["ready"].set()
+
+
+def start_warmup(state):
+    state.update(warmup_seconds=None, error=None)
+    state["ready"].clear()
+    if WARMUP_ROUNDS <= 0:
+        state["ready"].set()
+        return
+    threading.Thread(target=_run_warmup, args=(state,), name="warmup-" + state["name"], daemon=True).start()
+
+
+def wait_ready(timeout=None):
+    """Block until every app in this process has warmed up (serve.py waits on this)."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for state in list(_apps.values()):
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not state["ready"].wait(remaining):
+            return False
+    return True
+
+
+def install(app, name, warm, model_version=None):
+    """
+    Add /healthz and /readyz to a Flask app and warm it up in the
+    background.  ``warm(data_url)`` must run preprocessing and predict.
+    """
+    state = _apps[name] = {"name": name, "app": app, "warm": warm, "ready": threading.Event(),
+                           "warmup_seconds": None, "error": None}
+
+    @app.route("/healthz")
+    def healthz():
+        return jsonify({"status": "ok", "app": name})
+
+    @app.route("/readyz")
+    def readyz():
+        ready = state["ready"].is_set()
+        body = {
+            "ready": ready,
+            "app": name,
+            "model_version": model_version,
+            "warmup_seconds": state["warmup_seconds"],
+            "warmup_error": state["error"],
+            "queue_depth": admission.queue_depth(),
+        }
+        return jsonify(body), 200 if ready else 503
+
+    start_warmup(state)
+    return app
+
+
+def _rewarm_after_fork():
+    for state in _apps.values():
+        state["ready"] = threading.Event()
+        start_warmup(state)
+
+
+# A forked worker starts cold again: redo the warmup in the child.
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_rewarm_after_fork)
@@ -0,0 +1,236 @@
+"""
+inference
+~~~~~~~~~
+
+Prediction plus calibrated top-k confidences from a single kernel pass.
+
+``SVC.predict`` and ``SVC.decision_function`` each evaluate the kernel
+against every support vector, and ``probability=True`` would retrain the
+SVM with internal cross-validation.  Instead the model is switched to
+return its raw one-vs-one decision values: the predicted digit is the
+libsvm vote over those values, and a small calibrator fitted by
+``model_trainer`` turns the same values into probabilities.  The
+prediction always comes first in ``top_k``; the other digits follow in
+order of probability.
+
+Models and calibrators are loaded once per path, so apps served from one
+process (``multi_game``) share a single copy.  A ``Batcher`` lets those
+apps' request threads share a pool of inference workers: rows submitted
+while every worker is busy are classified together in the next call.
+"""
+
+#### Libraries
+# Standard library
+import hashlib
+import os
+import queue
+import threading
+import time
+
+# Third-party libraries
+import joblib
+import numpy as np
+
+import metrics
+
+CALIBRATOR_PATH = "svm_mnist_calibrator.pkl"
+DEFAULT_TOP_K = 3
+BATCH_MAX_ROWS = int(os.getenv("BATCH_MAX_ROWS", "64"))
+BATCH_WAIT = float(os.getenv("BATCH_WAIT_MS", "0")) / 1e3  # extra time to wait for more rows; 0: only take queued ones
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", str(os.cpu_count() or 1)))  # libsvm releases the GIL
+
+_loaded = {}  # (kind, path) -> model, calibrator or version, shared by every app in the process
+_load_lock = threading.Lock()
+
+
+def _load_once(kind, path, load):
+    with _load_lock:
+        if (kind, path) not in _loaded:
+            _loaded[kind, path] = load(path)
+        return _loaded[kind, path]
+
+
+def prepare_model(clf):
+    """Make ``decision_function`` return raw one-vs-one values (predict is unaffected)."""
+    clf.decision_function_shape = "ovo"
+    return clf
+
+
+def load_model(path):
+    """The prepared SVM at ``path``, loaded once per process."""
+    return _load_once("model", path, lambda p: prepare_model(joblib.load(p)))
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def model_version(path):
+    """Short content hash of a model file, reported by /readyz."""
+    return _load_once("version", path, _hash_file)
+
+
+def _read_calibrator(path):
+    if not os.path.exists(path):
+        print(f"No calibrator at '{path}'; confidences will be uncalibrated.")
+        return None
+    return joblib.load(path)
+
+
+def load_calibrator(path=CALIBRATOR_PATH):
+    """The fitted calibrator, or None if ``model_trainer`` has not produced one."""
+    return _load_once("calibrator", path, _read_calibrator)
+
+
+def ovo_votes(dec, n_classes):
+    """libsvm voting: for pair (i, j) a positive value is a vote for i, otherwise for j."""
+    votes = np.zeros((dec.shape[0], n_classes), dtype=np.int32)
+    k = 0
+    for i in range(n_classes):
+        for j in range(i + 1, n_classes):
+            wins = dec[:, k] > 0
+            votes[:, i] += wins
+            votes[:, j] += ~wins
+            k += 1
+    return votes
+
+
+def _softmax(scores):
+    scores = scores - scores.max(axis=1, keepdims=True)
+    exp = np.exp(scores)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def classify(clf, x, calibrator=None, k=DEFAULT_TOP_K):
+    """
+    Classify a batch of 1x784 rows.  Returns one dict per row with the
+    predicted digit (the vote; ties go to the lower class, as in libsvm),
+    its confidence and the top ``k`` digits, the prediction first.  Without
+    a calibrator the confidences are a softmax over the vote counts.
+    """
+    n_classes = len(clf.classes_)
+    dec = clf.decision_function(x).reshape(x.shape[0], -1)
+    votes = ovo_votes(dec, n_classes)
+    if calibrator is not None:
+        proba = calibrator.predict_proba(dec)
+    else:
+        proba = _softmax(votes.astype(np.float64))
+
+    k = max(1, min(int(k), n_classes))
+    ranked = np.argsort(-proba, axis=1, kind="stable")
+    results = []
+    for row in range(x.shape[0]):
+        pred_idx = int(votes[row].argmax())
+        order = [pred_idx] + [int(i) for i in ranked[row] if i != pred_idx][:k - 1]
+        results.append({
+            "prediction": int(clf.classes_[pred_idx]),
+            "confidence": round(float(proba[row, pred_idx]), 4),
+            "top_k": [{"digit": int(clf.classes_[i]), "confidence": round(float(proba[row, i]), 4)}
+                      for i in order],
+            "calibrated": calibrator is not None,
+        })
+    return results
+
+
+def fit_calibrator(clf, x, y):
+    """Fit a multinomial logistic regression on held-out one-vs-one decision values."""
+    from sklearn.linear_model import LogisticRegression
+
+    prepare_model(clf)
+    calibrator = LogisticRegression(max_iter=1000)
+    calibrator.fit(clf.decision_function(x), y)
+    return calibrator
+
+
+class Batcher:
+    """
+    ``classify`` for many request threads through ``INFERENCE_THREADS``
+    worker threads.  A worker takes every request queued while it was busy
+    (up to ``BATCH_MAX_ROWS`` rows, optionally waiting ``BATCH_WAIT_MS``
+    for more) and classifies them in one call, so a lone request is not
+    delayed and a burst costs one model call instead of one per request.
+    """
+
+    def __init__(self, name, clf, calibrator=None, max_rows=BATCH_MAX_ROWS, wait=BATCH_WAIT,
+                 threads=INFERENCE_THREADS):
+        self.name = name
+        self.clf = clf
+        self.calibrator = calibrator
+        self.max_rows = max_rows
+        self.wait = wait
+        self.threads = threads
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_workers(self):
+        # Threads do not survive a fork: each serve.py worker starts its own.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    for i in range(self.threads):
+                        threading.Thread(target=self._run, args=(self._queue,), name=f"batcher-{self.name}-{i}",
+                                         daemon=True).start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def classify(self, x, k=DEFAULT_TOP_K):
+        """Same results as ``classify(clf, x, calibrator, k)``."""
+        if x.shape[0] == 0:
+            return []
+        k = max(1, min(int(k), len(self.clf.classes_)))  # as classify() clamps it
+        request = {"x": x, "k": k, "done": threading.Event()}
+        self._ensure_workers().put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["results"]
+
+    def _take(self, work):
+        requests = [work.get()]
+        rows = requests[0]["x"].shape[0]
+        give_up = time.monotonic() + self.wait
+        while rows < self.max_rows:
+            try:
+                remaining = give_up - time.monotonic()
+                request = work.get(timeout=remaining) if remaining > 0 else work.get_nowait()
+            except queue.Empty:
+                break
+            requests.append(request)
+            rows += request["x"].shape[0]
+        return requests, rows
+
+    def _run(self, work):
+        while True:
+            requests, rows = self._take(work)
+            metrics.INFERENCE_BATCH_ROWS.observe(rows, self.name)
+            try:
+                k = max(request["k"] for request in requests)
+                x = requests[0]["x"] if len(requests) == 1 else np.vstack([request["x"] for request in requests])
+                results = classify(self.clf, x, self.calibrator, k)
+            except Exception as e:
+                for request in requests:
+                    request["error"] = e
+                    request["done"].set()
+                continue
+            start = 0
+            for request in requests:
+                n = request["x"].shape[0]
+                request["results"] = [dict(result, top_k=result["top_k"][:request["k"]])
+                                      for result in results[start:start + n]]
+                start += n
+                request["done"].set()
+
+
+def shared_batcher(clf, calibrator=None):
+    """One Batcher per model object, shared by every app that classifies with it."""
+    with _load_lock:
+        key = ("batcher", id(clf))
+        if key not in _loaded:
+            _loaded[key] = Batcher("svm", clf, calibrator)
+        return _loaded[key]
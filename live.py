@@ -0,0 +1,216 @@
+"""
+live
+~~~~
+
+Live predictions while the user draws, over Server-Sent Events.
+
+The page opens ``GET /live`` (an ``EventSource``) and receives a session
+id.  While the pen moves it posts throttled canvas snapshots to
+``POST /live/<session>``; the stream answers with ``prediction`` events.
+
+Each connection has a single pending-frame slot: a new snapshot replaces
+one that has not been processed yet, so a fast pen never queues more
+than one inference per connection.  A frame is only re-predicted when
+its normalized 28x28 input has materially changed since the last
+prediction (mean absolute pixel difference above ``LIVE_CHANGE``).
+When the ``/predict`` slots are all taken, the preprocessed input is kept
+and retried after ``RETRY_SECONDS``, or dropped for a newer frame.
+
+Every open stream holds a server thread, so run the app threaded
+(``app.run()`` is, ``serve.py`` needs ``--threads``) or under ``asgi_app``.
+"""
+
+#### Libraries
+# Standard library
+import json
+import os
+import secrets
+import threading
+
+# Third-party libraries
+import numpy as np
+from flask import Response, jsonify, request, stream_with_context
+
+import metrics
+import preprocessing
+
+MAX_LIVE_SESSIONS = int(os.getenv("MAX_LIVE_SESSIONS", "64"))
+LIVE_CHANGE = float(os.getenv("LIVE_CHANGE", "0.01"))  # mean |delta| of 0-1 pixels
+HEARTBEAT_SECONDS = 15.0    # keep-alive comment; also how dead clients are noticed
+GATE_TIMEOUT = 0.5          # how long a live frame waits for a /predict slot
+RETRY_SECONDS = 0.5         # back-off before a shed input is tried again (unless a newer frame comes)
+
+
+def sse(event, payload):
+    """One Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+HEARTBEAT = ": keep-alive\n\n"
+
+
+class LiveSession:
+    """Per-connection state: the pending frame slot and the last predicted input."""
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.closed = False
+        self.last_url = None
+        self.last_x = None
+        self.deferred_x = None  # preprocessed input waiting for a /predict slot
+        self._pending = None
+        self._cond = threading.Condition()
+
+    def submit(self, data_url):
+        """Store the newest frame; returns True if it replaced an unprocessed one."""
+        with self._cond:
+            coalesced = self._pending is not None
+            self._pending = data_url
+            self._cond.notify()
+        return coalesced
+
+    def take(self, timeout):
+        """The pending frame, or None after ``timeout`` seconds or once closed."""
+        with self._cond:
+            if self._pending is None and not self.closed:
+                self._cond.wait(timeout)
+            data_url, self._pending = self._pending, None
+        return data_url
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+
+class LiveChannel:
+    """The live sessions of one app and the work done for each frame."""
+
+    def __init__(self, name, preprocess, predict, gate=None):
+        self.name = name
+        self.preprocess = preprocess
+        self.predict = predict
+        self.gate = gate
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def open(self):
+        """A new session, or None when MAX_LIVE_SESSIONS are already open."""
+        with self._lock:
+            if len(self.sessions) >= MAX_LIVE_SESSIONS:
+                return None
+            session = LiveSession(secrets.token_urlsafe(12))
+            self.sessions[session.id] = session
+        metrics.LIVE_SESSIONS.inc(self.name)
+        return session
+
+    def close(self, session):
+        session.close()
+        with self._lock:
+            if self.sessions.pop(session.id, None) is None:
+                return
+        metrics.LIVE_SESSIONS.dec(self.name)
+
+    def submit(self, session_id, data_url):
+        """Returns None for an unknown session, else whether the frame was coalesced."""
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        coalesced = session.submit(data_url)
+        metrics.LIVE_FRAMES.inc(self.name, "coalesced" if coalesced else "received")
+        return coalesced
+
+    def wait_seconds(self, session):
+        """How long to wait for a frame: until the retry of a shed input, else until the next heartbeat."""
+        return RETRY_SECONDS if session.deferred_x is not None else HEARTBEAT_SECONDS
+
+    def process(self, session, data_url):
+        """
+        Predict one frame, or retry the shed input when ``data_url`` is None.
+        Returns the event payload, or None if nothing changed or it was shed again.
+        """
+        if data_url is None:
+            if session.deferred_x is None:
+                return None
+            return self._predict(session, session.deferred_x)
+        if data_url == session.last_url:
+            metrics.LIVE_FRAMES.inc(self.name, "unchanged")
+            return None
+        try:
+            x = self.preprocess(data_url)
+        except preprocessing.PayloadError as e:
+            metrics.LIVE_FRAMES.inc(self.name, "error")
+            return {"error": str(e)}
+        session.last_url = data_url
+        session.deferred_x = None  # a newer frame replaces an input waiting for a slot
+        if session.last_x is not None and np.abs(x - session.last_x).mean() <= LIVE_CHANGE:
+            metrics.LIVE_FRAMES.inc(self.name, "unchanged")
+            return None
+        if not x.any():
+            session.last_x = x
+            return {"prediction": None}
+        return self._predict(session, x)
+
+    def _predict(self, session, x):
+        if self.gate is not None and self.gate.acquire(GATE_TIMEOUT) != "ok":
+            # /predict is saturated: keep the input and back off instead of redoing the preprocessing.
+            session.deferred_x = x
+            metrics.LIVE_FRAMES.inc(self.name, "shed")
+            return None
+        session.deferred_x = None
+        try:
+            with metrics.timed(metrics.STAGE_SECONDS, self.name, "predict"):
+                result = self.predict(x)
+        finally:
+            if self.gate is not None:
+                self.gate.release()
+        session.last_x = x
+        metrics.LIVE_FRAMES.inc(self.name, "predicted")
+        return result
+
+    def events(self, session):
+        """SSE messages for a session until it is closed (Flask streaming body)."""
+        try:
+            yield sse("ready", {"session": session.id})
+            while not session.closed:
+                data_url = session.take(self.wait_seconds(session))
+                if data_url is None and session.deferred_x is None:
+                    yield HEARTBEAT
+                    continue
+                event = self.process(session, data_url)
+                if event is not None:
+                    yield sse("prediction", event)
+                elif data_url is None:
+                    yield HEARTBEAT  # still shed; a write is how a dead client is noticed
+        finally:
+            self.close(session)
+
+
+def install(app, name, preprocess, predict, gate=None):
+    """
+    Add ``GET /live`` and ``POST /live/<session>`` to a Flask app.
+    ``predict(x)`` gets a 1x784 input and returns a JSON-able dict; the
+    optional admission ``gate`` is shared with the regular predict route.
+    """
+    channel = LiveChannel(name, preprocess, predict, gate)
+
+    @app.route("/live")
+    def live_stream():
+        session = channel.open()
+        if session is None:
+            return jsonify({"error": "Too many live sessions"}), 503, {"Retry-After": "5"}
+        headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return Response(stream_with_context(channel.events(session)), mimetype="text/event-stream",
+                        headers=headers)
+
+    @app.route("/live/<session_id>", methods=["POST"])
+    def live_frame(session_id):
+        data = request.get_json(silent=True)
+        if not data or "image" not in data:
+            return jsonify({"error": "No image provided"}), 400
+        coalesced = channel.submit(session_id, data["image"])
+        if coalesced is None:
+            return jsonify({"error": "Unknown live session"}), 404
+        return jsonify({"coalesced": coalesced}), 202
+
+    return channel
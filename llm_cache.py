@@ -0,0 +1,213 @@
+"""
+llm_cache
+~~~~~~~~~
+
+Cache for the games' Gemini responses, shared across players.
+
+A story context differs from game to game mostly in its numbers (the
+digit to draw, the level), so those are replaced by placeholders before
+the context is used as a key, and the same numbers in the response text
+are turned into placeholders too.  "Draw a 7 to reach level 3" is stored
+as "Draw a <<target_digit>> to reach level <<level>>" and served to any
+player whose context only differs in those values.  Numbers that the
+response introduces itself (``fresh`` fields, e.g. the next digit in
+the starship game) get a new random value each time a variant is reused.
+
+The key keeps which placeholders were equal (target 3 at level 3 is a
+different key from target 7 at level 3), so a reused text never swaps
+two numbers.  Numbers written out as words are left alone.
+
+Each key collects up to ``LLM_CACHE_VARIANTS`` different responses
+before it stops calling the LLM and picks one of them at random.  Keys
+live in an in-memory LRU of ``LLM_CACHE_SIZE`` entries backed by an
+SQLite file (``LLM_CACHE_PATH``, shared by ``serve.py`` workers and kept
+across restarts; empty for memory only).  ``LLM_CACHE=0`` turns caching
+off.  Hits and misses are counted in ``/metrics``.
+"""
+
+#### Libraries
+# Standard library
+import copy
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import metrics
+
+LLM_CACHE = os.getenv("LLM_CACHE", "1") != "0"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_VARIANTS = int(os.getenv("LLM_CACHE_VARIANTS", "3"))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+
+NUMBER = re.compile(r"(?<!\d)(?<!\d\.)\d+(?!\d)(?!\.\d)")  # whole numbers, not parts of decimals
+
+
+def _token(name):
+    return f"<<{name}>>"
+
+
+def _map_strings(value, fn):
+    """Apply ``fn`` to every string inside nested dicts/lists."""
+    if isinstance(value, str):
+        return fn(value)
+    if isinstance(value, dict):
+        return {k: _map_strings(v, fn) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_map_strings(v, fn) for v in value]
+    return value
+
+
+def _is_number(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class LLMCache:
+    """LRU of normalized key -> list of templated responses, persisted in SQLite."""
+
+    def __init__(self, name, path=LLM_CACHE_PATH, variants=LLM_CACHE_VARIANTS, capacity=LLM_CACHE_SIZE,
+                 enabled=LLM_CACHE):
+        self.name = name
+        self.path = path
+        self.variants = variants
+        self.capacity = capacity
+        self.enabled = enabled and variants > 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    # --- storage ---
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS llm_cache (app TEXT, key TEXT, variant INTEGER, value TEXT, "
+                       "PRIMARY KEY (app, key, variant))")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _load(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        stored = []
+        if self.path:
+            try:
+                rows = self._db().execute("SELECT value FROM llm_cache WHERE app = ? AND key = ? ORDER BY variant",
+                                          (self.name, key)).fetchall()
+                stored = [json.loads(row[0]) for row in rows]
+            except sqlite3.Error as e:
+                print(f"[{self.name}] LLM cache read failed: {e}")
+        return self._remember(key, stored)
+
+    def _remember(self, key, stored):
+        with self._lock:
+            stored = self._memory.setdefault(key, stored)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.capacity:
+                self._memory.popitem(last=False)
+        return stored
+
+    def _store(self, key, template):
+        stored = self._load(key)
+        with self._lock:
+            if len(stored) >= self.variants:
+                return
+            stored.append(template)
+            variant = len(stored) - 1
+        if self.path:
+            try:
+                with self._db() as db:
+                    db.execute("INSERT OR IGNORE INTO llm_cache VALUES (?, ?, ?, ?)",
+                               (self.name, key, variant, json.dumps(template)))
+            except sqlite3.Error as e:
+                print(f"[{self.name}] LLM cache write failed: {e}")
+
+    # --- templating ---
+    @staticmethod
+    def _placeholders(context, fields):
+        """value -> placeholder name for the numeric ``fields`` (first field wins on equal values)."""
+        names = {}
+        for field in fields:
+            if _is_number(context.get(field)):
+                names.setdefault(context[field], field)
+        return names
+
+    def _templatize(self, response, names, fresh, constants):
+        """The response with placeholders, or None if its numbers are ambiguous."""
+        names = dict(names)
+        template = copy.deepcopy(response)
+        if isinstance(template, dict):
+            for field in fresh:
+                if _is_number(template.get(field)):
+                    if template[field] in constants or template[field] in names:
+                        return None  # can't tell a coincidence from a reference
+                    names[template[field]] = field
+            for field, value in template.items():
+                if _is_number(value) and value in names:
+                    template[field] = _token(names[value])
+
+        def replace(text):
+            return NUMBER.sub(lambda m: _token(names[int(m.group())]) if int(m.group()) in names else m.group(), text)
+
+        return _map_strings(template, replace)
+
+    @staticmethod
+    def _fill(template, names, fresh):
+        values = {name: value for value, name in names.items()}
+        taken = set(values.values())
+        for field in fresh:
+            if field not in values:
+                choices = [d for d in range(10) if d not in taken] or list(range(10))
+                values[field] = random.choice(choices)
+                taken.add(values[field])
+        response = copy.deepcopy(template)
+        if isinstance(response, dict):
+            for key, value in response.items():
+                if isinstance(value, str) and value.startswith("<<") and value.endswith(">>") and value[2:-2] in values:
+                    response[key] = values[value[2:-2]]
+
+        def replace(text):
+            for name, value in values.items():
+                text = text.replace(_token(name), str(value))
+            return text
+
+        return _map_strings(response, replace)
+
+    # --- public ---
+    def get(self, kind, context, generate, fields=(), fresh=()):
+        """
+        A response for ``context``: a cached variant once ``variants`` have
+        been collected for its key, otherwise ``generate()`` (whose result is
+        stored).  ``fields`` are the numeric context keys to parameterize;
+        ``fresh`` are numeric response keys the LLM picks itself (a fresh
+        value equal to a context number is not cached).
+        Exceptions from ``generate`` propagate and nothing is cached.
+        """
+        if not self.enabled:
+            return generate()
+        names = self._placeholders(context, fields)
+        constants = {v for k, v in context.items() if k not in fields and _is_number(v)}
+        if constants & set(names):
+            # A fixed number equals a placeholder value: the text would be ambiguous.
+            metrics.LLM_CACHE.inc(self.name, "uncacheable")
+            return generate()
+
+        normalized = {k: _token(names[v]) if k in fields and _is_number(v) else v for k, v in context.items()}
+        key = kind + ":" + json.dumps(normalized, sort_keys=True)
+        stored = self._load(key)
+        if len(stored) >= self.variants:
+            metrics.LLM_CACHE.inc(self.name, "hit")
+            return self._fill(random.choice(stored), names, fresh)
+
+        metrics.LLM_CACHE.inc(self.name, "miss")
+        response = generate()
+        template = self._templatize(response, names, fresh, constants)
+        if template is not None:
+            self._store(key, template)
+        return response
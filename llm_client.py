@@ -0,0 +1,209 @@
+"""
+llm_client
+~~~~~~~~~~
+
+One wrapper around ``model.generate_content`` for all of the games, so a
+slow or failing Gemini API cannot hang the request threads.
+
+* Every attempt has a deadline (``LLM_TIMEOUT`` seconds).  The call runs
+  on its own daemon thread (at most ``LLM_THREADS`` at once) and the
+  caller stops waiting when the deadline passes, so an abandoned call
+  never holds up a request or the interpreter's exit; the whole call,
+  retries included, is also capped by ``LLM_DEADLINE`` and by the
+  request's admission deadline.
+* Failed attempts are retried up to ``LLM_RETRIES`` times with jittered
+  exponential backoff.  Requests Gemini rejects outright (bad key, bad
+  argument) are not retried.
+* After ``LLM_BREAKER_FAILURES`` consecutive failed calls the circuit
+  opens: calls fail at once with ``CircuitOpen`` and the games use their
+  local fallback text.  After ``LLM_BREAKER_COOLDOWN`` seconds a single
+  probe call is let through; if it succeeds the circuit closes again.
+
+Latency, timeouts, retries and the breaker state are exported in
+``/metrics``.
+
+``GEMINI_ENDPOINT`` (e.g. ``http://127.0.0.1:8081``) points the games at
+another Gemini-compatible server such as ``fake_gemini.py``.
+"""
+
+#### Libraries
+# Standard library
+import os
+import random
+import threading
+import time
+
+import admission
+import metrics
+
+try:
+    from google.api_core import exceptions as google_exceptions
+    NOT_RETRYABLE = (google_exceptions.InvalidArgument, google_exceptions.PermissionDenied,
+                     google_exceptions.Unauthenticated, google_exceptions.NotFound)
+except ImportError:
+    NOT_RETRYABLE = ()
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "8"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "20"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_THREADS = int(os.getenv("LLM_THREADS", "32"))
+GEMINI_ENDPOINT = os.getenv("GEMINI_ENDPOINT")
+BACKOFF_BASE = 0.25
+BACKOFF_MAX = 4.0
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2  # breaker states, as exported in the gauge
+
+
+def gemini_options():
+    """Extra ``google.generativeai.configure`` arguments: the REST transport to GEMINI_ENDPOINT if set."""
+    if not GEMINI_ENDPOINT:
+        return {}
+    return {"transport": "rest", "client_options": {"api_endpoint": GEMINI_ENDPOINT}}
+
+
+class LLMError(Exception):
+    """The LLM call did not produce a response."""
+
+
+class LLMTimeout(LLMError):
+    """An attempt ran past its deadline."""
+
+
+class CircuitOpen(LLMError):
+    """Too many recent failures; the LLM is not being called."""
+
+
+class CircuitBreaker:
+    def __init__(self, name, failures=LLM_BREAKER_FAILURES, cooldown=LLM_BREAKER_COOLDOWN):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        metrics.LLM_BREAKER.set(CLOSED, name)
+
+    def _set(self, state):
+        self.state = state
+        metrics.LLM_BREAKER.set(state, self.name)
+
+    def allow(self):
+        """True if a call may go ahead (always when closed; one probe when the cooldown is over)."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self._set(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self.consecutive = 0
+                if self.state != CLOSED:
+                    print(f"[{self.name}] LLM circuit closed")
+                self._set(CLOSED)
+                return
+            self.consecutive += 1
+            if self.state == HALF_OPEN or self.consecutive >= self.failures:
+                if self.state != OPEN:
+                    print(f"[{self.name}] LLM circuit open after {self.consecutive} failures")
+                self.opened_at = time.monotonic()
+                self._set(OPEN)
+
+
+class LLMClient:
+    """``generate_content`` with deadlines, retries and a circuit breaker."""
+
+    def __init__(self, name, model, timeout=LLM_TIMEOUT, deadline=LLM_DEADLINE, retries=LLM_RETRIES):
+        self.name = name
+        self.model = model
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.breaker = CircuitBreaker(name)
+        self._slots = None
+        self._pid = None
+
+    def __bool__(self):
+        return self.model is not None
+
+    def _thread_slots(self):
+        # A semaphore held across a fork would leak its slots; each serve.py worker makes its own.
+        if self._pid != os.getpid():
+            self._slots = threading.BoundedSemaphore(LLM_THREADS)
+            self._pid = os.getpid()
+        return self._slots
+
+    def _budget(self):
+        budget = self.deadline
+        request_deadline = admission.current_deadline()
+        if request_deadline is not None:
+            budget = min(budget, request_deadline.remaining())
+        return budget
+
+    def _attempt(self, timeout, args, kwargs):
+        start = time.perf_counter()
+        slots = self._thread_slots()
+        outcome = {}
+        done = threading.Event()
+
+        def call():
+            try:
+                outcome["response"] = self.model.generate_content(*args, **kwargs)
+            except Exception as e:
+                outcome["error"] = e
+            finally:
+                slots.release()
+                done.set()
+
+        try:
+            if not slots.acquire(timeout=timeout):
+                metrics.LLM_TIMEOUTS.inc(self.name)
+                raise LLMTimeout(f"All {LLM_THREADS} LLM threads busy for {timeout:.1f}s")
+            threading.Thread(target=call, name="llm-" + self.name, daemon=True).start()
+            if not done.wait(timeout - (time.perf_counter() - start)):
+                metrics.LLM_TIMEOUTS.inc(self.name)
+                raise LLMTimeout(f"Gemini did not answer within {timeout:.1f}s")
+        finally:
+            metrics.LLM_SECONDS.observe(time.perf_counter() - start, self.name)
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["response"].text
+
+    def generate(self, *args, **kwargs):
+        """The response text of ``model.generate_content(*args, **kwargs)``; raises LLMError subclasses or the API error."""
+        if self.model is None:
+            raise LLMError("No LLM configured")
+        budget = self._budget()
+        if budget <= 0:
+            raise LLMTimeout("No time left for the LLM call")
+        if not self.breaker.allow():
+            metrics.LLM_SHORT_CIRCUITED.inc(self.name)
+            raise CircuitOpen("LLM circuit is open")
+
+        give_up = time.monotonic() + budget
+        attempt = 0
+        while True:
+            try:
+                text = self._attempt(min(self.timeout, give_up - time.monotonic()), args, kwargs)
+                self.breaker.record(True)
+                return text
+            except Exception as e:
+                metrics.LLM_ERRORS.inc(self.name)
+                backoff = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                if (attempt >= self.retries or isinstance(e, NOT_RETRYABLE)
+                        or time.monotonic() + backoff >= give_up):
+                    self.breaker.record(False)
+                    raise
+            attempt += 1
+            metrics.LLM_RETRIES.inc(self.name)
+            time.sleep(backoff)
@@ -0,0 +1,281 @@
+"""
+Load test the digit apps with realistic canvas traffic.
+
+Payloads are MNIST test digits rendered as 280x280 canvas PNGs with
+random size, placement and brush width (see ``bench_preprocessing``),
+mixed with blank canvases and oversized images that the app must
+reject.  Requests are sent from ``--concurrency`` threads, either as
+fast as responses come back (closed loop) or on a fixed schedule of
+``--rate`` requests per second (open loop, latency measured from the
+scheduled send time so a slow server cannot hide its queueing).
+
+Each run is appended to ``loadtest_results.jsonl`` with the current git
+commit, so runs can be compared across commits with ``--compare``.
+
+    python number_recognizer_app.py &
+    python load_test.py number_recognizer --concurrency 8 --duration 30
+    python load_test.py spy_game --url http://127.0.0.1:5000 --rate 50
+    python load_test.py number_recognizer --compare
+"""
+
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+import numpy as np
+from PIL import Image
+
+from bench_preprocessing import synthesize_corpus
+
+RESULTS_PATH = "loadtest_results.jsonl"
+
+# Per app: an optional once-per-user setup request and the request under test.
+SCENARIOS = {
+    "number_recognizer": {"setup": None, "method": "POST", "path": "/predict"},
+    "game_for_kids": {"setup": ("POST", "/start_game", {"level": "beginner"}), "method": "POST", "path": "/predict"},
+    # The story games play an unreadable drawing as a blank one instead of refusing it.
+    "starship_calibrator": {"setup": ("GET", "/start_game", None), "method": "POST", "path": "/submit_drawing",
+                            "expected": {"oversized": {200}}},
+    "spy_game": {"setup": ("GET", "/start_game", None), "method": "POST", "path": "/submit_drawing",
+                 "expected": {"oversized": {200}}},
+}
+
+
+# --- PAYLOADS ---
+def data_url(png_bytes):
+    return "data:image/png;base64," + base64.b64encode(png_bytes).decode()
+
+
+def blank_canvas():
+    buf = io.BytesIO()
+    Image.new("RGBA", (280, 280), "white").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def oversized_image():
+    """A valid PNG larger than preprocessing.MAX_PNG_SIDE; must be refused with 400."""
+    buf = io.BytesIO()
+    Image.new("L", (5000, 200), 255).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def build_payloads(count, blank_fraction, oversized_fraction, seed=0):
+    """A shuffled list of (kind, JSON body bytes)."""
+    rng = np.random.default_rng(seed)
+    n_blank = int(round(count * blank_fraction))
+    n_oversized = int(round(count * oversized_fraction))
+    payloads = [("digit", data_url(png)) for png in synthesize_corpus(count - n_blank - n_oversized, seed)]
+    payloads += [("blank", data_url(blank_canvas()))] * n_blank
+    payloads += [("oversized", data_url(oversized_image()))] * n_oversized
+    order = rng.permutation(len(payloads))
+    return [(payloads[i][0], json.dumps({"image": payloads[i][1], "expected_answer": 0}).encode())
+            for i in order]
+
+
+EXPECTED_STATUS = {"digit": {200}, "blank": {200}, "oversized": {400, 413}}
+
+
+# --- DRIVER ---
+class Client:
+    """One keep-alive connection plus the cookies (game session, player) of one simulated player."""
+
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.prefix = parts.path.rstrip("/")  # e.g. /starship for an app mounted by multi_game
+        self.timeout = timeout
+        self.cookies = {}
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        """(status, response body) of one request."""
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, self.prefix + path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                payload = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                # The server closed a kept-alive connection; retry once on a fresh one.
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        for cookie in response.msg.get_all("Set-Cookie") or ():
+            name, _, value = cookie.split(";", 1)[0].partition("=")
+            self.cookies[name] = value
+        return response.status, payload
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run(args, payloads):
+    scenario = SCENARIOS[args.app]
+    lock = threading.Lock()
+    samples = []        # (kind, status or None, seconds) after warmup
+    counter = [0]
+    start = time.perf_counter() + 0.5  # let every thread finish its setup first
+    measure_from = start + args.warmup
+    stop = measure_from + args.duration
+
+    def worker():
+        client = Client(args.url, args.timeout)
+        if scenario["setup"]:
+            method, path, body = scenario["setup"]
+            try:
+                client.request(method, path, json.dumps(body).encode() if body is not None else None)
+            except OSError:
+                pass
+        while True:
+            with lock:
+                i = counter[0]
+                counter[0] += 1
+            if args.rate:
+                scheduled = start + i / args.rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+            if scheduled >= stop:
+                return
+            kind, body = payloads[i % len(payloads)]
+            try:
+                status = client.request(scenario["method"], scenario["path"], body)[0]
+            except OSError:
+                status = None
+            done = time.perf_counter()
+            if scheduled >= measure_from:
+                with lock:
+                    samples.append((kind, status, done - scheduled))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def summarize(samples, duration, expected):
+    latencies = sorted(seconds for kind, status, seconds in samples)
+    statuses, kinds = {}, {}
+    errors = 0
+    for kind, status, seconds in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        ok = status in expected[kind]
+        errors += not ok
+        per_kind = kinds.setdefault(kind, {"requests": 0, "errors": 0})
+        per_kind["requests"] += 1
+        per_kind["errors"] += not ok
+    ms = lambda value: None if value is None else round(value * 1e3, 2)
+    return {
+        "requests": len(samples),
+        "throughput": round(len(samples) / duration, 2),
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else None,
+        "status_counts": statuses,
+        "kinds": kinds,
+    }
+
+
+# --- RESULTS ---
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def print_summary(record):
+    print(f"{record['app']} @ {record['commit']}{'+dirty' if record['dirty'] else ''}: "
+          f"{record['requests']} requests, {record['throughput']} req/s, "
+          f"p50={record['p50_ms']}ms p95={record['p95_ms']}ms p99={record['p99_ms']}ms max={record['max_ms']}ms, "
+          f"errors={record['errors']} ({record['error_rate']})")
+    print(f"  status counts: {record['status_counts']}")
+
+
+def compare(path, app, last=10):
+    if not os.path.exists(path):
+        print(f"No results in {path}")
+        return
+    with open(path) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    runs = [run for run in runs if run["app"] == app][-last:]
+    print(f"{'time':<20} {'commit':<14} {'mode':<12} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err%':>6}")
+    for run in runs:
+        mode = f"rate={run['rate']}" if run["rate"] else f"conc={run['concurrency']}"
+        commit = (run["commit"] or "?") + ("+" if run["dirty"] else "")
+        print(f"{run['time'][:19]:<20} {commit:<14} {mode:<12} {run['throughput']:>8} {run['p50_ms']:>8} "
+              f"{run['p95_ms']:>8} {run['p99_ms']:>8} {100 * (run['error_rate'] or 0):>6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("app", choices=sorted(SCENARIOS))
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads (simulated players)")
+    parser.add_argument("--rate", type=float, default=0, help="requests/s on a fixed schedule (0: closed loop)")
+    parser.add_argument("--duration", type=float, default=20, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of traffic before measuring")
+    parser.add_argument("--timeout", type=float, default=30, help="per-request timeout in seconds")
+    parser.add_argument("--payloads", type=int, default=200, help="distinct canvases to cycle through")
+    parser.add_argument("--blank", type=float, default=0.05, help="fraction of blank canvases")
+    parser.add_argument("--oversized", type=float, default=0.02, help="fraction of oversized images")
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSONL file the run is appended to")
+    parser.add_argument("--no-save", action="store_true", help="do not record this run")
+    parser.add_argument("--compare", action="store_true", help="show recorded runs for this app and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.results, args.app)
+        return
+
+    payloads = build_payloads(args.payloads, args.blank, args.oversized)
+    samples = run(args, payloads)
+    commit, dirty = git_commit()
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "dirty": dirty,
+        "app": args.app,
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        "duration": args.duration,
+        **summarize(samples, args.duration, {**EXPECTED_STATUS, **SCENARIOS[args.app].get("expected", {})}),
+    }
+    print_summary(record)
+    if not args.no_save:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"Saved to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
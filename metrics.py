@@ -0,0 +1,285 @@
+"""
+metrics
+~~~~~~~
+
+Latency histograms, counters and gauges for the apps, exported in the
+Prometheus text format at ``/metrics``.
+
+Recording never takes a lock: every thread writes to its own shard of
+each metric, and a scrape adds the shards together.  Shards of threads
+that have exited are folded into a retired total so thread-per-request
+servers do not grow the shard list forever.
+"""
+
+#### Libraries
+# Standard library
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Third-party libraries
+from flask import Response, g, request
+
+REGISTRY = []
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FOLD_EVERY = 64  # fold dead threads' shards after this many new shards
+
+
+def _format_labels(labelnames, labels, extra=""):
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    """Base class: per-thread shards mapping a label tuple to a list of numbers."""
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = {}    # id(shard) -> (thread, shard)
+        self._retired = {}   # totals from threads that have exited
+        self._fold_lock = threading.Lock()
+        self._created = 0
+        REGISTRY.append(self)
+
+    def _width(self):
+        return 1
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            self._shards[id(shard)] = (threading.current_thread(), shard)
+            self._created += 1
+            if self._created % FOLD_EVERY == 0:
+                self._fold()
+        return shard
+
+    def _slot(self, labels):
+        shard = self._shard()
+        values = shard.get(labels)
+        if values is None:
+            values = shard[labels] = [0] * self._width()
+        return values
+
+    def _fold(self):
+        """Merge shards of dead threads into the retired totals."""
+        with self._fold_lock:
+            for key, (thread, shard) in list(self._shards.items()):
+                if thread.is_alive():
+                    continue
+                for labels, values in shard.items():
+                    total = self._retired.setdefault(labels, [0] * self._width())
+                    for i, value in enumerate(values):
+                        total[i] += value
+                del self._shards[key]
+
+    def collect(self):
+        """Sum of all shards: {labels: [values...]}."""
+        self._fold()
+        with self._fold_lock:
+            totals = {labels: list(values) for labels, values in self._retired.items()}
+            for _, shard in list(self._shards.values()):
+                for labels, values in list(shard.items()):
+                    total = totals.setdefault(labels, [0] * self._width())
+                    for i, value in enumerate(list(values)):
+                        total[i] += value
+        return totals
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labels, values in sorted(self.collect().items()):
+            lines.extend(self._render_values(labels, values))
+        return lines
+
+    def _render_values(self, labels, values):
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {values[0]}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._slot(labels)[0] += amount
+
+
+class Gauge(_Metric):
+    """Per-thread deltas for inc/dec; ``set`` records an absolute value."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._set_values = {}
+
+    def inc(self, *labels, amount=1):
+        self._slot(labels)[0] += amount
+
+    def dec(self, *labels, amount=1):
+        self._slot(labels)[0] -= amount
+
+    def set(self, value, *labels):
+        self._set_values[labels] = value
+
+    def get(self, *labels):
+        return self.collect().get(labels, [0])[0]
+
+    def observe(self, value, *labels):
+        self.set(value, *labels)
+
+    def collect(self):
+        totals = super().collect()
+        for labels, value in list(self._set_values.items()):
+            totals[labels] = [value]
+        return totals
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _width(self):
+        return len(self.buckets) + 2  # bucket counts, +Inf, sum
+
+    def observe(self, value, *labels):
+        values = self._slot(labels)
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def _render_values(self, labels, values):
+        lines, cumulative = [], 0
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, values[:-1]):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {values[-1]}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+@contextmanager
+def timed(metric, *labels):
+    """Observe the duration of the ``with`` block on a histogram or gauge."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(time.perf_counter() - start, *labels)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- APP METRICS ---
+REQUESTS = Counter("digit_requests_total", "HTTP requests by route and outcome.", ("app", "route", "outcome"))
+REQUEST_SECONDS = Histogram("digit_request_duration_seconds", "HTTP request latency.", ("app", "route"))
+IN_FLIGHT = Gauge("digit_requests_in_flight", "Requests currently being handled.", ("app",))
+STAGE_SECONDS = Histogram("digit_stage_duration_seconds",
+                          "Latency of preprocessing stages, prediction and response encoding.", ("app", "stage"))
+MODEL_LOAD_SECONDS = Gauge("digit_model_load_seconds", "Time taken to load the SVM model.", ("app",))
+LLM_SECONDS = Histogram("digit_llm_request_duration_seconds", "Gemini call latency per attempt.", ("app",))
+LLM_ERRORS = Counter("digit_llm_errors_total", "Gemini attempts that raised an error or timed out.", ("app",))
+LLM_TIMEOUTS = Counter("digit_llm_timeouts_total", "Gemini attempts abandoned at their deadline.", ("app",))
+LLM_RETRIES = Counter("digit_llm_retries_total", "Gemini attempts that were retries.", ("app",))
+LLM_SHORT_CIRCUITED = Counter("digit_llm_short_circuited_total",
+                              "Gemini calls skipped because the circuit breaker was open.", ("app",))
+LLM_BREAKER = Gauge("digit_llm_circuit_state", "Gemini circuit breaker: 0 closed, 1 half-open, 2 open.", ("app",))
+SHED = Counter("digit_requests_shed_total", "Requests rejected because the admission queue was full.",
+               ("app", "route"))
+EXPIRED = Counter("digit_requests_expired_total", "Requests abandoned after their deadline passed.",
+                  ("app", "route"))
+QUEUED = Gauge("digit_requests_queued", "Requests waiting for an admission slot.", ("app", "route"))
+LLM_CACHE = Counter("digit_llm_cache_requests_total", "LLM cache lookups (hit, miss, uncacheable).",
+                    ("app", "outcome"))
+PREFETCH = Counter("digit_story_prefetch_total",
+                   "Story segments served from the background prefetch (hit), template (not_ready) or generated inline (miss).",
+                   ("app", "outcome"))
+SHADOW_COMPARED = Counter("digit_shadow_compared_total", "Inputs classified by the shadow model, by agreement.",
+                          ("app", "outcome"))
+SHADOW_DROPPED = Counter("digit_shadow_dropped_total", "Inputs not shadowed because the queue was full.", ("app",))
+SHADOW_SECONDS = Histogram("digit_shadow_batch_duration_seconds", "Shadow model latency per batch.", ("app",))
+LIVE_SESSIONS = Gauge("digit_live_sessions", "Open live prediction streams.", ("app",))
+LIVE_FRAMES = Counter("digit_live_frames_total",
+                      "Live canvas frames by outcome (received, coalesced, unchanged, predicted, shed, error).",
+                      ("app", "outcome"))
+GAME_SESSIONS = Gauge("digit_game_sessions", "Game sessions in the store (all workers' when shared).", ("app",))
+SESSIONS_EVICTED = Counter("digit_game_sessions_evicted_total", "Game sessions evicted after going idle.", ("app",))
+INFERENCE_BATCH_ROWS = Histogram("digit_inference_batch_rows", "Rows classified per shared inference call.",
+                                 ("batcher",), buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+CHALLENGE_POOL = Gauge("digit_challenge_pool_size", "Ready challenges in the pool, per level.", ("app", "level"))
+CHALLENGES_SERVED = Counter("digit_challenges_served_total", "Challenges handed out, from the pool or the fallback.",
+                            ("app", "source"))
+PLAYER_ATTEMPTS = Counter("digit_player_attempts_total", "Drawings recorded in the player stats, by result.",
+                          ("app", "result"))
+PLAYER_STATS_FLUSH_ROWS = Histogram("digit_player_stats_flush_attempts", "Attempts written per player stats flush.",
+                                    ("app",), buckets=(1, 4, 16, 64, 256, 1024, 4096))
+PLAYER_STATS_PENDING = Gauge("digit_player_stats_pending", "Players with attempts not yet written.", ("app",))
+CONFUSIONS = Counter("digit_confusion_total", "Game drawings by digit asked for and digit the model read.",
+                     ("app", "asked", "read"))
+
+
+def stage_hook(pipeline_name, stage_name, seconds):
+    """Pipeline hook recording preprocessing stage latency."""
+    STAGE_SECONDS.observe(seconds, pipeline_name, stage_name)
+
+
+UNCOUNTED = "digit.uncounted"  # WSGI environ key of internal requests kept out of the request metrics
+
+
+def _outcome(status):
+    if status < 400:
+        return "success"
+    return "client_error" if status < 500 else "server_error"
+
+
+def record_request(name, route, status, seconds):
+    """Count one finished request (also used by ``asgi_app``'s native handlers)."""
+    if route != "/metrics":
+        REQUESTS.inc(name, route, _outcome(status))
+        REQUEST_SECONDS.observe(seconds, name, route)
+
+
+def install(app, name):
+    """
+    Record request metrics for a Flask app and serve them at /metrics.
+    Requests whose WSGI environ sets ``UNCOUNTED`` (the warmup) are not recorded.
+    """
+
+    @app.before_request
+    def _start_request():
+        if request.environ.get(UNCOUNTED):
+            return
+        g.metrics_start = time.perf_counter()
+        IN_FLIGHT.inc(name)
+
+    @app.after_request
+    def _record_request(response):
+        if "metrics_start" not in g:
+            return response
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        record_request(name, route, response.status_code, time.perf_counter() - g.metrics_start)
+        return response
+
+    @app.teardown_request
+    def _end_request(exc):
+        if "metrics_start" in g:
+            IN_FLIGHT.dec(name)
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    return app
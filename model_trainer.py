@@ -1,19 +1,24 @@
+import sys
 import joblib
 from sklearn import svm
 import mnist_loader  # assuming your custom loader
+import inference
 
 
 def svm_baseline():
     training_data, validation_data, test_data = mnist_loader.load_data()
-    
+
     # train
     clf = svm.SVC()
     clf.fit(training_data[0], training_data[1])
-    
+
     # save model
     joblib.dump(clf, "svm_mnist_model.pkl")
     print("Model saved to svm_mnist_model.pkl")
-    
+
+    # calibrate confidences on the held-out validation set
+    save_calibrator(clf, validation_data)
+
     # test
     predictions = [int(a) for a in clf.predict(test_data[0])]
     num_correct = sum(int(a == y) for a, y in zip(predictions, test_data[1]))
@@ -21,5 +26,22 @@ def svm_baseline():
     print("%s of %s values correct." % (num_correct, len(test_data[1])))
 
 
+def save_calibrator(clf, validation_data):
+    """Fit the confidence calibrator on one-vs-one decision values and save it."""
+    calibrator = inference.fit_calibrator(clf, validation_data[0], validation_data[1])
+    joblib.dump(calibrator, inference.CALIBRATOR_PATH)
+    print("Calibrator saved to %s" % inference.CALIBRATOR_PATH)
+
+
+def calibrate_existing():
+    """Add a calibrator to an already trained svm_mnist_model.pkl without retraining."""
+    training_data, validation_data, test_data = mnist_loader.load_data()
+    clf = joblib.load("svm_mnist_model.pkl")
+    save_calibrator(clf, validation_data)
+
+
 if __name__ == "__main__":
-    svm_baseline()
+    if sys.argv[1:] == ["calibrate"]:
+        calibrate_existing()
+    else:
+        svm_baseline()
@@ -0,0 +1,131 @@
+"""
+All four apps in one process, sharing one loaded model.
+
+The recognizer and the three games are mounted under their own URL
+prefixes.  They load the SVM and the calibrator through ``inference``,
+which loads each file once per process, and classify through one shared
+``inference.Batcher``, so four apps cost one copy of the model and one
+warm start.  ``/`` lists the apps, ``/metrics`` has every app's metrics
+and ``/games`` summarizes requests and latency per game.
+
+    python multi_game.py                               # development server on :5000
+    python serve.py multi_game --workers 4 --threads   # pre-fork, one model copy shared by the workers
+
+Live predictions need threads, as for the recognizer on its own.
+"""
+
+import importlib
+import os
+import time
+
+from flask import Flask, jsonify
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+
+import metrics
+import static_pages
+
+APP_NAME = "multi_game"
+
+# URL prefix -> (module, title)
+MOUNTS = {
+    "/recognizer": ("number_recognizer_app", "Handwritten Digit Recognizer"),
+    "/starship": ("starship_calibrator", "Starship Calibrator"),
+    "/spy": ("spy_game", "AI Containment Protocol"),
+    "/kids": ("game_for_kids", "Number Learning Adventure"),
+}
+
+start = time.perf_counter()
+games = {prefix: importlib.import_module(module) for prefix, (module, title) in MOUNTS.items()}
+print(f"Loaded {len(games)} apps sharing one model in {time.perf_counter() - start:.2f}s")
+
+hub = Flask("Digit Games")
+metrics.install(hub, APP_NAME)
+
+HTML_PAGE = """
+<!doctype html>
+<html>
+<head><meta charset="utf-8"><title>Digit Games</title>
+<style>body { font-family: sans-serif; max-width: 640px; margin: 40px auto; } li { margin: 8px 0; }</style>
+</head>
+<body>
+<h2>Digit Games</h2>
+<ul>
+{% for prefix, title in apps %}<li><a href="{{ prefix[1:] }}/">{{ title }}</a></li>
+{% endfor %}</ul>
+<p><a href="games">Per-game traffic</a> &middot; <a href="metrics">Metrics</a></p>
+</body>
+</html>
+"""
+
+INDEX_PAGE = static_pages.Page(hub, HTML_PAGE, apps=[(prefix, title) for prefix, (module, title) in MOUNTS.items()])
+
+
+@hub.route("/")
+def index():
+    return INDEX_PAGE.response()
+
+
+def _quantile(values, buckets, q):
+    """Upper bound of the histogram bucket holding quantile ``q`` (None without data)."""
+    counts = values[:-1]
+    total = sum(counts)
+    if not total:
+        return None
+    cumulative = 0
+    for i, count in enumerate(counts):
+        cumulative += count
+        if cumulative >= q * total:
+            return buckets[i] if i < len(buckets) else float("inf")
+
+
+@hub.route("/games")
+def per_game():
+    """Requests by outcome and latency per game, from this process's metrics."""
+    requests = metrics.REQUESTS.collect()
+    latency = metrics.REQUEST_SECONDS.collect()
+    buckets = metrics.REQUEST_SECONDS.buckets
+    summary = {}
+    for prefix, (module, title) in MOUNTS.items():
+        name = games[prefix].APP_NAME
+        outcomes = {}
+        for (app_name, route, outcome), (count,) in requests.items():
+            if app_name == name:
+                outcomes[outcome] = outcomes.get(outcome, 0) + count
+        merged = [0] * (len(buckets) + 2)
+        for (app_name, route), values in latency.items():
+            if app_name == name:
+                merged = [a + b for a, b in zip(merged, values)]
+        count = sum(merged[:-1])
+        summary[name] = {
+            "prefix": prefix,
+            "requests": sum(outcomes.values()),
+            "outcomes": outcomes,
+            "mean_seconds": round(merged[-1] / count, 4) if count else None,
+            "p50_seconds_le": _quantile(merged, buckets, 0.50),
+            "p95_seconds_le": _quantile(merged, buckets, 0.95),
+            "p99_seconds_le": _quantile(merged, buckets, 0.99),
+        }
+    return jsonify({"pid": os.getpid(), "games": summary})
+
+
+dispatcher = DispatcherMiddleware(hub, {prefix: game.app for prefix, game in games.items()})
+
+
+def app(environ, start_response):
+    """The pages fetch relative URLs, so an app's page must be served with a trailing slash."""
+    path = environ.get("PATH_INFO", "")
+    if path in MOUNTS:
+        location = environ.get("SCRIPT_NAME", "") + path + "/"
+        if environ.get("QUERY_STRING"):
+            location += "?" + environ["QUERY_STRING"]
+        start_response("308 Permanent Redirect", [("Location", location), ("Content-Length", "0")])
+        return [b""]
+    return dispatcher(environ, start_response)
+
+
+if __name__ == "__main__":
+    from werkzeug.serving import run_simple
+
+    games["/kids"].challenges_ready.start()
+    print("Serving all apps on http://127.0.0.1:5000")
+    run_simple("0.0.0.0", 5000, app, threaded=True)
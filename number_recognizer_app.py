@@ -1,15 +1,37 @@
-import base64
-import io
-import joblib
-import numpy as np
-from flask import Flask, request, jsonify, render_template_string
-from PIL import Image, ImageOps, ImageChops
+import os
+from flask import Flask, request, jsonify
+import admission
+import health
+import inference
+import live
+import metrics
+import preprocessing
+import shadow
+import static_pages
 
+APP_NAME = "number_recognizer"
 app = Flask("Handwritten Digit Recognizer")
+app.config["MAX_CONTENT_LENGTH"] = preprocessing.MAX_REQUEST_BYTES  # rejected with 413 before parsing
+metrics.install(app, APP_NAME)
 
 # Load the provided sklearn SVM model file (trained on 28x28 MNIST-style flattened images).
 MODEL_PATH = "svm_mnist_model.pkl"
-clf = joblib.load(MODEL_PATH)
+with metrics.timed(metrics.MODEL_LOAD_SECONDS, APP_NAME):
+    clf = inference.load_model(MODEL_PATH)
+calibrator = inference.load_calibrator()
+batcher = inference.shared_batcher(clf, calibrator)  # one inference worker for every app in the process
+MODEL_VERSION = inference.model_version(MODEL_PATH)
+shadow_model = shadow.install(app, APP_NAME, MODEL_VERSION)
+
+# Shared preprocessing pipeline: data URL -> 1x784 vector
+preprocess = preprocessing.build_pipeline(APP_NAME, data_url=True)
+preprocess.add_hook(metrics.stage_hook)
+preprocess.add_hook(admission.deadline_hook)
+
+# Multi-digit pipeline: data URL -> (boxes, n x 784 batch)
+preprocess_digits = preprocessing.build_pipeline(APP_NAME, data_url=True, stages=preprocessing.MULTI_DIGIT_STAGES)
+preprocess_digits.add_hook(metrics.stage_hook)
+preprocess_digits.add_hook(admission.deadline_hook)
 
 # HTML page served at /
 HTML_PAGE = """
@@ -30,7 +52,8 @@ HTML_PAGE = """
 <body>
   <h2>Draw a digit (0-9) and press Predict</h2>
   <div class="canvas-wrap">
-    <canvas id="canvas" width="280" height="280"></canvas>
+    <canvas id="canvas" width="560" height="280"></canvas>
+    <canvas id="overlay" width="560" height="280" style="position:absolute; left:0; top:0; pointer-events:none;"></canvas>
   </div>
   <div class="controls">
     <button id="clearBtn">Clear</button>
@@ -38,12 +61,15 @@ HTML_PAGE = """
     <label> Brush:
       <input id="brushSize" type="range" min="4" max="40" value="18">
     </label>
+    <label><input id="multiDigit" type="checkbox"> Several digits</label>
+    <label><input id="liveMode" type="checkbox"> Live</label>
   </div>
   <div id="result">Prediction: <span id="pred">—</span></div>
 
 <script>
 const canvas = document.getElementById('canvas');
 const ctx = canvas.getContext('2d');
+const overlay = document.getElementById('overlay').getContext('2d');
 let drawing = false;
 let lastX = 0, lastY = 0;
 ctx.lineJoin = ctx.lineCap = 'round';
@@ -73,13 +99,48 @@ canvas.addEventListener('pointermove', (e) => {
   lastX = x; lastY = y;
 });
 
-canvas.addEventListener('pointerup', () => drawing = false);
+canvas.addEventListener('pointerup', () => { drawing = false; sendLiveFrame(); });
 canvas.addEventListener('pointerleave', () => drawing = false);
 
+// live mode: stream predictions while drawing, at most one snapshot per LIVE_INTERVAL ms
+const LIVE_INTERVAL = 200;
+let liveSource = null, liveSession = null, liveTimer = null;
+
+function sendLiveFrame() {
+  if (!liveSession) return;
+  clearTimeout(liveTimer);
+  liveTimer = null;
+  fetch('live/' + liveSession, {
+    method: 'POST',
+    headers: {'Content-Type':'application/json'},
+    body: JSON.stringify({ image: canvas.toDataURL('image/png') })
+  });
+}
+
+canvas.addEventListener('pointermove', () => {
+  if (drawing && liveSession && liveTimer === null) liveTimer = setTimeout(sendLiveFrame, LIVE_INTERVAL);
+});
+
+document.getElementById('liveMode').addEventListener('change', (e) => {
+  if (liveSource) { liveSource.close(); liveSource = null; liveSession = null; }
+  if (!e.target.checked) return;
+  liveSource = new EventSource('live');
+  liveSource.addEventListener('ready', (ev) => { liveSession = JSON.parse(ev.data).session; sendLiveFrame(); });
+  liveSource.addEventListener('prediction', (ev) => {
+    const j = JSON.parse(ev.data);
+    if (j.error) return;
+    document.getElementById('pred').innerText = j.prediction === null ? '—'
+      : j.prediction + ' (' + Math.round(j.confidence * 100) + '% sure)';
+  });
+  liveSource.onerror = () => { liveSession = null; };
+});
+
 document.getElementById('clearBtn').addEventListener('click', () => {
   ctx.fillStyle = 'white';
   ctx.fillRect(0,0,canvas.width,canvas.height);
+  overlay.clearRect(0,0,canvas.width,canvas.height);
   document.getElementById('pred').innerText = '—';
+  sendLiveFrame();
 });
 
 document.getElementById('brushSize').addEventListener('input', (e) => {
@@ -89,7 +150,9 @@ document.getElementById('brushSize').addEventListener('input', (e) => {
 document.getElementById('predictBtn').addEventListener('click', async () => {
   const dataURL = canvas.toDataURL('image/png');
   // send to backend
-  const resp = await fetch('/predict', {
+  const multi = document.getElementById('multiDigit').checked;
+  overlay.clearRect(0,0,canvas.width,canvas.height);
+  const resp = await fetch(multi ? 'predict_digits' : 'predict', {
     method: 'POST',
     headers: {'Content-Type':'application/json'},
     body: JSON.stringify({ image: dataURL })
@@ -98,8 +161,13 @@ document.getElementById('predictBtn').addEventListener('click', async () => {
   if (j.error) {
     document.getElementById('pred').innerText = 'Error';
     alert(j.error);
+  } else if (multi) {
+    document.getElementById('pred').innerText = j.number || '—';
+    overlay.lineWidth = 2;
+    overlay.strokeStyle = 'red';
+    j.digits.forEach(d => overlay.strokeRect(d.box[0], d.box[1], d.box[2], d.box[3]));
   } else {
-    document.getElementById('pred').innerText = j.prediction;
+    document.getElementById('pred').innerText = j.prediction + ' (' + Math.round(j.confidence * 100) + '% sure)';
   }
 });
 </script>
@@ -108,98 +176,87 @@ document.getElementById('predictBtn').addEventListener('click', async () => {
 """
 
 
-def preprocess_image_from_bytes(img_bytes):
-    """
-    Convert raw PNG bytes (from user canvas) into a 1x784 numpy array
-    matching MNIST-style 28x28 flattened input the SVM expects.
-    Steps:
-      - Open image, convert to grayscale
-      - Invert (canvas has black strokes on white background -> invert to match MNIST white-on-black)
-      - Crop bounding box (tight crop around digit)
-      - Resize the digit to fit in a 20x20 box using high-quality LANCZOS (preserves detail)
-      - Paste into a 28x28 image centered
-      - Shift by center of mass to center the digit (MNIST-style)
-      - Normalize pixel values to 0.0-1.0 (float32)
-      - Flatten to shape (1, 784)
-    """
-    img = Image.open(io.BytesIO(img_bytes)).convert('L')  # grayscale
-    # Invert colors so strokes are white-on-black (MNIST)
-    img = ImageOps.invert(img)
-
-    # Crop to content
-    bbox = img.getbbox()
-    if bbox:
-        img = img.crop(bbox)
-
-    # If bbox is empty (blank canvas), produce blank 28x28
-    if img.size[0] == 0 or img.size[1] == 0:
-        blank = Image.new('L', (28,28), 0)
-        return np.array(blank, dtype=np.float32).reshape(1,-1) / 255.0
-
-    # Resize preserving aspect ratio so the largest dimension becomes 20 pixels
-    width, height = img.size
-    max_side = max(width, height)
-    new_width = int(round(width * 20.0 / max_side))
-    new_height = int(round(height * 20.0 / max_side))
-    img = img.resize((new_width, new_height), resample=Image.LANCZOS)
-
-    # Put into 28x28 image centered
-    new_img = Image.new('L', (28,28), 0)  # black background (because inverted)
-    upper_left = ((28 - new_width) // 2, (28 - new_height) // 2)
-    new_img.paste(img, upper_left)
-
-    # Shift center of mass to the center (MNIST centering trick)
-    arr = np.array(new_img, dtype=np.float32)
-    if arr.sum() > 0:
-        cy, cx = np.indices(arr.shape)
-        total = arr.sum()
-        x_center = (cx * arr).sum() / total
-        y_center = (cy * arr).sum() / total
-        # target center is (14,14)
-        shift_x = int(round(14 - x_center))
-        shift_y = int(round(14 - y_center))
-        new_img = ImageChops.offset(new_img, shift_x, shift_y)
-
-    arr = np.array(new_img, dtype=np.float32)
-    arr = arr / 255.0  # normalize to 0.0 - 1.0
-    flat = arr.reshape(1, -1)
-    return flat
+INDEX_PAGE = static_pages.Page(app, HTML_PAGE)
 
 
 @app.route("/")
 def index():
-    return render_template_string(HTML_PAGE)
+    return INDEX_PAGE.response()
 
 
 @app.route("/predict", methods=["POST"])
+@admission.limit(APP_NAME, "predict", concurrency=os.cpu_count() or 1, queue=32, timeout=10)
 def predict():
     data = request.get_json()
     if not data or "image" not in data:
         return jsonify({"error": "No image provided"}), 400
-    data_url = data["image"]
-    # data_url format: "data:image/png;base64,....."
-    if "," not in data_url:
-        return jsonify({"error": "Invalid image data"}), 400
-    header, b64 = data_url.split(",", 1)
     try:
-        img_bytes = base64.b64decode(b64)
-    except Exception as e:
-        return jsonify({"error": "Could not decode base64 image: " + str(e)}), 400
+        k = int(data.get("top_k", inference.DEFAULT_TOP_K))
+    except (TypeError, ValueError):
+        return jsonify({"error": "top_k must be an integer"}), 400
 
     # Preprocess to 1x784 vector
     try:
-        x = preprocess_image_from_bytes(img_bytes)
+        x = preprocess(data["image"])
+    except preprocessing.PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+    except admission.DeadlineExceeded:
+        raise
     except Exception as e:
         return jsonify({"error": "Preprocessing failed: " + str(e)}), 500
 
-    # Predict using loaded sklearn SVM model
+    # Predict with top-k calibrated confidences from one decision_function pass
     try:
-        pred = clf.predict(x)[0]
-        return jsonify({"prediction": int(pred)})
+        with metrics.timed(metrics.STAGE_SECONDS, APP_NAME, "predict"):
+            result = batcher.classify(x, k)[0]
+        shadow_model.submit(x, [result["prediction"]])
+        with metrics.timed(metrics.STAGE_SECONDS, APP_NAME, "encode"):
+            return jsonify(result)
     except Exception as e:
         return jsonify({"error": "Prediction failed: " + str(e)}), 500
 
 
+@app.route("/predict_digits", methods=["POST"])
+@admission.limit(APP_NAME, "predict_digits", concurrency=os.cpu_count() or 1, queue=32, timeout=10)
+def predict_digits():
+    """Read every digit on the canvas; all segments go through the model in one call."""
+    data = request.get_json()
+    if not data or "image" not in data:
+        return jsonify({"error": "No image provided"}), 400
+    try:
+        k = int(data.get("top_k", inference.DEFAULT_TOP_K))
+    except (TypeError, ValueError):
+        return jsonify({"error": "top_k must be an integer"}), 400
+
+    try:
+        boxes, x = preprocess_digits(data["image"])
+    except preprocessing.PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+    except admission.DeadlineExceeded:
+        raise
+    except Exception as e:
+        return jsonify({"error": "Preprocessing failed: " + str(e)}), 500
+
+    try:
+        with metrics.timed(metrics.STAGE_SECONDS, APP_NAME, "predict"):
+            results = batcher.classify(x, k) if len(boxes) else []
+        shadow_model.submit(x, [result["prediction"] for result in results])
+        with metrics.timed(metrics.STAGE_SECONDS, APP_NAME, "encode"):
+            digits = [dict(result, box=list(box)) for box, result in zip(boxes, results)]
+            return jsonify({"number": "".join(str(d["prediction"]) for d in digits), "digits": digits})
+    except Exception as e:
+        return jsonify({"error": "Prediction failed: " + str(e)}), 500
+
+
+live_channel = live.install(app, APP_NAME, preprocess,
+                            lambda x: batcher.classify(x)[0],
+                            gate=admission.GATES[(APP_NAME, "predict")])
+
+
+health.install(app, APP_NAME, lambda data_url: inference.classify(clf, preprocess(data_url), calibrator),
+               model_version=MODEL_VERSION)
+
+
 if __name__ == "__main__":
     print("Starting app on http://127.0.0.1:5000 — make sure 'svm_mnist_model.pkl' is in this folder.")
     app.run()
@@ -0,0 +1,206 @@
+"""
+Play whole game sessions against a running game app, end to end.
+
+Each simulated player starts a game, reads the digit the game asks for
+and "draws" it with an MNIST canvas of that digit (or, with probability
+``1 - --accuracy``, of another digit), until the game is won or lost.
+Latency is reported per step (start, submit) and per whole game, along
+with how the games ended.  Runs are appended to
+``playtest_results.jsonl`` with the current git commit.
+
+Without network access, run the games against ``fake_gemini.py``:
+
+    python fake_gemini.py --latency lognormal:0.8:0.4 &
+    GEMINI_ENDPOINT=http://127.0.0.1:8081 GEMINI_API_KEY=fake python serve.py spy_game --workers 2 --threads &
+    python play_games.py spy_game --games 40 --concurrency 8
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from bench_preprocessing import synthesize_corpus
+from load_test import Client, data_url, git_commit, percentile
+
+RESULTS_PATH = "playtest_results.jsonl"
+MAX_MOVES = 40  # a game still running after this many submissions is abandoned
+
+
+class GameError(Exception):
+    """A step answered with something other than 200."""
+
+
+class Player:
+    """One simulated player: a client, a canvas per digit, and the steps it timed."""
+
+    def __init__(self, url, timeout, canvases, accuracy, rng):
+        self.client = Client(url, timeout)
+        self.canvases = canvases
+        self.accuracy = accuracy
+        self.rng = rng
+        self.steps = []  # (step, status, seconds)
+
+    def step(self, name, method, path, body=None):
+        start = time.perf_counter()
+        status, payload = self.client.request(method, path, json.dumps(body).encode() if body is not None else None)
+        self.steps.append((name, status, time.perf_counter() - start))
+        if status != 200:
+            raise GameError(f"{name} answered {status}")
+        return json.loads(payload)
+
+    def draw(self, target):
+        digit = target
+        if target is None or self.rng.random() >= self.accuracy:
+            digit = self.rng.choice([d for d in range(10) if d != target])
+        return self.rng.choice(self.canvases[digit])
+
+
+# --- GAMES ---
+def play_starship(player, args):
+    state = player.step("start", "GET", "/start_game")
+    for _ in range(MAX_MOVES):
+        if state["game_state"] == "game_won":
+            return "won"
+        state = player.step("submit", "POST", "/submit_drawing", {"image": player.draw(state.get("target_digit"))})
+    return "abandoned"
+
+
+def play_spy(player, args):
+    state = player.step("start", "GET", "/start_game")
+    sequence, target = state["game_sequence"], state["target_digit"]
+    for _ in range(MAX_MOVES):
+        if state["game_state"] == "game_won":
+            return "won"
+        if state["game_state"] == "time_up":
+            return "lost"
+        state = player.step("submit", "POST", "/submit_drawing", {"image": player.draw(target)})
+        if 1 <= state.get("level", 0) <= len(sequence):
+            target = sequence[state["level"] - 1]
+    return "abandoned"
+
+
+def play_kids(player, args):
+    game = player.step("start", "POST", "/start_game", {"level": args.level})
+    correct = 0
+    for challenge in game["challenges"]:
+        result = player.step("submit", "POST", "/predict",
+                             {"image": player.draw(challenge["answer"]), "expected_answer": challenge["answer"]})
+        correct += result["correct"]
+    return "won" if correct == len(game["challenges"]) else "finished"
+
+
+GAMES = {"starship_calibrator": play_starship, "spy_game": play_spy, "game_for_kids": play_kids}
+
+
+# --- DRIVER ---
+def run(args, canvases):
+    lock = threading.Lock()
+    games = []   # (outcome, seconds, moves)
+    steps = []   # (step, status, seconds)
+    remaining = [args.games]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            player = Player(args.url, args.timeout, canvases, args.accuracy, rng)  # a new player per game
+            start = time.perf_counter()
+            try:
+                outcome = GAMES[args.app](player, args)
+            except (GameError, OSError, ValueError, KeyError) as e:
+                outcome = "error"
+                print(f"game failed: {e}")
+            with lock:
+                games.append((outcome, time.perf_counter() - start, sum(s[0] == "submit" for s in player.steps)))
+                steps.extend(player.steps)
+
+    threads = [threading.Thread(target=worker, args=(args.seed + i,), daemon=True) for i in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return games, steps, time.perf_counter() - start
+
+
+def latency_summary(seconds):
+    seconds = sorted(seconds)
+    ms = lambda value: None if value is None else round(value * 1e3, 1)
+    return {"count": len(seconds), "p50_ms": ms(percentile(seconds, 0.50)), "p95_ms": ms(percentile(seconds, 0.95)),
+            "p99_ms": ms(percentile(seconds, 0.99)), "max_ms": ms(seconds[-1] if seconds else None)}
+
+
+def summarize(games, steps, elapsed):
+    outcomes = {}
+    for outcome, seconds, moves in games:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    per_step = {}
+    for name in sorted({name for name, status, seconds in steps}):
+        per_step[name] = latency_summary([seconds for n, status, seconds in steps if n == name])
+        per_step[name]["errors"] = sum(n == name and status != 200 for n, status, seconds in steps)
+    return {
+        "games": len(games),
+        "games_per_s": round(len(games) / elapsed, 2) if elapsed else None,
+        "outcomes": outcomes,
+        "moves_per_game": round(sum(g[2] for g in games) / len(games), 2) if games else None,
+        "game": latency_summary([seconds for outcome, seconds, moves in games if outcome != "error"]),
+        "steps": per_step,
+    }
+
+
+def print_summary(record):
+    print(f"{record['app']} @ {record['commit']}{'+dirty' if record['dirty'] else ''}: {record['games']} games, "
+          f"{record['games_per_s']} games/s, {record['moves_per_game']} moves/game, outcomes {record['outcomes']}")
+    rows = [("whole game", record["game"])] + list(record["steps"].items())
+    print(f"  {'':<12} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'errors':>7}")
+    for name, row in rows:
+        print(f"  {name:<12} {row['count']:>6} {row['p50_ms']!s:>9} {row['p95_ms']!s:>9} {row['p99_ms']!s:>9} "
+              f"{row['max_ms']!s:>9} {row.get('errors', ''):>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("app", choices=sorted(GAMES))
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--games", type=int, default=20, help="games to play in total")
+    parser.add_argument("--concurrency", type=int, default=4, help="players playing at the same time")
+    parser.add_argument("--accuracy", type=float, default=0.85, help="chance the player draws the requested digit")
+    parser.add_argument("--level", default="beginner", help="game_for_kids level")
+    parser.add_argument("--timeout", type=float, default=60, help="per-request timeout in seconds")
+    parser.add_argument("--canvases", type=int, default=300, help="distinct MNIST canvases to draw from")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSONL file the run is appended to")
+    parser.add_argument("--no-save", action="store_true", help="do not record this run")
+    args = parser.parse_args()
+
+    canvases = {digit: [] for digit in range(10)}
+    for png, digit in synthesize_corpus(args.canvases, args.seed, labels=True):
+        canvases[digit].append(data_url(png))
+
+    games, steps, elapsed = run(args, canvases)
+    commit, dirty = git_commit()
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "dirty": dirty,
+        "app": args.app,
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "accuracy": args.accuracy,
+        **summarize(games, steps, elapsed),
+    }
+    print_summary(record)
+    if not args.no_save:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"Saved to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
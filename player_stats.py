@@ -0,0 +1,363 @@
+"""
+player_stats
+~~~~~~~~~~~~
+
+Durable per-player progress and a leaderboard for the games.
+
+A player is identified by a long-lived ``player`` cookie, so progress
+outlives a game session.  For every drawing a game calls
+``record(player, digit, correct, seconds)``, which only adds to an
+in-memory tally.  A background thread writes the tallies every
+``STATS_FLUSH_SECONDS`` (or as soon as ``STATS_BATCH`` attempts are
+waiting), in one transaction, as increments to running totals: attempts,
+correct answers and response time per player and per digit, the current
+and best streak of correct answers.  Nothing is kept per attempt, so the
+store grows with the number of players, not with the history.
+
+Reads never scan: ``progress`` is two primary-key lookups plus the
+tallies this process has not written yet, and ``leaderboard`` walks the
+first rows of an index ordered by correct answers.  ``progress`` does
+not wait for a flush: it copies the unwritten tallies, reads SQLite,
+and reads again if a flush committed in between.  ``STATS_DB`` is one
+SQLite file (WAL mode) shared by all ``serve.py`` workers; a worker's
+attempts show up in the other workers' reads after its next flush.
+
+Tallies are also written at exit, and ``serve.py`` workers run the exit
+handlers before they stop.  A process that is killed (SIGKILL, a crash)
+loses what it has not flushed yet: at most ``STATS_FLUSH_SECONDS`` of
+attempts, or ``STATS_BATCH`` of them.
+"""
+
+#### Libraries
+# Standard library
+import atexit
+import hashlib
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+# Third-party libraries
+from flask import g, jsonify, request
+
+import game_sessions
+import metrics
+
+STATS_DB = os.getenv("STATS_DB", "player_stats.sqlite3")
+STATS_FLUSH_SECONDS = float(os.getenv("STATS_FLUSH_SECONDS", "1.0"))
+STATS_BATCH = 500  # pending attempts that trigger a flush before the interval is up
+LEADERBOARD_SIZE = 10
+MAX_LEADERBOARD_SIZE = 100
+MAX_RESPONSE_SECONDS = 300.0  # a longer gap is a break, not a response time
+PROGRESS_RETRIES = 3  # reads raced by a flush before progress waits for it
+PLAYER_COOKIE = "player"
+PLAYER_COOKIE_AGE = 365 * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (app TEXT, player TEXT, attempts INTEGER, correct INTEGER, seconds REAL,
+                                    timed INTEGER, streak INTEGER, best_streak INTEGER, updated REAL,
+                                    PRIMARY KEY (app, player));
+CREATE INDEX IF NOT EXISTS players_rank ON players (app, correct DESC, attempts);
+CREATE TABLE IF NOT EXISTS player_digits (app TEXT, player TEXT, digit INTEGER, attempts INTEGER, correct INTEGER,
+                                          seconds REAL, timed INTEGER, PRIMARY KEY (app, player, digit));
+"""
+
+# Running totals are incremented in place.  For the streaks, a tally that saw a
+# miss replaces the current streak with its own trailing run; one without adds to it.
+UPSERT_PLAYER = """
+INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (app, player) DO UPDATE SET
+    attempts = attempts + excluded.attempts, correct = correct + excluded.correct,
+    seconds = seconds + excluded.seconds, timed = timed + excluded.timed,
+    best_streak = MAX(best_streak, excluded.best_streak, streak + ?),
+    streak = CASE WHEN ? THEN excluded.streak ELSE streak + excluded.streak END,
+    updated = excluded.updated
+"""
+UPSERT_DIGIT = """
+INSERT INTO player_digits VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (app, player, digit) DO UPDATE SET
+    attempts = attempts + excluded.attempts, correct = correct + excluded.correct,
+    seconds = seconds + excluded.seconds, timed = timed + excluded.timed
+"""
+
+
+def player_tag(player):
+    """A short public name for a player; the cookie value itself stays private."""
+    return hashlib.blake2s(player.encode(), digest_size=4).hexdigest()
+
+
+def player_from_cookie_header(header):
+    """The player id in a raw Cookie header, or None."""
+    return game_sessions.id_from_cookie_header(header, PLAYER_COOKIE)
+
+
+def new_id():
+    return secrets.token_urlsafe(16)
+
+
+def set_cookie_header(player):
+    """Value of a Set-Cookie header for a new player."""
+    return f"{PLAYER_COOKIE}={player}; Path=/; Max-Age={PLAYER_COOKIE_AGE}; HttpOnly; SameSite=Lax"
+
+
+class Tally:
+    """Totals over a run of attempts, mergeable in order with ``extend``."""
+
+    def __init__(self):
+        self.attempts = self.correct = self.timed = 0
+        self.seconds = 0.0
+        self.lead = 0      # correct answers before the first miss
+        self.run = 0       # correct answers since the last miss: the current streak
+        self.best = 0      # longest streak inside the run
+        self.missed = False
+        self.digits = {}   # digit -> [attempts, correct, seconds, timed]
+
+    def add(self, digit, correct, seconds):
+        self.attempts += 1
+        counts = self.digits.setdefault(digit, [0, 0, 0.0, 0])
+        counts[0] += 1
+        if seconds is not None:
+            self.seconds += seconds
+            self.timed += 1
+            counts[2] += seconds
+            counts[3] += 1
+        if correct:
+            self.correct += 1
+            counts[1] += 1
+            self.run += 1
+            self.best = max(self.best, self.run)
+            if not self.missed:
+                self.lead += 1
+        else:
+            self.missed = True
+            self.run = 0
+
+    def extend(self, later):
+        """Append the attempts of ``later``, which came after these."""
+        self.attempts += later.attempts
+        self.correct += later.correct
+        self.seconds += later.seconds
+        self.timed += later.timed
+        self.best = max(self.best, later.best, self.run + later.lead)
+        if not self.missed:
+            self.lead += later.lead
+        self.run = later.run if later.missed else self.run + later.run
+        self.missed = self.missed or later.missed
+        for digit, counts in later.digits.items():
+            mine = self.digits.setdefault(digit, [0, 0, 0.0, 0])
+            for i, value in enumerate(counts):
+                mine[i] += value
+
+
+def _rates(attempts, correct, seconds, timed):
+    return {
+        "attempts": attempts,
+        "correct": correct,
+        "accuracy": round(correct / attempts, 3) if attempts else None,
+        "mean_seconds": round(seconds / timed, 2) if timed else None,
+    }
+
+
+class PlayerStats:
+    """Per-player running totals in SQLite, written in batches by a background thread."""
+
+    def __init__(self, name, path=STATS_DB, flush_every=STATS_FLUSH_SECONDS):
+        self.name = name
+        self.path = path
+        self.flush_every = flush_every
+        self._pending = {}    # player -> Tally not yet handed to the writer
+        self._flushing = {}   # player -> Tally being written
+        self._pending_attempts = 0
+        self._generation = 0  # odd while a flush commits; bumped again once it is out of _flushing
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._pid = None
+        atexit.register(self.flush)
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _ensure_writer(self):
+        # Threads do not survive a fork: each serve.py worker starts its own.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid == os.getpid():
+                    return
+                self._pid = os.getpid()
+                self._wake = threading.Event()
+                threading.Thread(target=self._run, name="player-stats-" + self.name, daemon=True).start()
+
+    # --- Writes ---
+    def record(self, player, digit, correct, seconds=None):
+        """Count one drawing of ``digit``; returns at once, the write happens in the background."""
+        if player is None or digit is None:
+            return
+        if seconds is not None and not 0 <= seconds <= MAX_RESPONSE_SECONDS:
+            seconds = None
+        self._ensure_writer()
+        with self._lock:
+            tally = self._pending.get(player)
+            if tally is None:
+                tally = self._pending[player] = Tally()
+            tally.add(int(digit), bool(correct), seconds)
+            self._pending_attempts += 1
+            waiting, players = self._pending_attempts, len(self._pending)
+        metrics.PLAYER_ATTEMPTS.inc(self.name, "correct" if correct else "wrong")
+        metrics.PLAYER_STATS_PENDING.set(players, self.name)
+        if waiting >= STATS_BATCH:
+            self._wake.set()
+
+    def flush(self):
+        """Write everything recorded so far in one transaction."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+                attempts, self._pending_attempts = self._pending_attempts, 0
+            metrics.PLAYER_STATS_PENDING.set(0, self.name)
+            try:
+                self._write(self._flushing)
+                metrics.PLAYER_STATS_FLUSH_ROWS.observe(attempts, self.name)
+            except sqlite3.Error as e:
+                print(f"[{self.name}] writing player stats failed, will retry: {e}")
+                with self._lock:
+                    # Put the tallies back in front of whatever arrived meanwhile
+                    for player, later in self._pending.items():
+                        earlier = self._flushing.get(player)
+                        if earlier is None:
+                            self._flushing[player] = later
+                        else:
+                            earlier.extend(later)
+                    self._pending, self._pending_attempts = self._flushing, self._pending_attempts + attempts
+                    self._flushing = {}
+            finally:
+                with self._lock:
+                    self._flushing = {}
+                    self._generation += 2 - self._generation % 2  # even again, and changed
+
+    def _write(self, tallies):
+        now = time.time()
+        players, digits = [], []
+        for player, t in tallies.items():
+            players.append((self.name, player, t.attempts, t.correct, t.seconds, t.timed, t.run, t.best, now,
+                            t.lead, t.missed))
+            digits.extend((self.name, player, digit, *counts) for digit, counts in t.digits.items())
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(UPSERT_PLAYER, players)
+            db.executemany(UPSERT_DIGIT, digits)
+            with self._lock:
+                self._generation += 1  # progress can't tell which side of the commit it read
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _run(self):
+        wake = self._wake
+        while True:
+            wake.wait(self.flush_every)
+            wake.clear()
+            self.flush()
+
+    # --- Reads ---
+    def progress(self, player):
+        """A player's totals, streaks and per-digit accuracy, including attempts not yet written."""
+        for _ in range(PROGRESS_RETRIES):
+            generation, unwritten = self._unwritten(player)
+            if generation % 2 == 0:
+                tally = self._stored(player)
+                with self._lock:
+                    unchanged = self._generation == generation  # no flush landed while we read
+                if unchanged:
+                    return self._report(player, tally, unwritten)
+        with self._flush_lock:  # a flush is either fully in the tables or still in _flushing
+            generation, unwritten = self._unwritten(player)
+            return self._report(player, self._stored(player), unwritten)
+
+    def _unwritten(self, player):
+        """(flush generation, a copy of the player's tallies not in the tables yet)."""
+        unwritten = Tally()
+        with self._lock:
+            for later in (self._flushing.get(player), self._pending.get(player)):
+                if later is not None:
+                    unwritten.extend(later)
+            return self._generation, unwritten
+
+    def _stored(self, player):
+        db = self._db()
+        row = db.execute("SELECT attempts, correct, seconds, timed, streak, best_streak FROM players "
+                         "WHERE app = ? AND player = ?", (self.name, player)).fetchone()
+        tally = Tally()
+        if row is not None:
+            tally.attempts, tally.correct, tally.seconds, tally.timed, tally.run, tally.best = row
+            tally.missed = True
+            for digit, *counts in db.execute("SELECT digit, attempts, correct, seconds, timed FROM player_digits "
+                                             "WHERE app = ? AND player = ?", (self.name, player)):
+                tally.digits[digit] = counts
+        return tally
+
+    @staticmethod
+    def _report(player, tally, unwritten):
+        tally.extend(unwritten)
+        return {
+            "player": player_tag(player),
+            **_rates(tally.attempts, tally.correct, tally.seconds, tally.timed),
+            "streak": tally.run,
+            "best_streak": tally.best,
+            "digits": {str(digit): _rates(*tally.digits[digit]) for digit in sorted(tally.digits)},
+        }
+
+    def leaderboard(self, size=LEADERBOARD_SIZE):
+        """The ``size`` players with the most correct answers (fewer attempts breaks ties)."""
+        rows = self._db().execute(
+            "SELECT player, attempts, correct, best_streak FROM players WHERE app = ? "
+            "ORDER BY correct DESC, attempts LIMIT ?", (self.name, size)).fetchall()
+        return [{"rank": rank, "player": player_tag(player), "correct": correct, "attempts": attempts,
+                 "accuracy": round(correct / attempts, 3) if attempts else None, "best_streak": best_streak}
+                for rank, (player, attempts, correct, best_streak) in enumerate(rows, 1)]
+
+    # --- Flask ---
+    def current_player(self):
+        """The player id of the current Flask request; a new one is set as a cookie on the response."""
+        player = player_from_cookie_header(request.headers.get("Cookie"))
+        if player is None:
+            player = g.get("new_player")
+            if player is None:
+                player = g.new_player = new_id()
+        return player
+
+
+def install(app, name, **kwargs):
+    """Add the player cookie, ``/progress`` and ``/leaderboard`` to a Flask app; returns the PlayerStats."""
+    stats = PlayerStats(name, **kwargs)
+
+    @app.after_request
+    def set_player_cookie(response):
+        player = g.get("new_player")
+        if player is not None:
+            response.headers.add("Set-Cookie", set_cookie_header(player))
+        return response
+
+    @app.route("/progress")
+    def progress():
+        return jsonify(stats.progress(stats.current_player()))
+
+    @app.route("/leaderboard")
+    def leaderboard():
+        size = min(request.args.get("size", LEADERBOARD_SIZE, type=int), MAX_LEADERBOARD_SIZE)
+        return jsonify({"leaderboard": stats.leaderboard(max(size, 1))})
+
+    return stats
@@ -0,0 +1,395 @@
+"""
+preprocessing
+~~~~~~~~~~~~~
+
+Turns a canvas drawing (black strokes on a white background) into the
+1x784 MNIST-style vector the SVM expects.  The PNG is decoded once into
+a NumPy array and every later step (crop, resize, centering, center of
+mass shift) works on that array, so no intermediate PIL images are made.
+
+For a canvas with several digits, ``segment_digits`` splits the strokes
+into connected components (grouping pieces that sit above each other,
+like the two strokes of a 4) and ``batch_segments`` normalizes every
+segment the same way, stacking them into one (n, 784) batch.
+
+Every app builds a ``Pipeline`` from these stages.  A pipeline times each
+stage and passes the timings to its hooks, so profiling and optimizations
+land in one place for all of the apps.
+"""
+
+#### Libraries
+# Standard library
+import base64
+import binascii
+import io
+import os
+import struct
+import threading
+import time
+from functools import lru_cache
+
+# Third-party libraries
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+FRAME_SIZE = 28   # MNIST images are 28x28
+BOX_SIZE = 20     # the digit is scaled to fit a 20x20 box inside the frame
+
+# Payload limits.  The canvas is 280x280, which encodes to a few tens of KB.
+MAX_REQUEST_BYTES = 2 * 1024 * 1024      # whole request body (Flask MAX_CONTENT_LENGTH)
+MAX_BASE64_CHARS = 1536 * 1024           # base64 part of the data URL
+MAX_IMAGE_SIDE = 4096                    # larger images are rejected before decoding
+MAX_PNG_SIDE = 1120                      # PNGs have no reduced-resolution decode: twice the widest canvas
+DECODE_MAX_SIDE = 560                    # larger images are decoded at reduced resolution
+MAX_DIGITS = 16                          # more segments than this is not a number
+MIN_SEGMENT_PIXELS = 12                  # smaller specks are dropped as noise
+SEGMENT_OVERLAP = 0.5                    # pieces overlapping this much horizontally are one digit
+FRAGMENT_FRACTION = 0.15                 # pieces smaller than this share of the largest join a neighbour
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_SIDE * MAX_IMAGE_SIDE
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+_buffers = threading.local()
+
+
+class PayloadError(ValueError):
+    """The client sent something that is not a usable image."""
+
+
+def decode_data_url(data_url):
+    """Strip the ``data:image/png;base64,`` header and decode the base64 payload."""
+    if not isinstance(data_url, str) or "," not in data_url:
+        raise PayloadError("Invalid image data")
+    header, b64 = data_url.split(",", 1)
+    if len(b64) > MAX_BASE64_CHARS:
+        raise PayloadError("Image data too large")
+    try:
+        return base64.b64decode(b64)
+    except (binascii.Error, ValueError) as e:
+        raise PayloadError("Could not decode base64 image: " + str(e))
+
+
+def sniff_dimensions(img_bytes):
+    """
+    Read (format, width, height) from a PNG or JPEG header without
+    decoding any pixels.  Raises PayloadError for anything else.
+    """
+    if img_bytes[:8] == PNG_SIGNATURE and img_bytes[12:16] == b"IHDR" and len(img_bytes) >= 24:
+        width, height = struct.unpack(">II", img_bytes[16:24])
+        return "PNG", width, height
+    if img_bytes[:2] == b"\xff\xd8":
+        pos = 2
+        while pos + 9 <= len(img_bytes):
+            if img_bytes[pos] != 0xFF:
+                break
+            marker = img_bytes[pos + 1]
+            if marker == 0xFF:  # fill byte
+                pos += 1
+                continue
+            if marker in JPEG_SOF_MARKERS:
+                height, width = struct.unpack(">HH", img_bytes[pos + 5:pos + 9])
+                return "JPEG", width, height
+            (length,) = struct.unpack(">H", img_bytes[pos + 2:pos + 4])
+            pos += 2 + length
+    raise PayloadError("Unsupported or corrupt image (expected PNG or JPEG)")
+
+
+def validate(img_bytes):
+    """
+    Reject non-images and oversized images from their header alone.  A PNG
+    is always decoded at full size, so it may be at most MAX_PNG_SIDE per
+    side; a JPEG, decoded at reduced resolution, up to MAX_IMAGE_SIDE.
+    """
+    fmt, width, height = sniff_dimensions(img_bytes)
+    max_side = MAX_PNG_SIDE if fmt == "PNG" else MAX_IMAGE_SIDE
+    if width == 0 or height == 0 or width > max_side or height > max_side:
+        raise PayloadError(f"Image dimensions {width}x{height} not allowed for {fmt} (at most {max_side} per side)")
+    return img_bytes
+
+
+def decode(img_bytes):
+    """
+    Decode PNG/JPEG bytes into a 2D uint8 grayscale array.  Images larger
+    than DECODE_MAX_SIDE are downscaled by an integer factor: JPEGs are
+    decoded at reduced resolution directly (``draft``); PNGs, which
+    ``validate`` caps at MAX_PNG_SIDE, are decoded at full size and then
+    ``reduce``d.  PIL decodes lazily, so a truncated or corrupt file fails in
+    here too, as PayloadError.
+    """
+    try:
+        img = Image.open(io.BytesIO(img_bytes))
+        factor = -(-max(img.size) // DECODE_MAX_SIDE)  # ceiling division
+        if factor > 1 and img.format == "JPEG":
+            img.draft('L', (img.size[0] // factor, img.size[1] // factor))
+        if img.mode != 'L':
+            img = img.convert('L')
+        if max(img.size) > DECODE_MAX_SIDE:
+            img = img.reduce(-(-max(img.size) // DECODE_MAX_SIDE))
+        return np.asarray(img, dtype=np.uint8)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        raise PayloadError("Could not decode image: " + str(e))
+
+
+def crop_to_content(gray):
+    """
+    Crop a white-background grayscale array to the bounding box of the
+    strokes and invert it, returning float32 white-on-black pixels.
+    Returns None for a blank canvas.
+    """
+    mask = gray != 255
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask[rows[0]:rows[-1] + 1].any(axis=0))
+    crop = gray[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    return 255.0 - crop.astype(np.float32)
+
+
+@lru_cache(maxsize=1024)
+def _area_weights(src, dst):
+    """
+    (dst, src) matrix whose rows average the input pixels each output
+    pixel covers, weighted by the overlapping fraction of every pixel.
+    """
+    scale = src / dst
+    edges = np.arange(dst + 1, dtype=np.float64) * scale
+    lo, hi = edges[:-1, None], edges[1:, None]
+    px = np.arange(src, dtype=np.float64)[None, :]
+    overlap = np.clip(np.minimum(hi, px + 1) - np.maximum(lo, px), 0.0, None)
+    weights = (overlap / scale).astype(np.float32)
+    weights.setflags(write=False)
+    return weights
+
+
+def resize_to_box(crop, box=BOX_SIZE):
+    """
+    Area-averaged resize of a cropped digit so its longest side becomes
+    ``box`` pixels, preserving the aspect ratio.
+    """
+    height, width = crop.shape
+    max_side = max(width, height)
+    new_width = max(1, int(round(width * float(box) / max_side)))
+    new_height = max(1, int(round(height * float(box) / max_side)))
+    return _area_weights(height, new_height) @ crop @ _area_weights(width, new_width).T
+
+
+def center_in_frame(patch, size=FRAME_SIZE):
+    """
+    Place the resized digit in a ``size`` x ``size`` black frame so that
+    its center of mass lands on the frame center (MNIST centering trick).
+    The digit is first centered by its bounding box and then shifted by
+    whole pixels, wrapping around the edges like ``ImageChops.offset``.
+    """
+    frame = getattr(_buffers, 'frame', None)
+    if frame is None or frame.shape != (size, size):
+        frame = _buffers.frame = np.empty((size, size), dtype=np.float32)
+    frame.fill(0.0)
+
+    height, width = patch.shape
+    top, left = (size - height) // 2, (size - width) // 2
+    total = patch.sum()
+    if total > 0:
+        y_center = top + patch.sum(axis=1) @ np.arange(height, dtype=np.float32) / total
+        x_center = left + patch.sum(axis=0) @ np.arange(width, dtype=np.float32) / total
+        shift_y = int(round(size / 2.0 - y_center))
+        shift_x = int(round(size / 2.0 - x_center))
+    else:
+        shift_y = shift_x = 0
+
+    y, x = top + shift_y, left + shift_x
+    if 0 <= y and y + height <= size and 0 <= x and x + width <= size:
+        frame[y:y + height, x:x + width] = patch
+    else:
+        frame[top:top + height, left:left + width] = patch
+        frame[:] = np.roll(frame, (shift_y, shift_x), axis=(0, 1))
+    return frame
+
+
+def normalize(frame):
+    """Scale 0-255 pixels to 0.0-1.0 and flatten to a fresh (1, 784) array."""
+    return (frame * np.float32(1.0 / 255.0)).reshape(1, -1)
+
+
+def segment_digits(gray):
+    """
+    Split a canvas into digits, left to right.  Returns a list of
+    ``((x, y, width, height), crop)`` where ``crop`` is the inverted
+    float32 digit like ``crop_to_content`` returns, with the strokes of
+    neighbouring digits masked out.  A blank canvas gives an empty list.
+    """
+    mask = gray != 255
+    labels, count = ndimage.label(mask, structure=np.ones((3, 3), dtype=bool))
+    if count == 0:
+        return []
+    sizes = np.bincount(labels.ravel())
+    slices = ndimage.find_objects(labels)
+
+    # Group components whose column ranges mostly overlap (strokes of one digit).
+    groups = []
+    for label in sorted(range(1, count + 1), key=lambda l: slices[l - 1][1].start):
+        rows, cols = slices[label - 1]
+        if groups:
+            group = groups[-1]
+            overlap = min(group["x1"], cols.stop) - max(group["x0"], cols.start)
+            narrower = min(group["x1"] - group["x0"], cols.stop - cols.start)
+            if overlap >= SEGMENT_OVERLAP * narrower:
+                group["labels"].append(label)
+                group["x0"], group["x1"] = min(group["x0"], cols.start), max(group["x1"], cols.stop)
+                group["y0"], group["y1"] = min(group["y0"], rows.start), max(group["y1"], rows.stop)
+                group["size"] += sizes[label]
+                continue
+        groups.append({"labels": [label], "x0": cols.start, "x1": cols.stop,
+                       "y0": rows.start, "y1": rows.stop, "size": sizes[label]})
+
+    groups = [group for group in groups if group["size"] >= MIN_SEGMENT_PIXELS]
+    # A stroke broken by a lifted pen leaves a small fragment: join it to the closest neighbour.
+    largest = max((group["size"] for group in groups), default=0)
+    merged = []
+    for i, group in enumerate(groups):
+        if len(groups) == 1 or group["size"] >= FRAGMENT_FRACTION * largest:
+            merged.append(group)
+            continue
+        gap_left = group["x0"] - merged[-1]["x1"] if merged else None
+        gap_right = groups[i + 1]["x0"] - group["x1"] if i + 1 < len(groups) else None
+        if gap_right is None or (gap_left is not None and gap_left <= gap_right):
+            target = merged[-1]
+        else:
+            target = groups[i + 1]
+        target["labels"].extend(group["labels"])
+        for key, pick in (("x0", min), ("y0", min), ("x1", max), ("y1", max)):
+            target[key] = pick(target[key], group[key])
+        target["size"] += group["size"]
+    groups = merged
+    if len(groups) > MAX_DIGITS:
+        raise PayloadError(f"Too many separate strokes ({len(groups)}); at most {MAX_DIGITS} digits are read")
+    segments = []
+    for group in groups:
+        window = (slice(group["y0"], group["y1"]), slice(group["x0"], group["x1"]))
+        keep = np.isin(labels[window], group["labels"])
+        crop = np.where(keep, 255.0 - gray[window].astype(np.float32), np.float32(0.0))
+        box = (int(group["x0"]), int(group["y0"]), int(group["x1"] - group["x0"]), int(group["y1"] - group["y0"]))
+        segments.append((box, crop))
+    return segments
+
+
+def batch_segments(segments):
+    """
+    Normalize every segment like a single digit and stack them.  Returns
+    ``(boxes, x)`` with ``x`` of shape (len(segments), 784).
+    """
+    x = np.empty((len(segments), FRAME_SIZE * FRAME_SIZE), dtype=np.float32)
+    for row, (box, crop) in enumerate(segments):
+        x[row] = normalize(center_in_frame(resize_to_box(crop)))
+    return [box for box, crop in segments], x
+
+
+def blank():
+    """The input for an empty canvas."""
+    return np.zeros((1, FRAME_SIZE * FRAME_SIZE), dtype=np.float32)
+
+
+DEFAULT_STAGES = [
+    ("validate", validate),
+    ("decode", decode),
+    ("crop", crop_to_content),
+    ("resize", resize_to_box),
+    ("center", center_in_frame),
+    ("normalize", normalize),
+]
+
+
+MULTI_DIGIT_STAGES = [
+    ("validate", validate),
+    ("decode", decode),
+    ("segment", segment_digits),
+    ("batch", batch_segments),
+]
+
+
+class Pipeline:
+    """
+    An ordered list of ``(name, function)`` stages.  Each stage gets the
+    previous stage's output; a stage returning None (blank canvas) ends
+    the run early with a blank input.  After every stage the hooks are
+    called as ``hook(pipeline_name, stage_name, seconds)``.
+    """
+
+    def __init__(self, name, stages=None, data_url=False):
+        self.name = name
+        self.stages = list(DEFAULT_STAGES if stages is None else stages)
+        if data_url:
+            self.stages.insert(0, ("b64decode", decode_data_url))
+        self.hooks = []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def __call__(self, payload):
+        value = payload
+        for stage_name, stage in self.stages:
+            start = time.perf_counter()
+            value = stage(value)
+            elapsed = time.perf_counter() - start
+            for hook in self.hooks:
+                hook(self.name, stage_name, elapsed)
+            if value is None:
+                return blank()
+        return value
+
+
+class StageTimer:
+    """
+    Pipeline hook that accumulates call counts and total time per stage
+    and prints a summary every ``report_every`` runs of the first stage.
+    """
+
+    def __init__(self, report_every=100):
+        self.report_every = report_every
+        self.counts = {}
+        self.totals = {}
+        self._first = None
+
+    def __call__(self, pipeline_name, stage_name, seconds):
+        if self._first is None:
+            self._first = stage_name
+        self.counts[stage_name] = self.counts.get(stage_name, 0) + 1
+        self.totals[stage_name] = self.totals.get(stage_name, 0.0) + seconds
+        if stage_name == self._first and self.counts[stage_name] % self.report_every == 0:
+            print(f"[{pipeline_name}] preprocessing " + self.summary())
+
+    def summary(self):
+        parts = [f"{name}={self.totals[name] / self.counts[name] * 1e3:.2f}ms" for name in self.counts]
+        return "avg per stage: " + ", ".join(parts)
+
+
+def build_pipeline(name, data_url=False, stages=None):
+    """
+    The standard pipeline for an app (or one made of ``stages``, e.g.
+    MULTI_DIGIT_STAGES).  Set PREPROCESS_PROFILE=<n> to print per-stage
+    averages every n requests.
+    """
+    pipeline = Pipeline(name, stages=stages, data_url=data_url)
+    report_every = int(os.getenv("PREPROCESS_PROFILE", "0"))
+    if report_every > 0:
+        pipeline.add_hook(StageTimer(report_every))
+    return pipeline
+
+
+def preprocess_image_from_bytes(img_bytes):
+    """
+    Convert raw PNG bytes (from user canvas) into a 1x784 numpy array
+    matching MNIST-style 28x28 flattened input the SVM expects.
+    Steps:
+      - Decode once into a grayscale array
+      - Crop to the strokes and invert to white-on-black (MNIST)
+      - Area-average resize so the digit fits a 20x20 box
+      - Center in a 28x28 frame and shift by center of mass
+      - Normalize pixel values to 0.0-1.0 (float32), shape (1, 784)
+    """
+    crop = crop_to_content(decode(img_bytes))
+    if crop is None:
+        return blank()
+    return normalize(center_in_frame(resize_to_box(crop)))
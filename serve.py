@@ -0,0 +1,167 @@
+"""
+Pre-fork production server for the digit apps.
+
+The master process imports the app module once (which loads the SVM),
+freezes the garbage collector so the model's objects are never touched
+by a collection, binds the listening socket and forks the workers.  The
+workers inherit the model pages copy-on-write and all accept from the
+same socket.  BLAS thread pools are pinned per worker so N workers do
+not oversubscribe the CPUs, and workers that crash are restarted.
+A worker stopped by SIGTERM or SIGINT runs the exit handlers before it
+exits, so pending player stats and confusion snapshots are written.
+With more than one worker, game sessions are kept in SQLite so a player's
+requests can land on any worker (``SESSION_STORE``, see game_sessions).
+
+    python serve.py number_recognizer_app --workers 4 --port 5000
+    python serve.py starship_calibrator --workers 2 --threads
+"""
+
+import argparse
+import atexit
+import gc
+import importlib
+import os
+import signal
+import socket
+import sys
+import time
+
+BLAS_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                 "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+RESTART_BACKOFF = 1.0  # seconds to wait before restarting a worker that died quickly
+
+
+def pin_blas_threads(count):
+    """Limit BLAS/OpenMP thread pools; must run before numpy is imported."""
+    for var in BLAS_ENV_VARS:
+        os.environ[var] = str(count)
+
+
+def load_app(module_name):
+    module = importlib.import_module(module_name)
+    return module.app
+
+
+def bind_socket(host, port, backlog):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def stop_worker(signum, frame):
+    raise SystemExit(0)
+
+
+def run_worker(app, sock, host, port, threaded, blas_threads):
+    """Serve requests from the shared socket until killed."""
+    from werkzeug.serving import make_server
+
+    import health
+
+    signal.signal(signal.SIGINT, stop_worker)
+    signal.signal(signal.SIGTERM, stop_worker)
+    try:
+        # Thread pools created before the fork are not inherited sanely; re-apply the limit.
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(blas_threads)
+    except ImportError:
+        pass
+    server = make_server(host, port, app, threaded=threaded, fd=sock.fileno())
+    # Each worker warms itself up after the fork; don't accept until it is done.
+    health.wait_ready()
+    server.serve_forever()
+
+
+def spawn(app, sock, args):
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            run_worker(app, sock, args.host, args.port, args.threads, args.blas_threads)
+        except SystemExit:
+            status = 0  # stopped by SIGTERM or SIGINT
+        finally:
+            # A second signal must not interrupt the flush below.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            # os._exit skips atexit: flush the worker's player stats and snapshots first.
+            try:
+                atexit._run_exitfuncs()
+            finally:
+                os._exit(status)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("app", help="module with a Flask `app`, e.g. number_recognizer_app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads", action="store_true", help="handle requests in threads inside each worker")
+    parser.add_argument("--blas-threads", type=int, default=1, help="BLAS threads per worker")
+    parser.add_argument("--backlog", type=int, default=1024)
+    args = parser.parse_args()
+
+    pin_blas_threads(args.blas_threads)
+    os.environ["SERVE_MASTER_PID"] = str(os.getpid())  # background work that must wait for the fork checks this
+    if args.workers > 1:
+        os.environ.setdefault("SESSION_STORE", "sqlite")
+    sys.path.insert(0, os.getcwd())
+
+    start = time.perf_counter()
+    app = load_app(args.app)
+    import health
+    health.wait_ready()  # no warmup threads may be running when we fork
+    print(f"Loaded and warmed up {args.app} in {time.perf_counter() - start:.2f}s")
+
+    # Move everything allocated so far (model included) to the permanent
+    # generation: the collector will never write to those objects' headers,
+    # so the workers keep sharing the pages instead of copying them.
+    gc.collect()
+    gc.freeze()
+
+    sock = bind_socket(args.host, args.port, args.backlog)
+    workers = {}
+    for _ in range(args.workers):
+        workers[spawn(app, sock, args)] = time.monotonic()
+    print(f"Serving {args.app} on http://{args.host}:{args.port} with {args.workers} workers")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = workers.pop(pid, None)
+        if stopping or started is None:
+            continue
+        print(f"Worker {pid} exited with status {status}; restarting")
+        if time.monotonic() - started < RESTART_BACKOFF:
+            time.sleep(RESTART_BACKOFF)
+        workers[spawn(app, sock, args)] = time.monotonic()
+
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+shadow
+~~~~~~
+
+Shadow evaluation of a candidate model on live traffic.
+
+Set ``SHADOW_MODEL=path/to/candidate.pkl`` and every preprocessed input
+the app classifies is also handed to the candidate.  The hand-off is a
+``put_nowait`` on a bounded queue (``SHADOW_QUEUE``, default 256); a
+background thread drains it in batches, so the shadow model never adds
+latency to a request and inputs are dropped, not queued, when it falls
+behind.
+
+Agreement with the primary model, shadow latency and a primary-by-shadow
+confusion matrix are kept per process and served at ``/shadow``; the
+counters also appear in ``/metrics``.
+"""
+
+#### Libraries
+# Standard library
+import os
+import queue
+import threading
+import time
+
+# Third-party libraries
+import joblib
+import numpy as np
+from flask import jsonify
+
+import inference
+import metrics
+
+SHADOW_MODEL = os.getenv("SHADOW_MODEL")
+SHADOW_QUEUE = int(os.getenv("SHADOW_QUEUE", "256"))
+MAX_BATCH = 64
+N_CLASSES = 10
+
+
+class Shadow:
+    """A candidate model fed from a bounded queue by the request threads."""
+
+    def __init__(self, name, path=None, primary_version=None):
+        self.name = name
+        self.path = path
+        self.primary_version = primary_version
+        self.clf = joblib.load(path) if path else None
+        self.version = inference.model_version(path) if path else None
+        self.confusion = np.zeros((N_CLASSES, N_CLASSES), dtype=np.int64)  # [primary, shadow]
+        self.compared = 0
+        self.disagreed = 0
+        self.seconds = 0.0
+        self.batches = 0
+        self._queue = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.clf is not None
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork: each serve.py worker starts its own.
+        if self._pid != os.getpid():
+            self._queue = queue.Queue(maxsize=SHADOW_QUEUE)
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, args=(self._queue,), name="shadow-" + self.name, daemon=True).start()
+
+    def submit(self, x, predictions):
+        """Queue a batch of inputs with the primary model's predictions; never blocks."""
+        if self.clf is None:
+            return
+        keep = x.any(axis=1)  # blank canvases say nothing about the model
+        if not keep.any():
+            return
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait((x[keep], np.asarray(predictions)[keep]))
+        except queue.Full:
+            metrics.SHADOW_DROPPED.inc(self.name, amount=int(keep.sum()))
+
+    def _run(self, work):
+        while True:
+            items = [work.get()]
+            rows = len(items[0][0])
+            while rows < MAX_BATCH:
+                try:
+                    items.append(work.get_nowait())
+                except queue.Empty:
+                    break
+                rows += len(items[-1][0])
+            x = np.vstack([item[0] for item in items])
+            primary = np.concatenate([item[1] for item in items])
+            try:
+                start = time.perf_counter()
+                shadow = self.clf.predict(x).astype(np.int64)
+                elapsed = time.perf_counter() - start
+            except Exception as e:
+                print(f"[{self.name}] shadow model failed: {e}")
+                metrics.SHADOW_DROPPED.inc(self.name, amount=len(x))
+                continue
+            self._record(primary, shadow, elapsed)
+
+    def _record(self, primary, shadow, elapsed):
+        np.add.at(self.confusion, (primary, shadow), 1)
+        disagreed = int((primary != shadow).sum())
+        self.compared += len(primary)
+        self.disagreed += disagreed
+        self.seconds += elapsed
+        self.batches += 1
+        metrics.SHADOW_SECONDS.observe(elapsed, self.name)
+        metrics.SHADOW_COMPARED.inc(self.name, "agree", amount=len(primary) - disagreed)
+        metrics.SHADOW_COMPARED.inc(self.name, "disagree", amount=disagreed)
+
+    def report(self):
+        compared = self.compared
+        confusion = self.confusion.copy()
+        per_class = {}
+        for digit in range(N_CLASSES):
+            total = int(confusion[digit].sum())
+            if total:
+                per_class[str(digit)] = round(1.0 - confusion[digit, digit] / total, 4)
+        return {
+            "enabled": True,
+            "app": self.name,
+            "primary_version": self.primary_version,
+            "shadow_model": self.path,
+            "shadow_version": self.version,
+            "compared": compared,
+            "disagreements": self.disagreed,
+            "disagreement_rate": round(self.disagreed / compared, 4) if compared else None,
+            "dropped": metrics.SHADOW_DROPPED.collect().get((self.name,), [0])[0],
+            "queued": self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0,
+            "avg_batch_seconds": round(self.seconds / self.batches, 6) if self.batches else None,
+            "disagreement_by_primary_digit": per_class,
+            "confusion": confusion.tolist(),  # rows: primary prediction, columns: shadow prediction
+        }
+
+
+def install(app, name, primary_version=None, path=SHADOW_MODEL):
+    """Add /shadow to a Flask app; returns the Shadow (a no-op without SHADOW_MODEL)."""
+    shadow = Shadow(name, path, primary_version)
+    if shadow.enabled:
+        print(f"[{name}] shadowing with {path} ({shadow.version})")
+
+    @app.route("/shadow")
+    def shadow_report():
+        if not shadow.enabled:
+            return jsonify({"enabled": False, "app": name})
+        return jsonify(shadow.report())
+
+    return shadow
@@ -1,18 +1,26 @@
-import base64
-import io
-import joblib
-import numpy as np
 import random
 import os
 import json
 import time
-from flask import Flask, request, jsonify, render_template_string
-from PIL import Image, ImageOps, ImageChops
+from flask import Flask, request, jsonify
 from google.generativeai import GenerativeModel, configure
 from google.generativeai.types import GenerationConfig
 from dotenv import load_dotenv
+import admission
+import confusion
+import game_sessions
+import health
+import inference
+import llm_cache
+import llm_client
+import metrics
+import player_stats
+import preprocessing
+import shadow
+import static_pages
 
 # --- SETUP ---
+APP_NAME = "spy_game"
 load_dotenv(".env")
 
 # Configure the Gemini client
@@ -20,7 +28,7 @@ try:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         raise ValueError("GEMINI_API_KEY not found in .env file")
-    configure(api_key=api_key)
+    configure(api_key=api_key, **llm_client.gemini_options())
     model = GenerativeModel('gemini-1.5-flash')
 except Exception as e:
     print(f"Error configuring Gemini AI: {e}")
@@ -29,12 +37,25 @@ except Exception as e:
 # Load the pre-trained SVM model
 try:
     MODEL_PATH = "svm_mnist_model.pkl"
-    clf = joblib.load(MODEL_PATH)
+    with metrics.timed(metrics.MODEL_LOAD_SECONDS, APP_NAME):
+        clf = inference.load_model(MODEL_PATH)
+    calibrator = inference.load_calibrator()
+    batcher = inference.shared_batcher(clf, calibrator)  # one inference worker for every app in the process
+    MODEL_VERSION = inference.model_version(MODEL_PATH)
 except FileNotFoundError:
     print(f"FATAL ERROR: Model file not found at '{MODEL_PATH}'")
     exit()
 
 app = Flask("AI Containment Game")
+app.config["MAX_CONTENT_LENGTH"] = preprocessing.MAX_REQUEST_BYTES  # rejected with 413 before parsing
+metrics.install(app, APP_NAME)
+shadow_model = shadow.install(app, APP_NAME, MODEL_VERSION)
+confusions = confusion.install(app, APP_NAME, MODEL_VERSION)  # digit asked for vs digit read
+
+# Shared preprocessing pipeline: data URL -> 1x784 vector
+preprocess = preprocessing.build_pipeline(APP_NAME, data_url=True)
+preprocess.add_hook(metrics.stage_hook)
+preprocess.add_hook(admission.deadline_hook)
 
 
 # --- DEFAULT GAME STATE ---
@@ -46,13 +67,21 @@ def get_default_state():
         "total_levels": 5,
         "time_limit": 90,
         "start_time": None,
+        "move_started": None,  # when the current code was asked for
         "attempts_remaining": 3,
         "max_attempts": 3,
         "game_sequence": []  # The pre-generated sequence of correct digits
     }
 
 
-story_state = get_default_state()
+# Each player's mission, kept per session cookie
+sessions = game_sessions.install(app, APP_NAME, get_default_state())
+stats = player_stats.install(app, APP_NAME)
+
+# Story segments reused across players; numbers in the context become placeholders
+story_cache = llm_cache.LLMCache(APP_NAME)
+llm = llm_client.LLMClient(APP_NAME, model)
+STORY_FIELDS = ("next_digit", "player_input", "level", "attempts_remaining")
 
 # --- FRONTEND (HTML, CSS, JS) ---
 HTML_PAGE = """
@@ -226,7 +255,7 @@ function updateUI(data) {
 
 startGameBtn.addEventListener('click', async () => {
     storyBox.innerText = "Initializing quarantine protocols...";
-    const resp = await fetch('/start_game');
+    const resp = await fetch('start_game');
     const data = await resp.json();
     updateUI(data);
     clearBtn.click();
@@ -266,7 +295,7 @@ submitStoryBtn.addEventListener('click', async () => {
     storyBox.innerText = "Analyzing neural input... Transmitting counter-protocol...";
     submitStoryBtn.disabled = true;
     const dataURL = canvas.toDataURL('image/png');
-    const resp = await fetch('/submit_drawing', {
+    const resp = await fetch('submit_drawing', {
         method: 'POST',
         headers: {'Content-Type':'application/json'},
         body: JSON.stringify({ image: dataURL })
@@ -278,7 +307,7 @@ submitStoryBtn.addEventListener('click', async () => {
 });
 
 resetBtn.addEventListener('click', async () => {
-    const resp = await fetch('/reset_game');
+    const resp = await fetch('reset_game');
     const data = await resp.json();
     timerDisplay.innerText = "Time until breach: --";
     document.getElementById('timer-bar').style.width = '100%';
@@ -305,14 +334,23 @@ function typeWriter(element, text, speed) {
 
 
 # --- BACKEND LOGIC ---
+def fallback_story(context):
+    """Local story text for when Gemini is offline, failing or switched off by the circuit breaker."""
+    if context['game_state'] == 'welcome':
+        return {"story_text": f"Welcome, Specialist. Your first counter-protocol is {context['next_digit']}."}
+    elif context['game_state'] == 'time_up':
+        return {"story_text": "Time's up. SYNAPSE has breached containment. Mission failed."}
+    elif context['game_state'] == 'game_won':
+        return {"story_text": "All firewall layers reinforced. SYNAPSE is contained. Outstanding work, Specialist."}
+    elif context['result'] == 'success':
+        return {"story_text": f"Success! The next firewall code is {context['next_digit']}."}
+    else:
+        return {"story_text": f"Failure! Firewall integrity dropping. Retry code {context['next_digit']}."}
+
+
 def get_llm_story(context):
-    if not model:  # Fallback if Gemini is offline
-        if context['game_state'] == 'welcome':
-            return {"story_text": f"Welcome, Specialist. Your first counter-protocol is {context['next_digit']}."}
-        elif context['result'] == 'success':
-            return {"story_text": f"Success! The next firewall code is {context['next_digit']}."}
-        else:
-            return {"story_text": f"Failure! Firewall integrity dropping. Retry code {context['next_digit']}."}
+    if not llm:  # Fallback if Gemini is offline
+        return fallback_story(context)
 
     system_prompt = """
     You are a story generator for a tense AI containment game. Your response MUST be a single JSON object.
@@ -334,18 +372,20 @@ def get_llm_story(context):
 
     CRITICAL: Your entire response must be ONLY a valid JSON object like this: {{"story_text": "Your narrative here."}}
     """
+    def generate():
+        text = llm.generate([system_prompt, user_prompt],
+                            generation_config=GenerationConfig(response_mime_type="application/json"))
+        return json.loads(text)
+
     try:
-        response = model.generate_content(
-            [system_prompt, user_prompt],
-            generation_config=GenerationConfig(response_mime_type="application/json")
-        )
-        return json.loads(response.text)
+        return story_cache.get("story", context, generate, fields=STORY_FIELDS)
     except Exception as e:
         print(f"LLM Error: {str(e)}, using fallback")
-        return get_llm_story(context)  # Call self for fallback
+        return fallback_story(context)
 
 
-def process_submission(predicted_digit):
+def submission_transition(story_state, predicted_digit):
+    """Apply a drawing to the mission state; returns (is_success, LLM context)."""
     is_success = (predicted_digit == story_state["target_digit"])
     context = {"player_input": predicted_digit}
 
@@ -376,10 +416,24 @@ def process_submission(predicted_digit):
         "level": story_state['level'],
         "attempts_remaining": story_state['attempts_remaining']
     })
+    return is_success, context
+
 
+def process_submission(sid, predicted_digit, player=None):
+    # The state changes atomically; the LLM is called once the session is released
+    def submit(state):
+        target, playing = state["target_digit"], state["game_state"] == "playing"
+        now = time.time()
+        seconds = now - state["move_started"] if state["move_started"] else None
+        state["move_started"] = now
+        return submission_transition(state, predicted_digit) + (dict(state), target if playing else None, seconds)
+
+    is_success, context, story_state, target, seconds = sessions.update(sid, submit)
+    stats.record(player, target, is_success, seconds)
+    confusions.record(target, predicted_digit)
     llm_response = get_llm_story(context)
 
-    return jsonify({
+    return {
         "story_text": llm_response.get('story_text'),
         "prediction": predicted_digit,
         "success": is_success,
@@ -388,23 +442,30 @@ def process_submission(predicted_digit):
         "total_levels": story_state['total_levels'],
         "attempts_remaining": story_state['attempts_remaining'],
         "max_attempts": story_state['max_attempts']
-    })
+    }
+
+
+INDEX_PAGE = static_pages.Page(app, HTML_PAGE)
 
 
 @app.route("/")
 def index():
-    return render_template_string(HTML_PAGE)
+    return INDEX_PAGE.response()
 
 
-@app.route("/start_game", methods=["GET"])
-def start_game():
-    story_state.update(get_default_state())
-    game_sequence = [random.randint(0, 9) for _ in range(story_state['total_levels'])]
-    story_state.update({
-        "level": 1, "game_state": 'playing',
-        "start_time": time.time(), "game_sequence": game_sequence,
-        "target_digit": game_sequence[0]
-    })
+def begin_mission(sid):
+    """Start a new mission with a fresh digit sequence and get the briefing."""
+    def start(story_state):
+        story_state.update(get_default_state())
+        game_sequence = [random.randint(0, 9) for _ in range(story_state['total_levels'])]
+        story_state.update({
+            "level": 1, "game_state": 'playing',
+            "start_time": time.time(), "move_started": time.time(), "game_sequence": game_sequence,
+            "target_digit": game_sequence[0]
+        })
+        return dict(story_state)
+
+    story_state = sessions.update(sid, start)
 
     context = {
         "game_state": "welcome",
@@ -412,13 +473,49 @@ def start_game():
     }
     llm_response = get_llm_story(context)
 
-    return jsonify({**story_state, **llm_response})
+    return {**story_state, **llm_response}
+
+
+def check_time_up(sid):
+    """End the mission if the time limit has passed; returns the response or None."""
+    story_state = sessions.get(sid)
+    if story_state['start_time'] is None:  # no mission started yet
+        return None
+    time_elapsed = time.time() - story_state['start_time']
+    if time_elapsed >= story_state['time_limit']:
+        def expire(state):
+            state['game_state'] = 'time_up'
+            return dict(state)
+
+        story_state = sessions.update(sid, expire)
+        llm_response = get_llm_story({"game_state": "time_up"})
+        return {**story_state, **llm_response, "success": False}
+    return None
+
+
+def classify_drawing(data_url):
+    """Preprocess the drawing (errors become a blank input); returns the prediction with top-k confidences."""
+    try:
+        x = preprocess(data_url)
+    except admission.DeadlineExceeded:
+        raise
+    except Exception as e:
+        print(f"Error preprocessing image: {str(e)}")
+        x = preprocessing.blank()
+    with metrics.timed(metrics.STAGE_SECONDS, APP_NAME, "predict"):
+        result = batcher.classify(x)[0]
+    shadow_model.submit(x, [result["prediction"]])
+    return result
+
+
+@app.route("/start_game", methods=["GET"])
+def start_game():
+    return jsonify(begin_mission(sessions.current_id()))
 
 
 @app.route("/reset_game", methods=["GET"])
 def reset_game():
-    global story_state
-    story_state = get_default_state()
+    story_state = sessions.reset(sessions.current_id())
     return jsonify({
         **story_state,
         "story_text": "URGENT: Rogue AI \"SYNAPSE\" is attempting a containment breach. Your mission is to reinforce the quarantine firewalls by entering a series of counter-protocol codes. The system's integrity is failing. Press 'Deploy' to begin."
@@ -426,47 +523,21 @@ def reset_game():
 
 
 @app.route("/submit_drawing", methods=["POST"])
+@admission.limit(APP_NAME, "submit_drawing", concurrency=32, queue=64, timeout=30)
 def submit_drawing():
-    time_elapsed = time.time() - story_state.get('start_time', 0)
-    if time_elapsed >= story_state['time_limit']:
-        story_state['game_state'] = 'time_up'
-        llm_response = get_llm_story({"game_state": "time_up"})
-        return jsonify({**story_state, **llm_response, "success": False})
+    sid = sessions.current_id()
+    timed_out = check_time_up(sid)
+    if timed_out:
+        return jsonify(timed_out)
 
     data = request.get_json()
-    x = preprocess_image_from_bytes(data["image"])
-    pred = int(clf.predict(x)[0])
-    return process_submission(pred)
+    guess = classify_drawing(data["image"])
+    admission.check_deadline()  # don't start an LLM call nobody is waiting for
+    return jsonify({**process_submission(sid, guess["prediction"], stats.current_player()), "confidence": guess["confidence"], "top_k": guess["top_k"]})
 
 
-def preprocess_image_from_bytes(data_url):
-    try:
-        if "," not in data_url: return np.zeros((1, 784), dtype=np.float32)
-        _, b64 = data_url.split(",", 1)
-        img_bytes = base64.b64decode(b64)
-        img = Image.open(io.BytesIO(img_bytes)).convert('L')
-        img = ImageOps.invert(img)
-        bbox = img.getbbox()
-        if not bbox: return np.zeros((1, 784), dtype=np.float32)
-        img = img.crop(bbox)
-        scale = 20.0 / max(img.size)
-        new_size = (int(round(img.size[0] * scale)), int(round(img.size[1] * scale)))
-        img = img.resize(new_size, resample=Image.LANCZOS)
-        new_img = Image.new('L', (28, 28), 0)
-        new_img.paste(img, ((28 - new_size[0]) // 2, (28 - new_size[1]) // 2))
-        arr = np.array(new_img, dtype=np.float32)
-        if arr.sum() == 0: return arr.reshape(1, -1)
-        cy, cx = np.indices(arr.shape)
-        x_center = (cx * arr).sum() / arr.sum()
-        y_center = (cy * arr).sum() / arr.sum()
-        shift_x = int(round(14.0 - x_center))
-        shift_y = int(round(14.0 - y_center))
-        new_img = ImageChops.offset(new_img, shift_x, shift_y)
-        final_arr = np.array(new_img, dtype=np.float32)
-        return (final_arr.reshape(1, -1) / 255.0)
-    except Exception as e:
-        print(f"Error preprocessing image: {str(e)}")
-        return np.zeros((1, 784), dtype=np.float32)
+health.install(app, APP_NAME, lambda data_url: inference.classify(clf, preprocess(data_url), calibrator),
+               model_version=MODEL_VERSION)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,30 @@
-import base64
-import io
-import joblib
-import numpy as np
 import random
 import os
 import json
-from flask import Flask, request, jsonify, render_template_string
-from PIL import Image, ImageOps, ImageChops
-from google import genai
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify
+from google.generativeai import GenerativeModel, configure
+from google.generativeai.types import GenerationConfig
+import admission
+import confusion
+import game_sessions
+import health
+import inference
+import llm_cache
+import llm_client
+import metrics
+import player_stats
+import preprocessing
+import shadow
+import static_pages
 from dotenv import load_dotenv
 
 # --- SETUP ---
+APP_NAME = "starship_calibrator"
+
 # Load environment variables from .env file (for GEMINI_API_KEY)
 load_dotenv(".env")
 
@@ -19,9 +33,9 @@ try:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         raise ValueError("GEMINI_API_KEY not found in .env file")
-    genai.configure(api_key=api_key)
+    configure(api_key=api_key, **llm_client.gemini_options())
     # Use the latest generative model
-    model = genai.GenerativeModel('gemini-2.0-flash')
+    model = GenerativeModel('gemini-2.0-flash')
 except Exception as e:
     print(f"Error configuring Gemini AI: {e}")
     print("Story mode will not work. Please check your .env file and API key.")
@@ -30,7 +44,11 @@ except Exception as e:
 # Load the pre-trained SVM model for digit recognition
 try:
     MODEL_PATH = "svm_mnist_model.pkl"
-    clf = joblib.load(MODEL_PATH)
+    with metrics.timed(metrics.MODEL_LOAD_SECONDS, APP_NAME):
+        clf = inference.load_model(MODEL_PATH)
+    calibrator = inference.load_calibrator()
+    batcher = inference.shared_batcher(clf, calibrator)  # one inference worker for every app in the process
+    MODEL_VERSION = inference.model_version(MODEL_PATH)
 except FileNotFoundError:
     print(f"FATAL ERROR: Model file not found at '{MODEL_PATH}'")
     print("Please make sure 'svm_mnist_model.pkl' is in the same directory.")
@@ -38,15 +56,39 @@ except FileNotFoundError:
 
 # Initialize Flask App
 app = Flask("Handwritten Digit Recognizer")
+app.config["MAX_CONTENT_LENGTH"] = preprocessing.MAX_REQUEST_BYTES  # rejected with 413 before parsing
+metrics.install(app, APP_NAME)
+shadow_model = shadow.install(app, APP_NAME, MODEL_VERSION)
+confusions = confusion.install(app, APP_NAME, MODEL_VERSION)  # digit asked for vs digit read
+
+# Shared preprocessing pipeline: data URL -> 1x784 vector
+preprocess = preprocessing.build_pipeline(APP_NAME, data_url=True)
+preprocess.add_hook(metrics.stage_hook)
+preprocess.add_hook(admission.deadline_hook)
 
 # --- GAME STATE ---
-# This dictionary will hold the state of our story game
-story_state = {
+# Each player's story state, kept per session cookie
+sessions = game_sessions.install(app, APP_NAME, {
     "game_state": "welcome",  # Can be 'welcome', 'playing', 'level_complete', 'game_won'
     "target_digit": None,
     "level": 0,
-    "total_levels": 5  # How many digits to draw to win
-}
+    "total_levels": 5,  # How many digits to draw to win
+    "move_started": None  # When the current digit was asked for
+})
+stats = player_stats.install(app, APP_NAME)
+
+# Next story segments generated while the player draws:
+# session id -> ((level, target_digit), {result: Future}), oldest session first
+PREFETCH_WAIT = float(os.getenv("PREFETCH_WAIT", "0.25"))  # seconds to wait on an unfinished segment
+MAX_PREFETCHED = 1024  # sessions with segments in flight
+prefetch_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="story-prefetch")
+prefetched = OrderedDict()
+prefetch_lock = threading.Lock()
+
+# Story segments reused across players; numbers in the context become placeholders
+story_cache = llm_cache.LLMCache(APP_NAME)
+llm = llm_client.LLMClient(APP_NAME, model)
+STORY_FIELDS = ("target_digit", "player_drawing", "current_level")
 
 # --- HTML & CSS & JAVASCRIPT (FRONTEND) ---
 HTML_PAGE = """
@@ -265,7 +307,7 @@ function updateUI(data) {
 
 startGameBtn.addEventListener('click', async () => {
     storyBox.innerText = "Initializing systems... Contacting Nova...";
-    const resp = await fetch('/start_game');
+    const resp = await fetch('start_game');
     const data = await resp.json();
     updateUI(data);
     clearBtn.click(); // Clear canvas for the new game
@@ -276,7 +318,7 @@ submitStoryBtn.addEventListener('click', async () => {
     submitStoryBtn.disabled = true; // Prevent multiple submissions
 
     const dataURL = canvas.toDataURL('image/png');
-    const resp = await fetch('/submit_drawing', {
+    const resp = await fetch('submit_drawing', {
         method: 'POST',
         headers: {'Content-Type':'application/json'},
         body: JSON.stringify({ image: dataURL })
@@ -297,26 +339,14 @@ def get_llm_story(context):
     Generates a story segment from Gemini based on the game context.
     Returns a dictionary with story text and next digit.
     """
-    if not model:
+    if not llm:
         # Fallback for when Gemini API is not configured
-        if context['result'] == 'success':
-            story_state['target_digit'] = random.randint(0, 9)
-            return {
-                "story_text": f"Success! System calibrated. Now draw a {story_state['target_digit']} to proceed.",
-                "next_digit": story_state['target_digit'],
-                "game_over": False
-            }
-        else:
-            return {
-                "story_text": f"Almost! That didn't quite work. Please try drawing {story_state['target_digit']} again.",
-                "next_digit": story_state['target_digit'],
-                "game_over": False
-            }
+        return template_story(context)
 
     system_prompt = f"""
     You are Nova, the friendly AI of the starship 'Stardust Cruiser'. Your role is to guide the user, the 'Captain', on a mission to calibrate the ship's systems by having them draw numbers.
     - Be encouraging, slightly dramatic, and use space-themed language (e.g., "circuits", "energy matrix", "warp drive", "nebula").
-    - The user needs to complete {story_state['total_levels']} calibrations to win.
+    - The user needs to complete {context['total_levels']} calibrations to win.
     - Your responses must be in JSON format.
     """
 
@@ -337,147 +367,213 @@ def get_llm_story(context):
     "game_over": (boolean) Set to true only if 'game_state' is 'game_won'.
     """
 
-    try:
-        response = model.generate_content(
+    def generate():
+        text = llm.generate(
             [system_prompt, user_prompt],
-            generation_config=genai.types.GenerationConfig(
+            generation_config=GenerationConfig(
                 # Enforce JSON output from the model
                 response_mime_type="application/json",
             )
         )
-        return json.loads(response.text)
-    except Exception as e:
-        print(f"Error calling Gemini API: {str(e)}")
-        return {"story_text": f"(LLM Error: {str(e)}) Please try again.", "next_digit": story_state['target_digit'],
-                "game_over": False}
-
-
-@app.route("/")
-def index():
-    return render_template_string(HTML_PAGE)
+        return json.loads(text)
 
+    try:
+        # A new digit is only picked at the start and after a success; a failure repeats the target
+        fresh = ("next_digit",) if context.get('result') != 'failure' else ()
+        return story_cache.get("story", context, generate, fields=STORY_FIELDS, fresh=fresh)
+    except Exception as e:
+        print(f"Error calling Gemini API: {str(e)}; using the template")
+        return template_story(context)
+
+
+def template_story(context):
+    """Canned story segment, used when Gemini is unavailable or a prefetched one is not ready."""
+    if context['game_state'] == 'game_won':
+        return {"story_text": "All systems calibrated! The Stardust Cruiser is ready for warp. Well done, Captain!",
+                "next_digit": None, "game_over": True}
+    if context.get('result') == 'failure':
+        return {
+            "story_text": f"Almost! That didn't quite work. Please try drawing {context['target_digit']} again.",
+            "next_digit": context['target_digit'],
+            "game_over": False
+        }
+    next_digit = random.randint(0, 9)
+    if context['game_state'] == 'welcome':
+        text = f"Welcome aboard, Captain! Let's calibrate the ship. Draw a {next_digit} to begin."
+    else:
+        text = f"Success! System calibrated. Now draw a {next_digit} to proceed."
+    return {"story_text": text, "next_digit": next_digit, "game_over": False}
 
-@app.route("/start_game", methods=["GET"])
-def start_game():
-    story_state['level'] = 1
-    story_state['game_state'] = 'welcome'  # Let the LLM generate the first prompt
-    story_state['target_digit'] = None  # No target yet
 
+def outcome_context(state, is_success, pred=None):
+    """The game state and LLM context that follow a submission to ``state``, without changing it."""
+    level = state['level'] + 1 if is_success else state['level']
+    game_state = "game_won" if level > state['total_levels'] else "playing"
     context = {
-        "game_state": story_state['game_state'],
-        "current_level": story_state['level'],
-        "total_levels": story_state['total_levels']
+        "game_state": game_state,
+        "current_level": level,
+        "total_levels": state['total_levels'],
+        "target_digit": state['target_digit'],
+        "result": "success" if is_success else "failure"
+    }
+    if pred is not None:
+        context["player_drawing"] = pred
+    return level, game_state, context
+
+
+def prefetch_next(sid, state):
+    """Start generating the success and the failure segment for the session's current challenge."""
+    key = (state['level'], state['target_digit'])
+    with prefetch_lock:
+        stale = prefetched.pop(sid, None)
+        if stale is not None and stale[0] != key:
+            for future in stale[1].values():
+                future.cancel()
+            stale = None
+        if state['game_state'] != 'playing' or state['target_digit'] is None:
+            return
+        futures = stale[1] if stale is not None else {}
+        for result, is_success in (("success", True), ("failure", False)):
+            if result not in futures:
+                context = outcome_context(state, is_success)[2]
+                futures[result] = prefetch_pool.submit(get_llm_story, context)
+        prefetched[sid] = (key, futures)
+        while len(prefetched) > MAX_PREFETCHED:
+            for future in prefetched.popitem(last=False)[1][1].values():
+                future.cancel()
+
+
+def prefetched_story(sid, state, context):
+    """The segment generated in the background for this outcome, or the template if it is not ready."""
+    with prefetch_lock:
+        entry = prefetched.get(sid)
+        future = None
+        if entry is not None and entry[0] == (state['level'], state['target_digit']):
+            future = entry[1].pop(context['result'], None)
+    if future is None:
+        metrics.PREFETCH.inc(APP_NAME, "miss")
+        return get_llm_story(context)
+    try:
+        story = future.result(timeout=PREFETCH_WAIT)
+        metrics.PREFETCH.inc(APP_NAME, "hit")
+        return story
+    except Exception:
+        # Still generating (or failed): answer now; the late result is simply discarded.
+        metrics.PREFETCH.inc(APP_NAME, "not_ready")
+        return template_story(context)
+
+
+def begin_story(sid):
+    """Reset the player's mission and ask the LLM for the briefing and first digit."""
+    # Let the LLM generate the first prompt; no target yet
+    context = {
+        "game_state": "welcome",
+        "current_level": 1,
+        "total_levels": sessions.defaults['total_levels']
     }
 
     llm_response = get_llm_story(context)
 
-    story_state['target_digit'] = llm_response.get('next_digit')
-    story_state['game_state'] = 'playing'
+    def start(state):
+        state.update(sessions.new_state())
+        state['level'] = 1
+        state['target_digit'] = llm_response.get('next_digit')
+        state['game_state'] = 'playing'
+        state['move_started'] = time.time()
+        return dict(state)
 
-    return jsonify({
+    state = sessions.update(sid, start)
+    prefetch_next(sid, state)
+
+    return {
         "story_text": llm_response.get('story_text', "Error generating story."),
         "prediction": None,
         "success": None,
-        "game_state": story_state['game_state']
-    })
+        "game_state": state['game_state'],
+        "target_digit": state['target_digit']
+    }
 
 
-@app.route("/submit_drawing", methods=["POST"])
-def submit_drawing():
-    data = request.get_json()
-    if not data or "image" not in data:
-        return jsonify({"error": "No image provided"}), 400
+def classify_drawing(data_url):
+    """Preprocess the user's drawing; returns the prediction with top-k confidences."""
+    # Invalid data is treated as a blank canvas
+    try:
+        x = preprocess(data_url)
+    except preprocessing.PayloadError:
+        x = preprocessing.blank()
+    with metrics.timed(metrics.STAGE_SECONDS, APP_NAME, "predict"):
+        result = batcher.classify(x)[0]
+    shadow_model.submit(x, [result["prediction"]])
+    return result
 
-    # Preprocess the user's drawing
-    x = preprocess_image_from_bytes(data["image"])
-    pred = int(clf.predict(x)[0])
 
+def advance_story(sid, pred, player=None):
+    """Apply a classified drawing to the player's story state and get the next story part."""
     # Check if the drawing is correct
-    is_success = (pred == story_state["target_digit"])
-
-    if is_success:
-        story_state["level"] += 1
-        if story_state["level"] > story_state["total_levels"]:
-            story_state["game_state"] = "game_won"
+    state, version = sessions.load(sid)
+    is_success = (pred == state["target_digit"])
+    target, playing = state["target_digit"], state["game_state"] == "playing"
+
+    # Both possible next parts were requested from the LLM while the player was drawing
+    level, game_state, context = outcome_context(state, is_success, pred)
+    llm_response = prefetched_story(sid, state, context)
+
+    def advance(state):
+        state["level"], state["game_state"] = level, game_state
+        # Update state with the new target from the LLM
+        if llm_response.get('game_over'):
+            state['game_state'] = 'game_won'
+            state['target_digit'] = None
         else:
-            story_state["game_state"] = "playing"  # Will get a new digit
-    else:
-        story_state["game_state"] = "playing"  # Will retry the same digit
-
-    # Get the next story part from the LLM
-    context = {
-        "game_state": story_state['game_state'],
-        "current_level": story_state['level'],
-        "total_levels": story_state['total_levels'],
-        "target_digit": story_state['target_digit'],
-        "player_drawing": pred,
-        "result": "success" if is_success else "failure"
-    }
-    llm_response = get_llm_story(context)
-
-    # Update state with the new target from the LLM
-    if llm_response.get('game_over'):
-        story_state['game_state'] = 'game_won'
-        story_state['target_digit'] = None
-    else:
-        story_state['target_digit'] = llm_response.get('next_digit')
-
-    return jsonify({
+            state['target_digit'] = llm_response.get('next_digit')
+        now = time.time()
+        seconds = now - state['move_started'] if state['move_started'] else None
+        state['move_started'] = now
+        return dict(state), seconds
+
+    # A second drawing submitted for the same challenge meanwhile gets a 409
+    state, seconds = sessions.update(sid, advance, expect=version)
+    prefetch_next(sid, state)
+    if playing:
+        stats.record(player, target, is_success, seconds)
+        confusions.record(target, pred)
+
+    return {
         "story_text": llm_response.get('story_text', "Error generating story."),
         "prediction": pred,
         "success": is_success,
-        "game_state": story_state['game_state']
-    })
+        "game_state": state['game_state'],
+        "target_digit": state['target_digit']
+    }
 
 
-def preprocess_image_from_bytes(data_url):
-    """
-    Convert raw PNG data URL into a 1x784 numpy array for the SVM model.
-    This includes grayscale conversion, inversion, cropping, resizing, and centering.
-    """
-    if "," not in data_url:
-        # Create a blank image if data is invalid
-        blank_array = np.zeros((1, 784), dtype=np.float32)
-        return blank_array
-
-    header, b64 = data_url.split(",", 1)
-    img_bytes = base64.b64decode(b64)
-    img = Image.open(io.BytesIO(img_bytes)).convert('L')
-    img = ImageOps.invert(img)
-
-    bbox = img.getbbox()
-    if not bbox:
-        return np.zeros((1, 784), dtype=np.float32)
-    img = img.crop(bbox)
-
-    width, height = img.size
-    max_side = max(width, height)
-    # Resize to fit within a 20x20 box, preserving aspect ratio
-    scale = 20.0 / max_side
-    new_width, new_height = int(round(width * scale)), int(round(height * scale))
-    img = img.resize((new_width, new_height), resample=Image.LANCZOS)
-
-    # Paste into the center of a 28x28 black canvas
-    new_img = Image.new('L', (28, 28), 0)
-    upper_left = ((28 - new_width) // 2, (28 - new_height) // 2)
-    new_img.paste(img, upper_left)
-
-    # Shift by center of mass (MNIST-style centering)
-    arr = np.array(new_img, dtype=np.float32)
-    if arr.sum() == 0:
-        return arr.reshape(1, -1)
-
-    cy, cx = np.indices(arr.shape)
-    total = arr.sum()
-    x_center = (cx * arr).sum() / total
-    y_center = (cy * arr).sum() / total
-    shift_x = int(round(14.0 - x_center))
-    shift_y = int(round(14.0 - y_center))
-    new_img = ImageChops.offset(new_img, shift_x, shift_y)
-
-    arr = np.array(new_img, dtype=np.float32)
-    arr = arr / 255.0  # Normalize to 0.0 - 1.0
-    return arr.reshape(1, -1)  # Flatten to 1x784
+INDEX_PAGE = static_pages.Page(app, HTML_PAGE)
+
+
+@app.route("/")
+def index():
+    return INDEX_PAGE.response()
+
+
+@app.route("/start_game", methods=["GET"])
+def start_game():
+    return jsonify(begin_story(sessions.current_id()))
+
+
+@app.route("/submit_drawing", methods=["POST"])
+@admission.limit(APP_NAME, "submit_drawing", concurrency=32, queue=64, timeout=30)
+def submit_drawing():
+    data = request.get_json()
+    if not data or "image" not in data:
+        return jsonify({"error": "No image provided"}), 400
+
+    guess = classify_drawing(data["image"])
+    admission.check_deadline()  # don't start an LLM call nobody is waiting for
+    return jsonify({**advance_story(sessions.current_id(), guess["prediction"], stats.current_player()), "confidence": guess["confidence"], "top_k": guess["top_k"]})
+
+
+health.install(app, APP_NAME, lambda data_url: inference.classify(clf, preprocess(data_url), calibrator),
+               model_version=MODEL_VERSION)
 
 
 if __name__ == "__main__":
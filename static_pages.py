@@ -0,0 +1,87 @@
+"""
+static_pages
+~~~~~~~~~~~~
+
+The apps' HTML pages never change while the process runs, so they are
+rendered once at startup and kept as ready-to-send byte blobs: plain,
+gzip and (when the ``brotli`` package is installed) brotli.  Each
+encoded body gets its own strong ``ETag`` (``"<hash>"``, ``"<hash>-gz"``,
+``"<hash>-br"``), and an ``If-None-Match`` naming the tag of the encoding
+the client would get now is answered with an empty ``304``.
+
+Set ``PAGE_MAX_AGE`` to change how many seconds browsers may reuse a
+page before revalidating it (default 300).
+"""
+
+#### Libraries
+# Standard library
+import gzip
+import hashlib
+import os
+
+# Third-party libraries
+from flask import Response, render_template_string, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PAGE_MAX_AGE = int(os.getenv("PAGE_MAX_AGE", "300"))
+MIN_COMPRESS_BYTES = 1024  # smaller bodies are not worth the Content-Encoding
+ETAG_SUFFIXES = {"identity": "", "gzip": "-gz", "br": "-br"}  # each encoded body is its own representation
+
+
+def _accepted_encodings():
+    """Encodings the client accepts, ignoring any with q=0."""
+    accepted = set()
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = item.partition(";")
+        quality = params.strip().replace(" ", "")
+        try:
+            if quality.startswith("q=") and float(quality[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        if name.strip():
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+class Page:
+    """A template rendered once, with precompressed variants."""
+
+    def __init__(self, app, template, mimetype="text/html", **context):
+        with app.app_context():
+            body = render_template_string(template, **context).encode("utf-8")
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.bodies = {"identity": body}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            self.bodies["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.bodies["br"] = brotli.compress(body, quality=11)
+        self.etags = {encoding: self.etag + ETAG_SUFFIXES[encoding] for encoding in self.bodies}
+
+    def _encoding(self):
+        accepted = _accepted_encodings()
+        for encoding in ("br", "gzip"):
+            if encoding in self.bodies and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def response(self):
+        """The page for the current request, or 304 if the client's copy is current."""
+        encoding = self._encoding()
+        etag = self.etags[encoding]
+        headers = {
+            "ETag": f'"{etag}"',
+            "Cache-Control": f"public, max-age={PAGE_MAX_AGE}",
+            "Vary": "Accept-Encoding",
+        }
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(self.bodies[encoding], mimetype=self.mimetype, headers=headers)
@@ -0,0 +1,43 @@
+import numpy as np
+
+import inference
+
+
+class FakeSVM:
+    """Three classes whose one-vs-one decision values always vote for class 0."""
+    classes_ = np.array([0, 1, 2])
+
+    def decision_function(self, x):
+        return np.ones((x.shape[0], 3))  # pairs (0, 1), (0, 2), (1, 2): 0 wins twice
+
+
+class FakeCalibrator:
+    """Calibrated probabilities that rank class 2 first, against the vote."""
+
+    def predict_proba(self, dec):
+        return np.tile([0.1, 0.2, 0.7], (dec.shape[0], 1))
+
+
+def test_prediction_is_the_vote_with_calibrated_confidence():
+    (result,) = inference.classify(FakeSVM(), np.zeros((1, 4)), FakeCalibrator(), k=3)
+    assert result["prediction"] == result["top_k"][0]["digit"] == 0
+    assert result["confidence"] == result["top_k"][0]["confidence"] == 0.1
+    assert [entry["digit"] for entry in result["top_k"]] == [0, 2, 1]
+
+
+def test_top_k_keeps_the_prediction_when_k_is_one():
+    (result,) = inference.classify(FakeSVM(), np.zeros((1, 4)), FakeCalibrator(), k=1)
+    assert [entry["digit"] for entry in result["top_k"]] == [0]
+
+
+def test_prediction_is_the_vote_without_calibrator():
+    (result,) = inference.classify(FakeSVM(), np.zeros((1, 4)), k=2)
+    assert result["prediction"] == result["top_k"][0]["digit"] == 0
+    assert not result["calibrated"]
+
+
+def test_tied_votes_go_to_the_lower_class():
+    svm = FakeSVM()
+    svm.decision_function = lambda x: np.array([[1.0, -1.0, 1.0]])  # one vote each
+    (result,) = inference.classify(svm, np.zeros((1, 4)), k=1)
+    assert result["prediction"] == result["top_k"][0]["digit"] == 0